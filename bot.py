@@ -10,10 +10,15 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
-from decimal import Decimal
 from database import Database
-from games import CubeGame, GameResult, TwoDiceGame, RockPaperScissorsGame, BasketballGame, DartsGame, SlotsGame, BowlingGame
-from cryptopay import CryptoPayAPI
+from workers import BetWorkerPool
+from idempotency import PayloadRegistry
+from metrics import Metrics
+from treasury import Treasury
+from games import CubeGame, GameResult, TwoDiceGame, RockPaperScissorsGame, BasketballGame, DartsGame, SlotsGame, BowlingGame, GAMES_DATA, resolve_bet
+from cryptopay import CryptoPayAPI, CryptoPayUnavailable, CryptoPayOutcomeUnknown
+from webhook import WebhookServer
+from money import Money, fmt, scale, to_str, to_units
 from typing import Optional, Dict
 import random
 import time
@@ -50,7 +55,37 @@ logging.basicConfig(level=logging.INFO)
 bot = Bot(token=os.getenv('BOT_TOKEN'), default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 db = Database()
-crypto_pay = CryptoPayAPI(os.getenv('CRYPTO_PAY_TOKEN'))
+bet_pool = BetWorkerPool(
+    db,
+    workers=int(os.getenv('BET_WORKERS', 4)),
+    name=os.getenv('BET_WORKER_NAME'),
+    max_in_flight=int(os.getenv('BET_MAX_IN_FLIGHT', 20)),
+    queue_slo=float(os.getenv('BET_QUEUE_SLO', 30))
+)
+INVOICE_TTL = 3600 # Срок оплаты счёта на ставку, сек
+INVOICE_EXPIRE_GRACE = 300 # Сколько ещё опрашивать инвойс после срока, сек
+INVOICE_IDS_PER_REQUEST = 100
+INVOICE_POLL_MIN = float(os.getenv('INVOICE_POLL_MIN', 3))
+INVOICE_POLL_MAX = float(os.getenv('INVOICE_POLL_MAX', 60))
+# С включённым приёмником обновлений Crypto Pay опрос инвойсов только сверяет пропущенное, сек
+INVOICE_RECONCILE_INTERVAL = float(os.getenv('INVOICE_RECONCILE_INTERVAL', 300))
+invoice_poll_wakeup = asyncio.Event()
+# Окно сводки по реф.балансу, сек: изменения за окно приходят рефереру одним сообщением
+REF_DIGEST_INTERVAL = int(os.getenv('REF_DIGEST_INTERVAL', 3600))
+# Сколько незавершённых ставок одного игрока может стоять в очереди; ставки сверх лимита возвращаются
+BET_USER_LIMIT = int(os.getenv('BET_USER_LIMIT', 5))
+processed_payloads = PayloadRegistry()
+# Длительности участков обработки ставки: parse, enqueue, roll, evaluate, payout, ledger, referral, notify
+metrics = Metrics()
+crypto_pay = CryptoPayAPI(os.getenv('CRYPTO_PAY_TOKEN'), base_url=os.getenv('CRYPTO_PAY_URL'))
+treasury = Treasury(crypto_pay)
+# Приёмник обновлений Crypto Pay включается заданием WEBHOOK_PORT; без него оплаты находит только опрос
+webhook = WebhookServer(
+    os.getenv('CRYPTO_PAY_TOKEN'),
+    host=os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+    port=int(os.getenv('WEBHOOK_PORT')),
+    path=os.getenv('WEBHOOK_PATH', '/cryptopay')
+) if os.getenv('WEBHOOK_PORT') else None
 
 
 CASINO_NAME = os.getenv('CASINO_NAME', 'GlacialCasino')
@@ -62,6 +97,11 @@ LOGS_ID = -1002870089940
 BETS_ID = -1002696966128
 BETS_LINK = os.getenv('BETS_CHANNEL_LINK')
 
+MIN_BET = to_units('0.1')
+REF_PERCENT = 15 # Доля реферера от проигрыша/выигрыша реферала, %
+MONEY_FIELDS = ('balance', 'ref_balance', 'ref_earnings')
+USERS_PAGE_SIZE = 10
+
 
 SUPPORT_LINK = os.getenv('SUPPORT_LINK')
 ADAPTER_LINK = os.getenv('ADAPTER_LINK')
@@ -148,7 +188,7 @@ async def start_handler(message: types.Message, command: CommandObject, state: F
                 f"<b>Заберите ваш выигрыш по кнопке ниже</b>",
                 parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text=f"Забрать {win_amount:.2f}$", url=check_link)]
+                    [InlineKeyboardButton(text=f"Забрать {fmt(win_amount)}$", url=check_link)]
                 ])
             )
         else:
@@ -162,7 +202,6 @@ async def start_handler(message: types.Message, command: CommandObject, state: F
         current_user = await db.get_user(user_id)
         if user and not current_user and user_id != referrer_id:
             await db.create_user(user_id, username, referrer_id)
-            await db.update_ref_balance(referrer_id, user['ref_balance'])
             await message.answer("🎉 Вы зарегистрированы по реферальной ссылке!")
             await bot.send_message(
                 chat_id=referrer_id,
@@ -214,8 +253,8 @@ async def show_profile_msg(message: types.Message):
         f"<blockquote>👤 Здесь только самая нужная информация для Вас</blockquote>\n\n"
         f"<blockquote>"
         f"• <b>ID:</b> <code>{user_id}</code>\n"
-        f"• <b>Реферальный баланс:</b> <code>{user['ref_balance']:.2f}$</code>\n"
-        f"• <b>Заработано с рефералов:</b> <code>{user['ref_earnings']:.2f}$</code>\n"
+        f"• <b>Реферальный баланс:</b> <code>{fmt(user['ref_balance'])}$</code>\n"
+        f"• <b>Заработано с рефералов:</b> <code>{fmt(user['ref_earnings'])}$</code>\n"
         f"• <b>Количество рефералов:</b> <code>{user['ref_count']}</code>"
         f"</blockquote>"
     )
@@ -244,8 +283,8 @@ async def show_referral_msg(message: types.Message):
         f"<b>{ username }, - это реферальная система {CASINO_NAME}</b>\n\n"
         f"<blockquote>🎁 Приводите к нам Ваших друзей и получайте 15% от их проигрышей</blockquote>\n\n"
         f"<blockquote>"
-        f"• <b>Реферальный баланс:</b> <code>{user.get('ref_balance', 0):.2f}$</code>\n"
-        f"• <b>Заработано:</b> <code>{user.get('ref_earnings', 0):.2f}$</code>\n"
+        f"• <b>Реферальный баланс:</b> <code>{fmt(user.get('ref_balance', 0))}$</code>\n"
+        f"• <b>Заработано:</b> <code>{fmt(user.get('ref_earnings', 0))}$</code>\n"
         f"• <b>Рефералов:</b> <code>{user.get('ref_count', 0)} чел.</code>\n"
         f"• <b><a href='https://t.me/{(await bot.get_me()).username}?start={user_id}'>Реферальная ссылка (зажмите чтобы скопировать)</a></b>\n"
         f"</blockquote>\n\n"
@@ -283,9 +322,9 @@ async def show_stats_msg(message: types.Message):
         f"• <b>Побед:</b> <code>{stats['wins']}</code>\n"
         f"• <b>Поражений:</b> <code>{stats['losses']}</code>\n"
         f"• <b>Процент побед:</b> <code>{stats['win_rate']:.1f}%</code>\n"
-        f"• <b>Оборот:</b> <code>{stats['turnover']:.2f}$</code>\n"
-        f"• <b>Выиграно всего:</b> <code>{stats['total_won']:.2f}$</code>\n"
-        f"• <b>Проиграно всего:</b> <code>{stats['total_lost']:.2f}$</code>"
+        f"• <b>Оборот:</b> <code>{fmt(stats['turnover'])}$</code>\n"
+        f"• <b>Выиграно всего:</b> <code>{fmt(stats['total_won'])}$</code>\n"
+        f"• <b>Проиграно всего:</b> <code>{fmt(stats['total_lost'])}$</code>"
         f"</blockquote>"
     )
     
@@ -296,43 +335,6 @@ async def show_stats_msg(message: types.Message):
         parse_mode="HTML"
     )
 
-GAMES_DATA = {
-    "cube": {
-        "name": "🎲 Кубик",
-        "types": {
-            "чет": "Чет (x1.85)", "нечет": "Нечет (x1.85)", 
-            "больше": "Больше 3 (x1.85)", "меньше": "Меньше 4 (x1.85)", 
-            "плинко": "Плинко (x0.3-1.95)",
-            "1": "Число 1 (x4)", "2": "Число 2 (x4)", "3": "Число 3 (x4)",
-            "4": "Число 4 (x4)", "5": "Число 5 (x4)", "6": "Число 6 (x4)",
-            "сектор1": "Сектор 1 (x2.5)", "сектор2": "Сектор 2 (x2.5)", "сектор3": "Сектор 3 (x2.5)"
-        }
-    },
-    "two_dice": {
-        "name": "🎲🎲 Два кубика",
-        "types": {"победа1": "Победа 1 (x1.85)", "победа2": "Победа 2 (x1.85)", "ничья": "Ничья (x3)"}
-    },
-    "rock_paper_scissors": {
-        "name": "👊 КНБ",
-        "types": {"камень": "👊 (x2.5)", "ножницы": "✌️ (x2.5)", "бумага": "✋ (x2.5)"}
-    },
-    "basketball": {
-        "name": "🏀 Баскетбол",
-        "types": {"гол": "Гол (x1.85)", "мимо": "Мимо (x1.4)"}
-    },
-    "darts": {
-        "name": "🎯 Дартс",
-        "types": {"белое": "Белое (x1.85)", "красное": "Красное (x1.85)", "яблочко": "Яблочко (x2.5)", "промах": "Мимо (x2.5)"}
-    },
-    "slots": {
-        "name": "🎰 Слоты",
-        "types": {"слоты": "Играть (x5-10)"}
-    },
-    "bowling": {
-        "name": "🎳 Боулинг",
-        "types": {"страйк": "Страйк (x4)", "боулпромах": "Промах (x4)", "боулинг": "Плинко (x0-4)", "боулпобеда": "Победа в дуэли (x1.85)", "боулпоражение": "Поражение в дуэли (x1.85)"}
-    }
-}
 @dp.message(Command("games"), StateFilter('*'))
 @dp.message(F.text == "🎲 Сделать ставку", StateFilter('*'))
 async def start_betting(message: types.Message, state: FSMContext):
@@ -446,8 +448,8 @@ async def select_bet_type(callback_query: types.CallbackQuery, state: FSMContext
 @dp.message(BettingStates.ENTER_AMOUNT)
 async def enter_amount(message: types.Message, state: FSMContext):
     try:
-        amount = float(message.text.replace(",", "."))
-        if amount < 0.1:
+        amount = to_units(message.text.replace(",", "."))
+        if amount < MIN_BET:
             await message.answer("Минимальная сумма ставки: 0.1$")
             return
     except ValueError:
@@ -461,23 +463,34 @@ async def enter_amount(message: types.Message, state: FSMContext):
     
     payload = f"bet_{uuid.uuid4().hex}"
 
-    await db.add_invoice_bet(payload, user_id, game_key, bet_type_key, amount)
-
-    invoice = await crypto_pay.create_invoice(
-        asset="USDT",
-        amount=str(amount),
-        description=f"Ставка в {GAMES_DATA[game_key]['name']} (Payload: {payload})",
-        payload=payload,
-        expires_in=3600 # 1 час
+    await db.add_invoice_bet(
+        payload, user_id, game_key, bet_type_key, amount,
+        expires_at=time.time() + INVOICE_TTL,
+        name=message.from_user.full_name
     )
 
+    try:
+        invoice = await crypto_pay.create_invoice(
+            asset="USDT",
+            amount=amount,
+            description=f"Ставка в {GAMES_DATA[game_key]['name']} (Payload: {payload})",
+            payload=payload,
+            expires_in=INVOICE_TTL
+        )
+    except CryptoPayUnavailable as e:
+        invoice = {'ok': False, 'error': str(e)}
+
     if invoice and invoice.get("ok"):
         invoice_result = invoice.get("result")
         pay_url = invoice_result.get("pay_url")
+        await db.set_invoice_id(payload, invoice_result["invoice_id"])
+        # Поллер в простое спит долго - будим, чтобы оплату заметить сразу. С приёмником оплату сообщит Crypto Pay
+        if webhook is None:
+            invoice_poll_wakeup.set()
         
         await message.answer(
             f"✅ <b>Ваш счет на оплату ставки создан!</b>\n\n"
-            f"<b>Сумма:</b> <code>{amount:.2f} USDT</code>\n\n"
+            f"<b>Сумма:</b> <code>{fmt(amount)} USDT</code>\n\n"
             "Нажмите кнопку ниже, чтобы перейти к оплате. Счет действителен 1 час.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="💳 Перейти к оплате", url=pay_url)],
@@ -487,6 +500,7 @@ async def enter_amount(message: types.Message, state: FSMContext):
         )
         await state.clear()
     else:
+        await db.expire_invoice_bet(payload)
         await message.answer("❌ Не удалось создать счет для оплаты. Попробуйте позже или обратитесь в поддержку.")
         logging.error(f"Invoice creation failed for user {user_id}: {invoice}")
         await state.clear()
@@ -522,20 +536,72 @@ async def cmd_admin(message: types.Message):
     
     await message.answer("👑 <b>Админ-панель</b>", reply_markup=keyboard, parse_mode="HTML")
 
+@dp.message(Command("queue"))
+async def cmd_queue(message: types.Message):
+    if not await is_admin(message.from_user.id):
+        return
+
+    stats = await bet_pool.stats()
+    text = (
+        "<b>Очередь ставок</b>\n\n"
+        f"<blockquote>• Ожидают: <code>{stats['pending']}</code>, между этапами: <code>{stats['staged']}</code>\n"
+        f"• В игре: <code>{stats['in_flight']}</code> из <code>{stats['workers']}</code> воркеров "
+        f"(всего по базе: <code>{stats['processing']}</code>, аренда истекла: <code>{stats['expired']}</code>)\n"
+        f"• Начато и не доиграно: <code>{stats['in_game']}</code> из <code>{stats['max_in_flight'] or '∞'}</code>\n"
+        f"• Самая старая ждёт: <code>{stats['oldest_wait']:.1f} сек</code>, "
+        f"SLO <code>{stats['queue_slo'] or '-'} сек</code>, нарушений: <code>{stats['slo_breaches']}</code></blockquote>\n\n"
+        f"<blockquote>• Разыграно: <code>{stats['processed']}</code>, ошибок: <code>{stats['failed']}</code>, повторов: <code>{stats['retried']}</code>\n"
+        f"• Ожидание: среднее <code>{stats['avg_wait']:.2f}</code>, p95 <code>{stats['p95_wait']:.2f}</code>, "
+        f"макс <code>{stats['max_wait']:.2f} сек</code></blockquote>\n\n"
+        "<blockquote><b>Этапы:</b>\n"
+    )
+    for name, stage in stats['stages'].items():
+        text += (
+            f"• {name}: <code>{stage['per_minute']:.1f}/мин</code>, "
+            f"<code>{stage['avg_time'] * 1000:.0f} мс</code>, ошибок <code>{stage['failed']}</code>\n"
+        )
+    text += "</blockquote>"
+    await message.answer(text, parse_mode="HTML")
+
+@dp.message(Command("metrics"))
+async def cmd_metrics(message: types.Message, command: CommandObject):
+    """Длительности участков обработки ставки; /metrics json - тот же снимок файлом"""
+    if not await is_admin(message.from_user.id):
+        return
+
+    if command.args and command.args.strip() == "json":
+        await message.answer_document(
+            types.BufferedInputFile(metrics.dump().encode(), filename=f"metrics_{int(time.time())}.json")
+        )
+        return
+
+    spans = metrics.snapshot()
+    if not spans:
+        await message.answer("Замеров пока нет")
+        return
+    text = "<b>Длительность участков, мс</b>\n<i>p50 / p95 / p99 / макс (число замеров, ошибок)</i>\n\n"
+    for name, span in spans.items():
+        text += (
+            f"• {name}: <code>{span['p50'] * 1000:.0f} / {span['p95'] * 1000:.0f} / "
+            f"{span['p99'] * 1000:.0f} / {span['max'] * 1000:.0f}</code> "
+            f"({span['count']}, {span['errors']})\n"
+        )
+    await message.answer(text, parse_mode="HTML")
+
 @dp.callback_query(lambda c: c.data == "admin_users")
 async def show_users(callback_query: types.CallbackQuery):
     if not await is_admin(callback_query.from_user.id):
         await callback_query.answer("Нет доступа", show_alert=True)
         return
         
-    users = await db.get_all_users(limit=10)
+    users = await db.get_users_page(USERS_PAGE_SIZE)
     
     text = "<b>Управление пользователями</b>\n\n"
     for user in users:
         text += (
             f"<code>{user['user_id']}</code> | {user['username']}\n"
-            f"Реф.баланс: <code>{user['ref_balance']:.2f}$</code>\n"
-            f"Заработано: <code>{user['ref_earnings']:.2f}$</code>\n"
+            f"Реф.баланс: <code>{fmt(user['ref_balance'])}$</code>\n"
+            f"Заработано: <code>{fmt(user['ref_earnings'])}$</code>\n"
             f"Рефералов: <code>{user['ref_count']}</code>\n"
             f"Пригласил: <code>{user.get('referrer_username', 'нет')}</code>\n"
             f"Дата: <code>{user['created_at']}</code>\n\n"
@@ -543,7 +609,10 @@ async def show_users(callback_query: types.CallbackQuery):
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Поиск", callback_data="search_users")],
-        [InlineKeyboardButton(text="Следующая", callback_data="users_next_10")],
+        [InlineKeyboardButton(text="Следующая", callback_data=f"users_next_{user_cursor(users[-1])}")],
+        [InlineKeyboardButton(text="Назад", callback_data="back_to_admin")]
+    ] if len(users) == USERS_PAGE_SIZE else [
+        [InlineKeyboardButton(text="Поиск", callback_data="search_users")],
         [InlineKeyboardButton(text="Назад", callback_data="back_to_admin")]
     ])
 
@@ -568,15 +637,20 @@ async def show_admin_stats(callback_query: types.CallbackQuery):
     text += f"• Всего: <code>{stats['today_games']}</code>\n"
     text += f"• Выиграно: <code>{stats['today_wins']}</code>\n"
     text += f"• Проиграно: <code>{stats['today_losses']}</code>\n"
-    text += f"• Оборот: <code>{stats['today_turnover']:.2f}$</code>\n"
-    text += f"• Прибыль: <code>{(stats['today_earned'] - stats['today_spent']):.2f}$</code></blockquote>\n\n"
+    text += f"• Оборот: <code>{fmt(stats['today_turnover'])}$</code>\n"
+    text += f"• Прибыль: <code>{fmt(stats['today_earned'] - stats['today_spent'])}$</code></blockquote>\n\n"
     
     text += f"<blockquote><b>Игры за неделю:</b>\n"
     text += f"• Всего: <code>{stats['week_games']}</code>\n"
     text += f"• Выиграно: <code>{stats['week_wins']}</code>\n"
     text += f"• Проиграно: <code>{stats['week_losses']}</code>\n"
-    text += f"• Оборот: <code>{stats['week_turnover']:.2f}$</code>\n"
-    text += f"• Прибыль: <code>{(stats['week_earned'] - stats['week_spent']):.2f}$</code></blockquote>"
+    text += f"• Оборот: <code>{fmt(stats['week_turnover'])}$</code>\n"
+    text += f"• Прибыль: <code>{fmt(stats['week_earned'] - stats['week_spent'])}$</code></blockquote>\n\n"
+
+    cache = db.cache_stats()
+    text += f"<blockquote><b>Кэш пользователей:</b>\n"
+    text += f"• Записей: <code>{cache['size']}</code>\n"
+    text += f"• Попаданий: <code>{cache['hit_rate']:.1f}%</code> ({cache['hits']}/{cache['hits'] + cache['misses']})</blockquote>"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Обновить", callback_data="admin_stats")],
@@ -630,8 +704,8 @@ async def process_user_search(message: types.Message, state: FSMContext):
     for user in users:
         text += (
             f"<code>{user['user_id']}</code> | {user['username']}\n"
-            f"Реф.баланс: <code>{user['ref_balance']:.2f}$</code>\n"
-            f"Заработано: <code>{user['ref_earnings']:.2f}$</code>\n"
+            f"Реф.баланс: <code>{fmt(user['ref_balance'])}$</code>\n"
+            f"Заработано: <code>{fmt(user['ref_earnings'])}$</code>\n"
             f"Рефералов: <code>{user['ref_count']}</code>\n"
             f"Пригласил: <code>{user.get('referrer_username', 'нет')}</code>\n"
             f"Дата: <code>{user['created_at']}</code>\n\n"
@@ -646,7 +720,7 @@ async def handle_edit_user(callback_query: types.CallbackQuery, state: FSMContex
     if not await is_admin(callback_query.from_user.id):
         return
 
-    action, field, user_id = callback_query.data.split("_")
+    field, user_id = callback_query.data[len("edit_"):].rsplit("_", 1)
     await state.update_data(field=field, user_id=user_id)
     await state.set_state(AdminStates.EDIT_USER)
     
@@ -673,7 +747,7 @@ async def process_edit_user(message: types.Message, state: FSMContext):
     user_id = int(data['user_id'])
     
     try:
-        value = float(message.text) if field != "referrer" else int(message.text)
+        value = to_units(message.text) if field in MONEY_FIELDS else int(message.text)
         updates = {field: value}
         
         if await db.update_user(user_id, updates):
@@ -683,9 +757,9 @@ async def process_edit_user(message: types.Message, state: FSMContext):
             user = await db.get_user(user_id)
             text = (
                 f"👤 Пользователь <code>{user['user_id']}</code>\n"
-                f"💰 Баланс: <code>{user['balance']:.2f}$</code>\n"
-                f"🔄 Реф.баланс: <code>{user['ref_balance']:.2f}$</code>\n"
-                f"💎 Заработано: <code>{user['ref_earnings']:.2f}$</code>\n"
+                f"💰 Баланс: <code>{fmt(user['balance'])}$</code>\n"
+                f"🔄 Реф.баланс: <code>{fmt(user['ref_balance'])}$</code>\n"
+                f"💎 Заработано: <code>{fmt(user['ref_earnings'])}$</code>\n"
                 f"👥 Рефералов: <code>{user['ref_count']}</code>\n"
                 f"🔗 Пригласил: <code>{user.get('referrer_id', 'нет')}</code>"
             )
@@ -740,13 +814,26 @@ async def cancel_delete_user(callback_query: types.CallbackQuery, state: FSMCont
     await callback_query.message.answer("❌ Удаление отменено")
     await callback_query.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("users_next_"))
+def user_cursor(user: dict) -> str:
+    """Ключ страницы для callback_data: created_at и user_id последней/первой строки"""
+    return f"{user['created_at']}|{user['user_id']}"
+
+def parse_user_cursor(value: str) -> tuple:
+    created_at, user_id = value.rsplit("|", 1)
+    return created_at, int(user_id)
+
+@dp.callback_query(lambda c: c.data.startswith(("users_next_", "users_prev_")))
 async def show_more_users(callback_query: types.CallbackQuery):
     if not await is_admin(callback_query.from_user.id):
         return
 
-    offset = int(callback_query.data.split("_")[2])
-    users = await db.get_all_users(limit=10, offset=offset)
+    direction = callback_query.data[:len("users_next_")]
+    after = parse_user_cursor(callback_query.data[len("users_next_"):])
+    if direction == "users_next_":
+        users = await db.get_users_page(USERS_PAGE_SIZE, after)
+    else:
+        # Назад: идём от первой строки текущей страницы в сторону новых и разворачиваем
+        users = (await db.get_users_page(USERS_PAGE_SIZE, after, newest_first=False))[::-1]
     
     if not users:
         await callback_query.answer("Больше пользователей нет")
@@ -756,8 +843,8 @@ async def show_more_users(callback_query: types.CallbackQuery):
     for user in users:
         text += (
             f"<code>{user['user_id']}</code> | {user['username']}\n"
-            f"🔄 Реф.баланс: <code>{user['ref_balance']:.2f}$</code>\n"
-            f"💎 Заработано: <code>{user['ref_earnings']:.2f}$</code>\n"
+            f"🔄 Реф.баланс: <code>{fmt(user['ref_balance'])}$</code>\n"
+            f"💎 Заработано: <code>{fmt(user['ref_earnings'])}$</code>\n"
             f"👥 Рефералов: <code>{user['ref_count']}</code>\n"
             f"🔗 Пригласил: <code>{user.get('referrer_username', 'нет')}</code>\n"
             f"📅 Дата: <code>{user['created_at']}</code>\n\n"
@@ -766,8 +853,8 @@ async def show_more_users(callback_query: types.CallbackQuery):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔍 Поиск", callback_data="search_users")],
         [
-            InlineKeyboardButton(text="◀️ Предыдущая", callback_data=f"users_next_{max(0, offset-10)}"),
-            InlineKeyboardButton(text="▶️ Следующая", callback_data=f"users_next_{offset+10}")
+            InlineKeyboardButton(text="◀️ Предыдущая", callback_data=f"users_prev_{user_cursor(users[0])}"),
+            InlineKeyboardButton(text="▶️ Следующая", callback_data=f"users_next_{user_cursor(users[-1])}")
         ],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")]
     ])
@@ -963,8 +1050,7 @@ async def process_broadcast(callback_query: types.CallbackQuery, state: FSMConte
     keyboard = InlineKeyboardMarkup(inline_keyboard=inline_buttons) if buttons else None
 
 
-    users = await db.get_all_users(limit=10000)  # Increased limit for large broadcasts
-    total_users = len(users)
+    total_users = await db.count_users()
     
 
     successful = 0
@@ -987,59 +1073,65 @@ async def process_broadcast(callback_query: types.CallbackQuery, state: FSMConte
     start_time = time.time()
     last_update = start_time
     
-    for i, user in enumerate(users, 1):
-        try:
-            if data['message_type'] == "text":
-                await bot.send_message(
-                    user['user_id'],
-                    data['text'],
-                    parse_mode=data['parse_mode'],
-                    reply_markup=keyboard
-                )
-            else:
-                method = getattr(bot, f"send_{data['message_type']}")
-                await method(
-                    user['user_id'],
-                    data['file_id'],
-                    caption=data['text'],
-                    reply_markup=keyboard
-                )
-            successful += 1
+    i = 0
+    # Пользователи читаются пачками по ключу, вся аудитория в память не загружается
+    async for batch in db.iter_users():
+        for user in batch:
+            i += 1
+            try:
+                if data['message_type'] == "text":
+                    await bot.send_message(
+                        user['user_id'],
+                        data['text'],
+                        parse_mode=data['parse_mode'],
+                        reply_markup=keyboard
+                    )
+                else:
+                    method = getattr(bot, f"send_{data['message_type']}")
+                    await method(
+                        user['user_id'],
+                        data['file_id'],
+                        caption=data['text'],
+                        reply_markup=keyboard
+                    )
+                successful += 1
             
-        except aiogram.exceptions.TelegramForbiddenError:
-            blocked += 1
-        except aiogram.exceptions.TelegramBadRequest as e:
-            if "chat not found" in str(e).lower():
-                deleted += 1
-            else:
+            except aiogram.exceptions.TelegramForbiddenError:
+                blocked += 1
+            except aiogram.exceptions.TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    deleted += 1
+                else:
+                    failed += 1
+            except Exception as e:
                 failed += 1
-        except Exception as e:
-            failed += 1
-            logging.error(f"Broadcast error for user {user['user_id']}: {e}")
+                logging.error(f"Broadcast error for user {user['user_id']}: {e}")
             
 
-        current_time = time.time()
-        if current_time - last_update >= 3 or i == total_users:
-            elapsed = int(current_time - start_time)
-            progress = (i / total_users) * 100
+            current_time = time.time()
+            if current_time - last_update >= 3 or i == total_users:
+                elapsed = int(current_time - start_time)
+                progress = min(i / total_users, 1) * 100 if total_users else 100
             
-            try:
-                await status_message.edit_text(
-                    "📨 Рассылка в процессе...\n\n"
-                    f"⏳ Всего пользователей: {total_users}\n"
-                    f"✅ Отправлено: {successful}\n"
-                    f"❌ Ошибок: {failed}\n"
-                    f"🚫 Заблокировали: {blocked}\n"
-                    f"🗑 Удалили: {deleted}\n"
-                    f"⏱ Прошло времени: {elapsed} сек\n"
-                    f"📊 Прогресс: {progress:.1f}%"
-                )
-                last_update = current_time
-            except:
-                pass
+                try:
+                    await status_message.edit_text(
+                        "📨 Рассылка в процессе...\n\n"
+                        f"⏳ Всего пользователей: {total_users}\n"
+                        f"✅ Отправлено: {successful}\n"
+                        f"❌ Ошибок: {failed}\n"
+                        f"🚫 Заблокировали: {blocked}\n"
+                        f"🗑 Удалили: {deleted}\n"
+                        f"⏱ Прошло времени: {elapsed} сек\n"
+                        f"📊 Прогресс: {progress:.1f}%"
+                    )
+                    last_update = current_time
+                except:
+                    pass
                 
-        await asyncio.sleep(0.05)
+            await asyncio.sleep(0.05)
 
+    # За время рассылки могли прийти новые пользователи - итог считаем по фактически обойдённым
+    total_users = i
     elapsed = int(time.time() - start_time)
     speed = total_users / elapsed if elapsed > 0 else 0
     
@@ -1053,7 +1145,7 @@ async def process_broadcast(callback_query: types.CallbackQuery, state: FSMConte
         f"🗑 Удалённые аккаунты: {deleted}\n"
         f"⏱ Время выполнения: {elapsed} сек\n"
         f"⚡️ Скорость: {speed:.1f} сообщений/сек\n\n"
-        f"📈 Процент успеха: {(successful/total_users*100):.1f}%",
+        f"📈 Процент успеха: {(successful/total_users*100 if total_users else 0):.1f}%",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="« Назад", callback_data="back_to_admin")]
         ])
@@ -1061,6 +1153,8 @@ async def process_broadcast(callback_query: types.CallbackQuery, state: FSMConte
     
     await state.clear()
 
+BREAKER_STATES = {'closed': "🟢 замкнут", 'open': "🔴 разомкнут", 'half_open': "🟡 ждёт пробный запрос"}
+
 @dp.callback_query(lambda c: c.data == "admin_cryptobot")
 async def show_cryptobot_balance(callback_query: types.CallbackQuery):
     if not await is_admin(callback_query.from_user.id):
@@ -1077,6 +1171,30 @@ async def show_cryptobot_balance(callback_query: types.CallbackQuery):
                 balance_text += f"<b>{currency}:</b> <code>{available:.2f}</code>\n"
         else:
             balance_text += "❌ Нет доступных балансов"
+        treasury_stats = treasury.stats()
+        balance_text += (
+            f"\n<b>Казна (кеш):</b> <code>{to_str(treasury_stats['available'])}$</code>, "
+            f"в резерве: <code>{to_str(treasury_stats['reserved'])}$</code>"
+        )
+        if treasury_stats['age'] is not None:
+            balance_text += f", обновлено <code>{treasury_stats['age']:.0f}</code> сек назад"
+        balance_text += "\n"
+        api_stats = crypto_pay.stats()
+        breaker = api_stats['breaker']
+        balance_text += (
+            f"\n<b>Запросов к API:</b> <code>{api_stats['requests']}</code>, "
+            f"новых соединений: <code>{api_stats['handshakes']}</code>, повторов: <code>{api_stats['retries']}</code>\n"
+            f"<b>Предохранитель:</b> {BREAKER_STATES[breaker['state']]}, ошибок подряд: <code>{breaker['failures']}</code>, "
+            f"срабатываний: <code>{breaker['trips']}</code>"
+        )
+        if breaker['state'] == 'open':
+            balance_text += f"\n<i>Пробный запрос через {breaker['retry_in']:.0f} сек</i>"
+        if webhook is not None:
+            webhook_stats = webhook.stats()
+            balance_text += (
+                f"\n<b>Вебхук:</b> обновлений <code>{webhook_stats['received']}</code>, "
+                f"оплат <code>{webhook_stats['invoices_paid']}</code>, отклонено <code>{webhook_stats['rejected']}</code>"
+            )
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💳 Пополнить", callback_data="add_cryptobot_balance")],
             [InlineKeyboardButton(text="🧾 Активные чеки", callback_data="admin_checks")],
@@ -1205,7 +1323,7 @@ async def process_add_balance(message: types.Message, state: FSMContext):
         return
     
     try:
-        amount = float(message.text)
+        amount = to_units(message.text)
         if amount <= 0:
             await message.answer("❌ Сумма должна быть больше 0")
             return
@@ -1213,8 +1331,8 @@ async def process_add_balance(message: types.Message, state: FSMContext):
 
         invoice_data = await crypto_pay.create_invoice(
             asset="USDT",
-            amount=str(amount),
-            description=f"Пополнение баланса CryptoBot на {amount} USDT",
+            amount=amount,
+            description=f"Пополнение баланса CryptoBot на {to_str(amount)} USDT",
             hidden_message="Спасибо за пополнение!"
         )
         
@@ -1226,7 +1344,7 @@ async def process_add_balance(message: types.Message, state: FSMContext):
 
         await message.answer(
             "✅ <b>Счет на пополнение создан</b>\n\n"
-            f"<b>Сумма:</b> <code>{amount}$</code>\n"
+            f"<b>Сумма:</b> <code>{to_str(amount)}$</code>\n"
             f"<b>Валюта:</b> <code>USDT</code>",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -1240,7 +1358,7 @@ async def process_add_balance(message: types.Message, state: FSMContext):
             chat_id=LOGS_ID,
             text=f"💳 <b>Создан счет на пополнение CryptoBot</b>\n\n"
                  f"<b>Администратор:</b> {message.from_user.mention_html()}\n"
-                 f"<b>Сумма:</b> <code>{amount}$</code>\n"
+                 f"<b>Сумма:</b> <code>{to_str(amount)}$</code>\n"
                  f"<b>Валюта:</b> <code>USDT</code>",
             parse_mode="HTML"
         )
@@ -1279,47 +1397,61 @@ async def refresh_cryptobot_balance(callback_query: types.CallbackQuery):
 
 
 
-async def create_payment_check(amount: float, description: str = None) -> dict:
+# Дописывается к сообщению о ручной выплате, если createCheck мог выполниться без ответа
+CHECK_UNKNOWN_NOTE = (
+    "\n\n❗️ <b>Чек мог быть создан:</b> ответ API на создание чека потерян. "
+    "Перед ручной выплатой проверьте чеки в @CryptoBot, иначе игрок получит деньги дважды."
+)
+
+@metrics.timed('payout')
+async def create_payment_check(amount: Money, description: str = None) -> dict:
+    """Данные чека, None, если чек не создан, или {'outcome_unknown': True}, если создан ли он - неизвестно"""
     try:
         if not description:
-            description = f"Выигрыш {amount}$ в {CASINO_NAME}"
+            description = f"Выигрыш {to_str(amount)}$ в {CASINO_NAME}"
         
-        balance_data = await crypto_pay.get_balance()
-        balances = balance_data.get('result', [])
-        usdt_balance = 0
+        # Баланс из кеша казны; сумма резервируется, пока создаётся чек
+        with metrics.span('payout.balance'):
+            reserved_at = await treasury.reserve(amount)
         
-        for balance in balances:
-            currency = balance.get('currency_code', '')
-            available = balance.get('available', '0')
-            
-            if currency and currency.upper() == 'USDT':
-                usdt_balance = float(available)
-                break
-        
-        if usdt_balance < amount:
+        if reserved_at is None:
             await bot.send_message(
                 chat_id=LOGS_ID,
                 text=f"⚠️ <b>Недостаточно средств для создания чека</b>\n"
-                     f"<b>Требуется:</b> <code>{amount}$</code>\n"
-                     f"<b>Доступно:</b> <code>{usdt_balance}$</code>",
+                     f"<b>Требуется:</b> <code>{to_str(amount)}$</code>\n"
+                     f"<b>Доступно:</b> <code>{to_str(treasury.available())}$</code>",
                 parse_mode="HTML"
             )
             return None
         
-        result = await crypto_pay.create_check(
-            asset="USDT",
-            amount=str(amount),
-            description=description,
-            hidden_message=f"Поздравляем с выигрышем в {CASINO_NAME}!"
-        )
+        try:
+            with metrics.span('payout.check'):
+                result = await crypto_pay.create_check(
+                    asset="USDT",
+                    amount=amount,
+                    description=description,
+                    hidden_message=f"Поздравляем с выигрышем в {CASINO_NAME}!"
+                )
+        except CryptoPayOutcomeUnknown as e:
+            # Запрос дошёл до API, ответ потерян - чек мог быть создан, повторять нельзя
+            treasury.release(amount, spent=False, reserved_at=reserved_at)
+            treasury.invalidate()
+            logging.error(f"Check creation outcome unknown: {e}")
+            return {'outcome_unknown': True}
+        except Exception:
+            # Создан ли чек, неизвестно - баланс перечитаем из API
+            treasury.release(amount, spent=False, reserved_at=reserved_at)
+            treasury.invalidate()
+            raise
+        treasury.release(amount, spent=result.get('ok') == True, reserved_at=reserved_at)
         
         if result.get('ok') == True and 'result' in result:
             # Перемещаем это сообщение сюда, чтобы оно отправлялось только при успешном создании чека
             await bot.send_message(
                 chat_id=LOGS_ID,
                 text=f"💸 <b>СОЗДАН ЧЕК НА ВЫПЛАТУ</b>\n\n"
-                     f"<b>Сумма:</b> <code>{amount}$</code>\n"
-                     f"<b>Новый баланс казны:</b> <code>{usdt_balance - amount}$</code>",
+                     f"<b>Сумма:</b> <code>{to_str(amount)}$</code>\n"
+                     f"<b>Новый баланс казны:</b> <code>{to_str(treasury.available())}$</code>",
                 parse_mode="HTML"
             )
 
@@ -1327,7 +1459,7 @@ async def create_payment_check(amount: float, description: str = None) -> dict:
             return {
                 'check_id': check_data.get('check_id'),
                 'check_link': check_data.get('bot_check_url'),
-                'amount': check_data.get('amount')
+                'amount': to_units(check_data.get('amount', '0'))
             }
         # Добавляем логирование ошибки, если чек не создан
         if result.get('ok') == False and 'error' in result:
@@ -1349,35 +1481,35 @@ async def process_game_result(message: types.Message, game_result: GameResult, s
     
     if game_type == 'rock_paper_scissors':
         if game_result.won:
-            win_amount = float(game_result.amount)
+            win_amount = game_result.amount
             check_result = await create_payment_check(win_amount)
             
             # Отправляем только сообщение в логи
-            current_balance = await db.get_current_balance()
             await bot.send_message(
                 chat_id=LOGS_ID,
                 text=f"💰 <b>ВЫПЛАТА ЧЕКОМ </b>\n\n"
                      f"<b>Игрок:</b> {message.from_user.mention_html()}\n"
                      f"<b>ID:</b> <code>{user_id}</code>\n"
-                     f"<b>Сумма выигрыша:</b> <code>{win_amount}$</code>\n"
-                     f"<b>Текущий баланс казны:</b> <code>{current_balance - float(win_amount)}$</code>",
+                     f"<b>Сумма выигрыша:</b> <code>{to_str(win_amount)}$</code>\n"
+                     f"<b>Текущий баланс казны:</b> <code>{to_str(treasury.available())}$</code>"
+                     + (CHECK_UNKNOWN_NOTE if check_result and check_result.get('outcome_unknown') else ""),
                 parse_mode="HTML"
             )
         return
     
     if game_result.won:
-        win_amount = float(game_result.amount)
+        win_amount = game_result.amount
         check_result = await create_payment_check(win_amount)
         
         # Отправляем только сообщение в логи
-        current_balance = await db.get_current_balance()
         await bot.send_message(
             chat_id=LOGS_ID,
             text=f"💰 <b>ВЫПЛАТА ЧЕКОМ</b>\n\n"
                  f"<b>Игрок:</b> {message.from_user.mention_html()}\n"
                  f"<b>ID:</b> <code>{user_id}</code>\n"
-                 f"<b>Сумма выигрыша:</b> <code>{win_amount}$</code>\n"
-                 f"<b>Текущий баланс казны:</b> <code>{current_balance - float(win_amount)}$</code>",
+                 f"<b>Сумма выигрыша:</b> <code>{to_str(win_amount)}$</code>\n"
+                 f"<b>Текущий баланс казны:</b> <code>{to_str(treasury.available())}$</code>"
+                 + (CHECK_UNKNOWN_NOTE if check_result and check_result.get('outcome_unknown') else ""),
             parse_mode="HTML"
         )
     
@@ -1386,22 +1518,11 @@ async def process_game_result(message: types.Message, game_result: GameResult, s
     referrer_id = user.get('referrer_id')
     
     if referrer_id:
-        if game_result.won:
-            ref_penalty = float(game_result.amount) * 0.15
-            await db.update_ref_balance(referrer_id, -ref_penalty)
-            await bot.send_message(
-                chat_id=referrer_id,
-                text=f"💸 С вашего Реф.Баланса списано <code>{ref_penalty:.2f}$</code> из-за выигрыша <code>{game_result.amount:.2f}$</code>",
-                parse_mode="HTML"
-            )
-        else:
-            ref_reward = float(bet_amount) * 0.15
-            await db.update_ref_balance(referrer_id, ref_reward)
-            await bot.send_message(
-                chat_id=referrer_id,
-                text=f"💵 Ваш Реф.Баланс пополнен на <code>{ref_reward:.2f}$</code> из-за проигрыша <code>{game_result.amount:.2f}$</code>",
-                parse_mode="HTML"
-            )
+        with metrics.span('referral'):
+            if game_result.won:
+                await db.apply_referral_change(referrer_id, user_id, -scale(game_result.amount, REF_PERCENT))
+            else:
+                await db.apply_referral_change(referrer_id, user_id, scale(bet_amount, REF_PERCENT))
 
 @dp.message(GameStates.DICE_BET)
 async def handle_dice_game(message: types.Message, state: FSMContext):
@@ -1409,7 +1530,7 @@ async def handle_dice_game(message: types.Message, state: FSMContext):
     dice_value = dice.dice.value
     
     state_data = await state.get_data()
-    bet_amount = float(state_data.get('bet_amount', 0))
+    bet_amount = state_data.get('bet_amount', 0)
     bet_type = state_data.get('bet_type', '')
     
     game = CubeGame(bet_amount)
@@ -1435,38 +1556,12 @@ async def check_messages(message: types.Message):
         if payload_match:
             payload = payload_match.group(1)
             logging.info(f"Found invoice payload: {payload}")
-            bet_data = await db.get_invoice_bet(payload)
-            
-            if bet_data:
-                logging.info(f"Processing invoice payment with payload: {payload}")
-                
-                user_info = None
-                try:
-                    user_info = await bot.get_chat(bet_data['user_id'])
-                    user_name = user_info.full_name if user_info else f"User {bet_data['user_id']}"
-                except Exception:
-                    user_name = f"User {bet_data['user_id']}"
-
-                data_for_process_bet = {
-                    'id': bet_data['user_id'],
-                    'name': user_name,
-                    'usd_amount': bet_data['amount'],
-                    'comment': bet_data['bet_type_key'],
-                    'game': bet_data['game_key']
-                }
-                
-                await process_bet(data_for_process_bet)
-                await db.mark_invoice_bet_paid(payload)
-                logging.info(f"Invoice bet {bet_data['invoice_id']} processed and marked as paid.")
-            elif bet_data and bet_data['status'] == 'paid':
-                logging.info(f"Invoice {bet_data['invoice_id']} with payload {payload} already processed.")
-            else:
-               
-                pass 
+            await process_invoice_payment(payload)
 
         # Затем проверяем на обычный перевод
         if "отправил(а)" in text and "💬" in text:
-            payment_data = parse_message(message)
+            with metrics.span('parse'):
+                payment_data = parse_message(message)
             if payment_data:
                 logging.info(f"Successfully parsed transfer message: {payment_data}")
                 await process_bet(payment_data)
@@ -1504,10 +1599,10 @@ def parse_message(message: types.Message) -> Optional[Dict]:
                 name = re.sub(r'@[\w]+', '***', name) if '@' in name else name
                 user_id = int(user.id)
                 asset = msg_text.split("отправил(а)")[1].split()[1]
-                amount = float(msg_text.split("($")[1].split(').')[0].replace(',', ""))
+                amount = to_units(msg_text.split("($")[1].split(').')[0].replace(',', ""))
                 
                 logging.info(f"Parsed user: {name} ({user_id})")
-                logging.info(f"Parsed amount: {amount} {asset}")
+                logging.info(f"Parsed amount: {to_str(amount)} {asset}")
 
                 if '💬' in message.text:
                     comment = message.text.split("💬 ")[1].lower()
@@ -1539,29 +1634,8 @@ def parse_message(message: types.Message) -> Optional[Dict]:
         return None
 
 def parse_game_type_and_bet(comment: str):
-    comment = comment.lower().replace(" ", "").replace("ё", "е")
-    basketball_words = ["мимо", "гол"]
-    if comment in basketball_words:
-        return "basketball", comment
-    darts_words = ["белое", "красное", "яблочко", "промах"]
-    if comment in darts_words:
-        return "darts", comment
-    slots_words = ["казик", "слоты", "777", "джекпот"]
-    if comment in slots_words:
-        return "slots", comment
-    bowling_words = ["боул", "боулинг", "боулпобеда", "боулпоражение", "страйк", "боулпромах"]
-    if comment in bowling_words:
-        return "bowling", comment
-    cube_words = ["чет", "нечет", "больше", "меньше", "плинко", "пл", "сектор1", "сектор 1", "сектор2", "сектор 2", "сектор3", "сектор 3", "с1", "с2", "с3", "1", "2", "3", "4", "5", "6"]
-    if comment in cube_words:
-        return "cube", comment
-    two_dice_words = ["ничья", "победа1", "победа2", "п1", "п2"]
-    if comment in two_dice_words:
-        return "two_dice", comment
-    rps_words = ["камень", "ножницы", "бумага", "к", "н", "б"]
-    if comment in rps_words:
-        return "rock_paper_scissors", comment
-    return None, None
+    """(игра, канонический исход) по комментарию к переводу или (None, None)"""
+    return resolve_bet(comment) or (None, None)
 
 async def process_bet(data: Dict):
     if data.get('id') == LOGS_ID:
@@ -1611,307 +1685,465 @@ async def process_bet(data: Dict):
                 ])
             )
             return
-        await db.add_to_queue(
-            user_id=data['id'],
-            amount=float(data['usd_amount']),
-            game=game_type,
-            bet_type=bet_type
-        )
+        with metrics.span('enqueue'):
+            queue_id = await db.add_to_queue(
+                user_id=data['id'],
+                amount=data['usd_amount'],
+                game=game_type,
+                bet_type=bet_type,
+                name=data['name'],
+                comment=data['comment']
+            )
+        bet_pool.notify()
         
-        # Отправляем подтверждение игроку
+        await admit_bet(queue_id)
+        return queue_id
+
+    except Exception as e:
+        logging.error(f"Error processing bet: {e}")
+
+async def admit_bet(queue_id: int):
+    """Ответ игроку на записанную в очередь ставку: позиция в очереди или возврат сверх лимита игрока"""
+    bet = await db.get_queue_position(queue_id)
+    if not bet:
+        return
+    if bet['user_ahead'] >= BET_USER_LIMIT:
+        if await refund_bet(bet, f"Ставка не принята: в очереди уже {bet['user_ahead']} ваших ставок"):
+            return
+    await send_bet_accepted(bet['user_id'], bet['game'], bet['bet_type'], bet['amount'], bet['position'])
+
+@metrics.timed('notify.ack')
+async def send_bet_accepted(user_id: int, game_type: str, bet_type: str, amount: Money, position: int):
+    """Подтверждение игроку, что ставка в очереди"""
+    text = (
+        f"✅ <b>Ваша ставка принята!</b>\n\n"
+        f"<b>Игра:</b> {GAMES_DATA[game_type]['name']}\n"
+        f"<b>Исход:</b> {GAMES_DATA[game_type]['types'][bet_type]}\n"
+        f"<b>Сумма:</b> <code>{to_str(amount)}$</code>\n"
+        f"<b>Позиция в очереди:</b> <code>{position}</code>"
+    )
+    if bet_pool.overloaded():
+        text += "\n\n⏳ <i>Сейчас много ставок, розыгрыш может задержаться</i>"
+    await bot.send_message(
+        chat_id=user_id,
+        text=text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="👀 Смотреть игру", url=BETS_LINK)]
+            ]),
+        parse_mode="HTML"
+    )
+
+async def process_invoice_payment(payload: str):
+    """Оплаченный инвойс: ставка разыгрывается ровно один раз, сколько бы раз о платеже ни сообщили"""
+    if payload in processed_payloads:
+        return
+    try:
+        # Имя игрока сохранено с инвойсом, так что повторные сообщения об оплате стоят один UPDATE
+        with metrics.span('enqueue'):
+            claimed = await db.claim_invoice_bet(payload)
+        if not claimed:
+            # Оплата пришла после того, как инвойс у нас истёк: ставку не играем, деньги возвращаем
+            expired = await db.claim_expired_invoice_bet(payload)
+            if expired:
+                logging.warning(f"Invoice bet {payload} was paid after it expired, refunding")
+                try:
+                    await send_refund(
+                        {**expired, 'game': expired['game_key'], 'name': expired['name'] or f"User {expired['user_id']}"},
+                        "Счёт оплачен после истечения срока, ставка не принята"
+                    )
+                except Exception as e:
+                    # Инвойс остаётся в 'refunding': повторно не возвращается, разбирается по логу
+                    logging.error(
+                        f"Failed to refund late-paid invoice {payload} "
+                        f"(user {expired['user_id']}, {to_str(expired['amount'])}$): {e}"
+                    )
+                else:
+                    await db.finish_expired_invoice_refund(payload)
+            else:
+                logging.info(f"Invoice bet {payload} was already claimed")
+            processed_payloads.add(payload)
+            return
+        processed_payloads.add(payload)
+        bet_pool.notify()
+        logging.info(f"Invoice bet {payload} queued as {claimed['queue_id']}")
+
+        await admit_bet(claimed['queue_id'])
+    except Exception as e:
+        logging.error(f"Error processing invoice payment {payload}: {e}")
+
+REVEAL_DELAY = 2 # Пауза на анимацию броска перед следующим этапом, сек
+# Ставка, не дошедшая до розыгрыша за это время (бот лежал), при запуске возвращается, а не доигрывается, сек
+BET_REPLAY_WINDOW = int(os.getenv('BET_REPLAY_WINDOW', 900))
+BET_SWEEP_INTERVAL = 60 # Как часто упавшие во время работы ставки возвращаются игрокам, сек
+
+GAME_CLASSES = {
+    'cube': CubeGame,
+    'two_dice': TwoDiceGame,
+    'rock_paper_scissors': RockPaperScissorsGame,
+    'basketball': BasketballGame,
+    'darts': DartsGame,
+    'slots': SlotsGame,
+    'bowling': BowlingGame
+}
+DICE_EMOJIS = {
+    'basketball': '🏀',
+    'darts': '🎯',
+    'slots': '🎰',
+    'bowling': '🎳'
+}
+BOT_RPS_CHOICES = {1: "камень", 2: "ножницы", 3: "бумага"}
+
+def has_second_throw(game_type: str, bet_type: str) -> bool:
+    """Второй бросок: ход бота в КНБ, второй кубик, второй шар в боулинге на победу/поражение"""
+    if game_type in ('rock_paper_scissors', 'two_dice'):
+        return True
+    return game_type == 'bowling' and bet_type in BowlingGame.DUELS
+
+# Этапы розыгрыша ставки из очереди. Каждый этап получает ставку с данными прошлых этапов в bet['state']
+# и возвращает следующий этап с паузой; паузы на анимацию выдерживает пул, а не воркер
+
+@metrics.timed('notify.announce')
+async def bet_accept(bet: Dict):
+    """Объявление ставки в канале"""
+    bet_msg = await bot.send_message(
+        chat_id=BETS_ID,
+        text=f"🎰 /// <b>НОВАЯ СТАВКА</b>\n\n"
+             f"<blockquote><b>Никнейм игрока:</b> {bet['name']}\n\n"
+             f"<b>Сумма ставки:</b> {to_str(bet['amount'])}$\n\n"
+             f"<b>Исход ставки:</b> {bet['comment']}</blockquote>",
+        parse_mode="HTML"
+    )
+    bet['state']['bet_msg_id'] = bet_msg.message_id
+    return 'roll', 0
+
+@metrics.timed('roll')
+async def bet_roll(bet: Dict):
+    """Первый бросок (в КНБ - выбор игрока)"""
+    state = bet['state']
+    game_type = bet['game']
+    game = GAME_CLASSES[game_type](bet['amount'])
+    if game_type == 'rock_paper_scissors':
         await bot.send_message(
-            chat_id=data['id'],
-            text=f"✅ <b>Ваша ставка принята!</b>\n\n"
-                 f"<b>Игра:</b> {GAMES_DATA[game_type]['name']}\n"
-                 f"<b>Исход:</b> {GAMES_DATA[game_type]['types'][bet_type]}\n"
-                 f"<b>Сумма:</b> <code>{data['usd_amount']}$</code>",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="👀 Смотреть игру", url=BETS_LINK)]
-                ]),
-            parse_mode="HTML"
+            chat_id=BETS_ID,
+            text=game.get_emoji(bet['bet_type']),
+            reply_to_message_id=state['bet_msg_id']
         )
-
-        bet_msg = await bot.send_message(
+    else:
+        dice_msg = await bot.send_dice(
+            chat_id=BETS_ID,
+            emoji=DICE_EMOJIS.get(game_type) or game.get_emoji(bet['bet_type']),
+            reply_to_message_id=state['bet_msg_id']
+        )
+        state['dice_value'] = dice_msg.dice.value
+    if has_second_throw(game_type, bet['bet_type']):
+        return 'reveal', REVEAL_DELAY
+    return 'settle', REVEAL_DELAY
+
+@metrics.timed('roll')
+async def bet_reveal(bet: Dict):
+    """Второй бросок (в КНБ - выбор бота)"""
+    state = bet['state']
+    game_type = bet['game']
+    game = GAME_CLASSES[game_type](bet['amount'])
+    if game_type == 'rock_paper_scissors':
+        bot_choice_value = random.randint(1, 3)
+        bot_choice = BOT_RPS_CHOICES.get(bot_choice_value, "камень")
+        await bot.send_message(
             chat_id=BETS_ID,
-            text=f"🎰 /// <b>НОВАЯ СТАВКА</b>\n\n"
-                 f"<blockquote><b>Никнейм игрока:</b> {data['name']}\n\n"
-                 f"<b>Сумма ставки:</b> {data['usd_amount']}$\n\n"
-                 f"<b>Исход ставки:</b> {data['comment']}</blockquote>",
+            text=game.BET_EMOJIS[bot_choice],
+            reply_to_message_id=state['bet_msg_id']
+        )
+        state['dice_value'] = bot_choice_value
+    else:
+        second_dice_msg = await bot.send_dice(
+            chat_id=BETS_ID,
+            emoji=DICE_EMOJIS.get(game_type) or game.get_emoji(bet['bet_type']),
+            reply_to_message_id=state['bet_msg_id']
+        )
+        state['second_dice_value'] = second_dice_msg.dice.value
+    return 'settle', REVEAL_DELAY
+
+async def report_orphaned_check(bet: Dict, amount: Money, check_link: str) -> None:
+    """Чек создан, но не сохранён со ставкой - по нему никто не заплатит, админ должен его удалить"""
+    logging.error(f"Orphaned check for bet {bet['id']}: {check_link}")
+    try:
+        await bot.send_message(
+            chat_id=LOGS_ID,
+            text=f"⚠️ <b>ЧЕК НЕ ПРИВЯЗАН К СТАВКЕ</b>\n\n"
+                 f"<b>Ставка:</b> <code>#{bet['id']}</code>, игрок <code>{bet['user_id']}</code>\n"
+                 f"<b>Сумма:</b> <code>{to_str(amount)}$</code>\n"
+                 f"<b>Чек:</b> {check_link}\n\n"
+                 f"Ставку доигрывает другой воркер со своим чеком - этот чек удалите в @CryptoBot.",
             parse_mode="HTML"
         )
-        game_classes = {
-            'cube': CubeGame,
-            'two_dice': TwoDiceGame,
-            'rock_paper_scissors': RockPaperScissorsGame,
-            'basketball': BasketballGame,
-            'darts': DartsGame,
-            'slots': SlotsGame,
-            'bowling': BowlingGame
-        }
-        game = game_classes[game_type](Decimal(str(data['usd_amount'])))
-        dice_value = None
-        second_dice_value = None
-        if game_type == 'rock_paper_scissors':
-            player_emoji = game.get_emoji(bet_type)
+    except Exception as e:
+        logging.error(f"Failed to report orphaned check of bet {bet['id']}: {e}")
+
+async def bet_settle(bet: Dict):
+    """Итог: чек на выплату, затем журнал, реферальный баланс и статус инвойса одной транзакцией"""
+    state = bet['state']
+    game_type = bet['game']
+    game = GAME_CLASSES[game_type](bet['amount'])
+    with metrics.span('evaluate'):
+        if game_type in ('two_dice', 'bowling'):
+            result = await game.process(bet['bet_type'], state['dice_value'], state.get('second_dice_value'))
+        else:
+            result = await game.process(bet['bet_type'], state['dice_value'])
+    if result.won and not result.draw:
+        outcome = 'win'
+    elif not result.won and not result.draw:
+        outcome = 'lose'
+    else:
+        outcome = 'draw'
+    state['outcome'] = outcome
+    state['win_amount'] = result.amount
+
+    # Чек, созданный до падения, берём из сохранённого этапа, а не создаём второй
+    check_token = state.get('check_token')
+    check_link = state.get('check_link')
+    if outcome != 'lose' and not check_link and not state.get('check_unknown'):
+        check_result = await create_payment_check(result.amount)
+        if check_result and check_result.get('outcome_unknown'):
+            # Чек мог быть создан: при повторе этапа второй не создаём, выплату решит админ
+            state['check_unknown'] = True
+            try:
+                await db.save_bet_state(bet['id'], bet['worker_id'], state)
+            except Exception as e:
+                logging.error(f"Failed to save unknown check outcome of bet {bet['id']}: {e}")
+        elif check_result and 'check_link' in check_result:
+            check_token = str(uuid.uuid4())[:8]
+            check_link = check_result['check_link']
+            state['check_token'] = check_token
+            state['check_link'] = check_link
+            try:
+                saved = await db.save_bet_state(bet['id'], bet['worker_id'], state)
+            except Exception:
+                await report_orphaned_check(bet, result.amount, check_link)
+                raise
+            if not saved:
+                # Ставку перехватил другой воркер: он чека не видит и создаст свой, этот нужно удалить
+                await report_orphaned_check(bet, result.amount, check_link)
+                raise RuntimeError(f"Bet {bet['id']} was reclaimed before its check was saved")
+    state['check_token'] = check_token
+
+    if result.won:
+        ref_change = -scale(result.amount, REF_PERCENT)
+    else:
+        ref_change = scale(bet['amount'], REF_PERCENT)
+    # Реферальный баланс пишется в той же транзакции, поэтому в ledger входит и он
+    with metrics.span('ledger'):
+        settlement = await db.settle_bet(
+            bet,
+            worker_id=bet['worker_id'],
+            outcome=outcome,
+            payout=result.amount,
+            ref_change=ref_change,
+            check_token=check_token,
+            check_link=check_link
+        )
+    state.update(settlement)
+    # settle_bet уже перевёл ставку на этап notify
+    bet['stage'] = 'notify'
+    return 'notify', 0
+
+@metrics.timed('notify')
+async def bet_notify(bet: Dict):
+    """Сообщения об итоге: в канал ставок, в логи при ручной выплате. Реферер получит сводку"""
+    state = bet['state']
+    outcome = state['outcome']
+    win_amount = state['win_amount']
+    check_token = state['check_token']
+
+    if outcome == 'draw' and not check_token:
+        if state.get('check_unknown'):
             await bot.send_message(
-                chat_id=BETS_ID,
-                text=player_emoji,
-                reply_to_message_id=bet_msg.message_id
+                chat_id=LOGS_ID,
+                text=f"⚠️ <b>ВОЗВРАТ НИЧЬЕЙ НЕ ПОДТВЕРЖДЁН</b>\n\n"
+                     f"<b>Ставка:</b> <code>#{bet['id']}</code>, игрок <code>{bet['user_id']}</code>\n"
+                     f"<b>Сумма:</b> <code>{fmt(win_amount)}$</code>"
+                     + CHECK_UNKNOWN_NOTE,
+                parse_mode="HTML"
             )
-            await asyncio.sleep(2)
-            bot_choice_value = random.randint(1, 3)
-            bot_choices = {1: "камень", 2: "ножницы", 3: "бумага"}
-            bot_choice = bot_choices.get(bot_choice_value, "камень")
-            bot_emoji = game.BET_EMOJIS[bot_choice]
+        return None
+
+    rows = []
+    if check_token:
+        claim_text = f"💸 Забрать {fmt(win_amount)}$" if outcome == 'win' else f"Забрать {fmt(win_amount)}$"
+        rows.append([InlineKeyboardButton(text=claim_text, url=f"https://t.me/{(await bot.get_me()).username}?start={check_token}")])
+    elif outcome == 'win':
+        rows.append([InlineKeyboardButton(text=f"Техподдержка", url=SUPPORT_LINK)])
+    if state['show_instruction']:
+        rows.append([InlineKeyboardButton(text="💬 Сделать ставку", url=GIDE_LINK)])
+    rows.append([InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")])
+
+    if outcome == 'win' and check_token:
+        photo = "win.jpg"
+        message_text = (
+            f"<b>🍀 Поздравляем, вы победили!</b>\n\n"
+            f"<blockquote>• <b>Удача на вашей стороне, вы выиграли {fmt(win_amount)}$!</b>\n"
+            f"• <b>Забрать выигрыш можно по кнопке ниже</b></blockquote>\n\n"
+            f"<b>{await links()}</b>"
+        )
+    elif outcome == 'win':
+        photo = "win.jpg"
+        message_text = (
+            f"<b>🍀 Поздравляем, вы победили!</b>\n\n"
+            f"<blockquote>• <b>Удача на вашей стороне, выигрыш в размере {fmt(win_amount)}$ будет зачислен вручную администрацией!</b></blockquote>\n\n"
+            f"<b>{await links()}</b>"
+        )
+    elif outcome == 'lose':
+        photo = "lose.jpg"
+        message_text = (
+            f"<b>🚫 К сожалению, вы проиграли...</b>\n\n"
+            f"<blockquote>• <b>В этот раз удача проскакала мимо вас, но не стоит расстраиваться! 99% игроков останавливаются перед кнрупны выигрышем!</b></blockquote>\n\n"
+            f"<b>{await links()}</b>"
+        )
+    else:
+        photo = "draw.jpg"
+        message_text = (
+            f"<b>❎ Ничья </b>\n\n"
+            f"<blockquote>• <b>Ничья — возврат ставки {fmt(win_amount)}$!</b></blockquote>\n\n"
+            f"<b>{await links()}</b>"
+        )
+    await bot.send_photo(
+        chat_id=BETS_ID,
+        photo=types.FSInputFile(photo),
+        caption=message_text,
+        parse_mode="HTML",
+        reply_to_message_id=state['bet_msg_id'],
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
+    )
+
+    if outcome == 'win' and not check_token:
+        await bot.send_message(
+            chat_id=LOGS_ID,
+            text=f"⚠️ <b>ТРЕБУЕТСЯ РУЧНАЯ ВЫПЛАТА</b>\n\n"
+                 f"<b>Игрок:</b> <code>{bet['name']}</code>\n"
+                 f"<b>ID:</b> <code>{bet['user_id']}</code>\n"
+                 f"<b>Сумма выигрыша:</b> <code>{fmt(win_amount)}$</code>\n"
+                 f"<b>Тип ставки:</b> <code>{bet['comment']}</code>\n"
+                 f"<b>Сумма ставки:</b> <code>{to_str(bet['amount'])}$</code>\n"
+                 f"<b>Тип игры:</b> <code>{bet['game']}</code>"
+                 + (CHECK_UNKNOWN_NOTE if state.get('check_unknown') else ""),
+            parse_mode="HTML"
+        )
+    return None
+
+BET_STAGES = {
+    'accept': bet_accept,
+    'roll': bet_roll,
+    'reveal': bet_reveal,
+    'settle': bet_settle,
+    'notify': bet_notify,
+}
+
+async def refund_bet(bet: Dict, reason: str = "Ставка не была разыграна из-за технического сбоя") -> bool:
+    """Возврат ставки, которую не доиграть или не принять: чек на сумму ставки или ручная выплата.
+    False, если ставку уже взяли в работу"""
+    if not await db.start_refund(bet['id'], bet['status']):
+        return False
+    await send_refund(bet, reason)
+    await db.finish_refund(bet['id'], bet['payload'])
+    return True
+
+async def send_refund(bet: Dict, reason: str) -> None:
+    """Чек на сумму ставки игроку; если чек не создать - сообщение админам о ручном возврате"""
+    check_result = await create_payment_check(bet['amount'])
+    if check_result and 'check_link' in check_result:
+        check_token = str(uuid.uuid4())[:8]
+        await db.save_win_check_token(
+            token=check_token,
+            user_id=bet['user_id'],
+            amount=bet['amount'],
+            check_link=check_result['check_link']
+        )
+        try:
             await bot.send_message(
-                chat_id=BETS_ID,
-                text=bot_emoji,
-                reply_to_message_id=bet_msg.message_id
-            )
-            dice_value = bot_choice_value
-        elif game_type in ['basketball', 'darts', 'slots', 'bowling']:
-            emoji_map = {
-                'basketball': '🏀',
-                'darts': '🎯',
-                'slots': '🎰',
-                'bowling': '🎳'
-            }
-            dice_msg = await bot.send_dice(
-                chat_id=BETS_ID,
-                emoji=emoji_map[game_type],
-                reply_to_message_id=bet_msg.message_id
-            )
-            dice_value = dice_msg.dice.value
-            if game_type == 'bowling' and any(x in bet_type for x in ["боулпобеда", "боулпоражение", "боулингпобеда", "боулингпоражение", "победа", "поражение"]):
-                await asyncio.sleep(2)
-                second_dice_msg = await bot.send_dice(
-                    chat_id=BETS_ID,
-                    emoji='🎳',
-                    reply_to_message_id=bet_msg.message_id
-                )
-                second_dice_value = second_dice_msg.dice.value
-        else:
-            dice_msg = await bot.send_dice(
-                chat_id=BETS_ID,
-                emoji=game.get_emoji(bet_type) if hasattr(game, 'get_emoji') else game.EMOJI,
-                reply_to_message_id=bet_msg.message_id
+                chat_id=bet['user_id'],
+                text=f"↩️ <b>{reason}</b>\n\n"
+                     f"<blockquote>• <b>Возвращаем {fmt(bet['amount'])}$ - забрать можно по кнопке ниже</b></blockquote>",
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text=f"Забрать {fmt(bet['amount'])}$", url=f"https://t.me/{(await bot.get_me()).username}?start={check_token}")]
+                ])
             )
-            dice_value = dice_msg.dice.value
-            if game_type == 'two_dice':
-                await asyncio.sleep(2)
-                second_dice_msg = await bot.send_dice(
-                    chat_id=BETS_ID,
-                    emoji=game.get_emoji(bet_type) if hasattr(game, 'get_emoji') else game.EMOJI,
-                    reply_to_message_id=bet_msg.message_id
-                )
-                second_dice_value = second_dice_msg.dice.value
-        if game_type == 'two_dice' or (game_type == 'bowling' and 'second_dice_value' in locals()):
-            result = await game.process(bet_type, dice_value, locals().get('second_dice_value'))
-        else:
-            result = await game.process(bet_type, dice_value)
-        await asyncio.sleep(2)
-        await db.add_transaction(
-            user_id=data['id'],
-            amount=-float(data['usd_amount']),
-            type='game',
-            game_type=game_type
+        except Exception as e:
+            logging.error(f"Failed to notify user {bet['user_id']} about refund: {e}")
+    else:
+        await bot.send_message(
+            chat_id=LOGS_ID,
+            text=f"⚠️ <b>ТРЕБУЕТСЯ РУЧНОЙ ВОЗВРАТ</b>\n\n"
+                 f"<b>Игрок:</b> <code>{bet['name']}</code>\n"
+                 f"<b>ID:</b> <code>{bet['user_id']}</code>\n"
+                 f"<b>Сумма ставки:</b> <code>{to_str(bet['amount'])}$</code>\n"
+                 f"<b>Тип игры:</b> <code>{bet['game']}</code>\n"
+                 + (f"<b>Инвойс:</b> <code>{bet['payload']}</code>\n" if bet.get('payload') else "")
+                 + f"<b>Причина:</b> {reason}"
+                 + (CHECK_UNKNOWN_NOTE if check_result and check_result.get('outcome_unknown') else ""),
+            parse_mode="HTML"
         )
-        referrer_id = await db.get_referrer(data['id'])
-        if referrer_id:
-            if result.won:
-                ref_penalty = float(result.amount) * 0.15
-                await db.update_ref_balance(referrer_id, -ref_penalty)
-                await bot.send_message(
-                    chat_id=referrer_id,
-                    text=f"💸 С вашего Реф.Баланса списано <code>{ref_penalty:.2f}$</code> из-за выигрыша <code>{data['name']}</code>",
-                    parse_mode="HTML"
-                )
-            else:
-                ref_reward = float(data['usd_amount']) * 0.15
-                await db.update_ref_balance(referrer_id, ref_reward)
-                await bot.send_message(
-                    chat_id=referrer_id,
-                    text=f"💵 Ваш Реф.Баланс пополнен на <code>{ref_reward:.2f}$</code> из-за проигрыша <code>{data['name']}</code>",
-                    parse_mode="HTML"
-                )
-        if result.won and result.draw == False:
-            win_amount = float(result.amount)
-            check_result = await create_payment_check(win_amount)
-            if check_result and 'check_link' in check_result:
-                check_token = str(uuid.uuid4())[:8]
-                await db.save_win_check_token(
-                    token=check_token,
-                    user_id=data['id'],
-                    amount=win_amount,
-                    check_link=check_result['check_link'] # Передаем check_link
-                )
-                message_text = (
-                    f"<b>🍀 Поздравляем, вы победили!</b>\n\n"
-                    f"<blockquote>• <b>Удача на вашей стороне, вы выиграли {result.amount:.2f}$!</b>\n"
-                    f"• <b>Забрать выигрыш можно по кнопке ниже</b></blockquote>\n\n"
-                    f"<b>{await links()}</b>"
-                )
-                if not await db.has_seen_instruction(user_id):
-                    await db.mark_instruction_seen(user_id)
-                    await bot.send_photo(
-                        chat_id=BETS_ID,
-                        photo=types.FSInputFile("win.jpg"),
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_to_message_id=bet_msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text=f"💸 Забрать {win_amount:.2f}$", url=f"https://t.me/{(await bot.get_me()).username}?start={check_token}")],
-                            [InlineKeyboardButton(text="💬 Сделать ставку", url=GIDE_LINK)],
-                            [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                        ])
-                    )
-                else:
-                    await bot.send_photo(
-                        chat_id=BETS_ID,
-                        photo=types.FSInputFile("win.jpg"),
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_to_message_id=bet_msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text=f"💸 Забрать {win_amount:.2f}$", url=f"https://t.me/{(await bot.get_me()).username}?start={check_token}")],
-                            [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                        ])
-                    )
-            else:
-                message_text = (
-                    f"<b>🍀 Поздравляем, вы победили!</b>\n\n"
-                    f"<blockquote>• <b>Удача на вашей стороне, выигрыш в размере {result.amount:.2f}$ будет зачислен вручную администрацией!</b></blockquote>\n\n"
-                    f"<b>{await links()}</b>"
-                )
-                if not await db.has_seen_instruction(user_id):
-                    await db.mark_instruction_seen(user_id)
-                    await bot.send_photo(
-                        chat_id=BETS_ID,
-                        photo=types.FSInputFile("win.jpg"),
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_to_message_id=bet_msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text=f"Техподдержка", url=SUPPORT_LINK)],
-                            [InlineKeyboardButton(text="💬 Сделать ставку", url=GIDE_LINK)],
-                            [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                        ])
-                    )
-                else:
-                    await bot.send_photo(
-                        chat_id=BETS_ID,
-                        photo=types.FSInputFile("win.jpg"),
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_to_message_id=bet_msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text=f"Техподдержка", url=SUPPORT_LINK)],
-                            [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                        ])
-                    )
-                await bot.send_message(
-                    chat_id=LOGS_ID,
-                    text=f"⚠️ <b>ТРЕБУЕТСЯ РУЧНАЯ ВЫПЛАТА</b>\n\n"
-                         f"<b>Игрок:</b> <code>{data['name']}</code>\n"
-                         f"<b>ID:</b> <code>{data['id']}</code>\n"
-                         f"<b>Сумма выигрыша:</b> <code>{result.amount:.2f}$</code>\n"
-                         f"<b>Тип ставки:</b> <code>{data['comment']}</code>\n"
-                         f"<b>Сумма ставки:</b> <code>{data['usd_amount']}$</code>\n"
-                         f"<b>Тип игры:</b> <code>{game_type}</code>",
-                    parse_mode="HTML"
-                )
 
-            # Записываем выигрыш как отдельную транзакцию
-            await db.add_transaction(
-                user_id=data['id'],
-                amount=win_amount, # Положительная сумма выигрыша
-                type='game',
-                game_type=game_type
-            )
-        elif result.won == False and result.draw == False:
-            message_text = (
-                f"<b>🚫 К сожалению, вы проиграли...</b>\n\n"
-                f"<blockquote>• <b>В этот раз удача проскакала мимо вас, но не стоит расстраиваться! 99% игроков останавливаются перед кнрупны выигрышем!</b></blockquote>\n\n"
-                f"<b>{await links()}</b>"
-            )
-            if not await db.has_seen_instruction(user_id):
-                await db.mark_instruction_seen(user_id)
-                await bot.send_photo(
-                    chat_id=BETS_ID,
-                    photo=types.FSInputFile("lose.jpg"),
-                    caption=message_text,
-                    parse_mode="HTML",
-                    reply_to_message_id=bet_msg.message_id,
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="💬 Сделать ставку", url=GIDE_LINK)],
-                        [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                    ])
-                )
-            else:
-                await bot.send_photo(
-                chat_id=BETS_ID,
-                    photo=types.FSInputFile("lose.jpg"),
-                    caption=message_text,
-                    parse_mode="HTML",
-                    reply_to_message_id=bet_msg.message_id,
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                    ])
-                )
-        else:
-            win_amount = float(result.amount)
-            check_result = await create_payment_check(win_amount)
-            if check_result and 'check_link' in check_result:
-                check_token = str(uuid.uuid4())[:8]
-                await db.save_win_check_token(
-                    token=check_token,
-                    user_id=data['id'],
-                    amount=win_amount,
-                    check_link=check_result['check_link']
-                )
+async def resolve_failed_bets(enqueued_before: float = 0):
+    """Упавшие ставки: нерассчитанные до settle возвращаются, расчёт повторяется, пока не кончились попытки,
+    а исчерпавшие попытки расчёта уходят админам. С enqueued_before возвращаются и зависшие дольше окна.
+    Возвращает (повторено расчётов, возвращено ставок)"""
+    requeued = await db.requeue_failed_settlements()
+    if requeued:
+        bet_pool.notify()
+    held = await db.hold_failed_settlements()
+    if held:
+        await bot.send_message(
+            chat_id=LOGS_ID,
+            text="⚠️ <b>Расчёт ставок не удался после всех попыток, проверьте вручную:</b>\n" + "\n".join(
+                f"• #{bet['id']} <code>{bet['user_id']}</code> {to_str(bet['amount'])}$ {bet['game']}" for bet in held
+            ),
+            parse_mode="HTML"
+        )
+    refunds = await db.get_bets_to_refund(enqueued_before)
+    for bet in refunds:
+        try:
+            await refund_bet(bet)
+        except Exception as e:
+            logging.error(f"Failed to refund bet {bet['id']}: {e}")
+    return requeued, len(refunds)
 
-                message_text = (
-                    f"<b>❎ Ничья </b>\n\n"
-                    f"<blockquote>• <b>Ничья — возврат ставки {result.amount:.2f}$!</b></blockquote>\n\n"
-                    f"<b>{await links()}</b>"
-                )
-                if not await db.has_seen_instruction(user_id):
-                    await db.mark_instruction_seen(user_id)
-                    await bot.send_photo(
-                        chat_id=BETS_ID,
-                        photo=types.FSInputFile("draw.jpg"),
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_to_message_id=bet_msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text=f"Забрать {win_amount:.2f}$", url=f"https://t.me/{(await bot.get_me()).username}?start={check_token}")],
-                            [InlineKeyboardButton(text="💬 Сделать ставку", url=GIDE_LINK)],
-                            [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                        ])
-                    )
-                else:
-                    await bot.send_photo(
-                        chat_id=BETS_ID,
-                        photo=types.FSInputFile("draw.jpg"),
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_to_message_id=bet_msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text=f"Забрать {win_amount:.2f}$", url=f"https://t.me/{(await bot.get_me()).username}?start={check_token}")],
-                            [InlineKeyboardButton(text='🤖 Cделать ставку', url="https://t.me/BunnyCasinoRobot?start=games")]
-
-                        ])
-                    )
+async def sweep_failed_bets_periodically():
+    """Ставки, упавшие во время работы, не ждут перезапуска: раз в BET_SWEEP_INTERVAL сек они возвращаются игрокам"""
+    while True:
+        await asyncio.sleep(BET_SWEEP_INTERVAL)
+        try:
+            requeued, refunded = await resolve_failed_bets()
+            if requeued or refunded:
+                logging.info(f"Failed bets sweep: {requeued} settlements retried, {refunded} refunded")
+        except Exception as e:
+            logging.error(f"Failed bets sweep failed: {e}", exc_info=True)
+
+async def recover_bets():
+    """Разбор очереди после перезапуска, до начала приёма новых ставок.
 
+    Ставки прошлого запуска продолжаются с последнего сохранённого этапа; рассчитанные (этап notify)
+    только досылают сообщения. Ставки, упавшие или зависшие до розыгрыша, возвращаются.
+    """
+    try:
+        released = await db.release_worker_bets(bet_pool.name)
+        requeued, refunded = await resolve_failed_bets(time.time() - BET_REPLAY_WINDOW)
+        interrupted = await db.get_refunding_bets()
+        logging.info(f"Bet recovery: {released} resumed, {requeued} settlements retried, {refunded} refunded")
+
+        if released or requeued or refunded or interrupted:
+            text = (
+                f"♻️ <b>Восстановление очереди ставок</b>\n\n"
+                f"• Продолжено: <code>{released}</code>\n"
+                f"• Повтор расчёта: <code>{requeued}</code>\n"
+                f"• Возвращено: <code>{refunded}</code>"
+            )
+            if interrupted:
+                text += "\n\n⚠️ <b>Прерванные возвраты, проверьте вручную:</b>\n" + "\n".join(
+                    f"• #{bet['id']} <code>{bet['user_id']}</code> {to_str(bet['amount'])}$" for bet in interrupted
+                )
+            await bot.send_message(chat_id=LOGS_ID, text=text, parse_mode="HTML")
     except Exception as e:
-        logging.error(f"Error processing bet: {e}")
+        logging.error(f"Bet recovery failed: {e}", exc_info=True)
 
 async def main():
     await bot.set_my_commands([
@@ -1924,13 +2156,36 @@ async def main():
     ])
 
     await db.init()
+    await crypto_pay.start()
+    await treasury.start()
+    warmed = await processed_payloads.warm(db)
+    logging.info(f"Payload registry warmed with {warmed} invoices")
+    await recover_bets()
+    if webhook is not None:
+        await webhook.start(process_invoice_payment)
 
     cmds = await bot.get_my_commands()
     print("🔧 Установленные команды:", cmds)
     
     asyncio.create_task(check_invoices_periodically()) # Запуск фоновой задачи
+    asyncio.create_task(send_ref_digests_periodically())
+    asyncio.create_task(sweep_failed_bets_periodically())
+    bet_pool.start(BET_STAGES)
     
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if webhook is not None:
+            await webhook.stop()
+        await bet_pool.stop()
+        # Сводка по ставкам этого запуска, не дожидаясь следующего окна
+        try:
+            await flush_ref_digests()
+        except Exception as e:
+            logging.error(f"Error sending referral digests on shutdown: {e}")
+        await treasury.stop()
+        await crypto_pay.close()
+        await db.close()
 
 
 @dp.callback_query(lambda c: c.data == "withdraw_ref_balance")
@@ -1940,10 +2195,10 @@ async def withdraw_ref_balance(callback_query: types.CallbackQuery):
     ref_balance = user.get('ref_balance', 0)
     
 
-    min_withdraw = 1
+    min_withdraw = to_units(1)
     
     if ref_balance < min_withdraw:
-        await callback_query.answer(f"Минимальная сумма для вывода: {min_withdraw}$", show_alert=True)
+        await callback_query.answer(f"Минимальная сумма для вывода: {to_str(min_withdraw)}$", show_alert=True)
         return
     
 
@@ -1955,7 +2210,7 @@ async def withdraw_ref_balance(callback_query: types.CallbackQuery):
 
     await db.add_transaction(
         user_id=user_id,
-        amount=-float(ref_balance),
+        amount=-ref_balance,
         type='withdraw',
         game_type='ref_balance'
     )
@@ -1964,7 +2219,7 @@ async def withdraw_ref_balance(callback_query: types.CallbackQuery):
     await bot.send_message(
         chat_id=user_id,
         text=f"<b>Запрос на вывод реф.баланса создан</b>\n\n"
-             f"<blockquote>• <b>Сумма к выводу:</b> <code>{ref_balance:.2f}$</code>\n"
+             f"<blockquote>• <b>Сумма к выводу:</b> <code>{fmt(ref_balance)}$</code>\n"
              f"• <b>Дата запроса:</b> <code>{time.strftime('%d.%m.%Y %H:%M')}</code>\n"
              f"• <b>Статус:</b> <code>В обработке</code></blockquote>\n\n"
              f"<b>Ваш токен:</b>\n"
@@ -1982,7 +2237,7 @@ async def withdraw_ref_balance(callback_query: types.CallbackQuery):
         text=f"<b>ЗАПРОС НА ВЫВОД РЕФ.БАЛАНСА</b>\n\n"
              f"<blockquote>• <b>Пользователь:</b> {callback_query.from_user.mention_html()}\n"
              f"• <b>ID:</b> <code>{user_id}</code>\n"
-             f"• <b>Сумма:</b> <code>{ref_balance:.2f}$</code>\n"
+             f"• <b>Сумма:</b> <code>{fmt(ref_balance)}$</code>\n"
              f"• <b>Дата запроса:</b> <code>{time.strftime('%d.%m.%Y %H:%M')}</code></blockquote>\n\n"
              f"<b>Токен для выплаты:</b>\n"
              f"<code>{withdraw_token}</code>",
@@ -1998,52 +2253,96 @@ async def log_all_messages(message: types.Message):
     logging.info(f"From: {message.from_user.id} in chat: {message.chat.id}")
     logging.info(f"Entities: {message.entities}")
 
+async def poll_invoices() -> int:
+    """Один проход по неоплаченным инвойсам: статусы запрашиваются по их invoice_id, пачками.
+    Возвращает число запросов к API"""
+    pending = await db.get_pending_invoice_bets()
+    bound = [bet for bet in pending if bet['invoice_id']]
+    requests = 0
+    for i in range(0, len(bound), INVOICE_IDS_PER_REQUEST):
+        by_id = {bet['invoice_id']: bet['payload'] for bet in bound[i:i + INVOICE_IDS_PER_REQUEST]}
+        invoices_data = await crypto_pay.get_invoices(invoice_ids=list(by_id), count=len(by_id))
+        requests += 1
+        for invoice in invoices_data.get('result', {}).get('items', []):
+            payload = by_id.get(invoice.get('invoice_id'))
+            if not payload:
+                continue
+            if invoice.get('status') == 'paid':
+                logging.info(f"Found new paid invoice: {invoice['invoice_id']} with payload {payload}. Processing...")
+                await process_invoice_payment(payload)
+            elif invoice.get('status') == 'expired':
+                await db.expire_invoice_bet(payload)
+
+    # Инвойсы без invoice_id (созданные до его сохранения) ищем по-старому, среди последних оплаченных
+    if len(bound) < len(pending):
+        invoices_data = await crypto_pay.get_invoices(status="paid", count=100)
+        requests += 1
+        for invoice in invoices_data.get('result', {}).get('items', []):
+            payload = invoice.get('payload')
+            if payload and payload not in processed_payloads:
+                await process_invoice_payment(payload)
+    return requests
+
 async def check_invoices_periodically():
+    """Опрос неоплаченных инвойсов. Пока их нет - раз в INVOICE_POLL_MAX сек или сразу после создания
+    нового. Пока есть - каждые INVOICE_POLL_MIN сек на каждый запрос прохода, так что нагрузка на API
+    не растёт с числом инвойсов, а пачка оплат больше любой страницы не теряется.
+    С приёмником обновлений - раз в INVOICE_RECONCILE_INTERVAL сек, для оплат, о которых не сообщили"""
     while True:
+        # Сбрасываем до прохода: инвойс, созданный во время прохода, снова взведёт событие
+        invoice_poll_wakeup.clear()
+        interval = INVOICE_POLL_MAX
         try:
-            logging.info("Checking for paid invoices...")
-            invoices_data = await crypto_pay.get_invoices(status="paid", count=100) # Проверяем последние 100 оплаченных инвойсов
-            invoices = invoices_data.get('result', {}).get('items', []) # Обновлено для правильной структуры ответа
-
-            for invoice in invoices:
-                payload = invoice.get('payload')
-                status = invoice.get('status')
-                invoice_id = invoice.get('invoice_id') # Используем invoice_id для уникальности
-
-                if payload and status == 'paid': # Проверяем только оплаченные инвойсы с payload
-                    # Проверяем, был ли этот инвойс уже обработан
-                    bet_data_from_db = await db.get_invoice_bet(payload)
-                    
-                    if bet_data_from_db and bet_data_from_db['status'] == 'pending': # Проверяем, что инвойс есть в нашей БД и он еще не обработан
-                        logging.info(f"Found new paid invoice: {invoice_id} with payload {payload}. Processing...")
-                        
-                        user_info = None
-                        try:
-                            user_info = await bot.get_chat(bet_data_from_db['user_id'])
-                            user_name = user_info.full_name if user_info else f"User {bet_data_from_db['user_id']}"
-                        except Exception:
-                            user_name = f"User {bet_data_from_db['user_id']}"
-
-                        data_for_process_bet = {
-                            'id': bet_data_from_db['user_id'],
-                            'name': user_name,
-                            'usd_amount': bet_data_from_db['amount'],
-                            'comment': bet_data_from_db['bet_type_key'],
-                            'game': bet_data_from_db['game_key']
-                        }
-                        await process_bet(data_for_process_bet)
-                        await db.mark_invoice_bet_paid(payload)
-                        logging.info(f"Invoice bet {invoice_id} processed and marked as paid.")
-                    elif bet_data_from_db and bet_data_from_db['status'] == 'paid':
-                        pass
-                    else:
-                       
-                        pass 
-
+            # Запас после срока: оплату, сделанную в последний момент, успеваем увидеть
+            expired = await db.expire_invoice_bets(time.time() - INVOICE_EXPIRE_GRACE)
+            if expired:
+                logging.info(f"Expired {expired} unpaid invoices")
+            requests = await poll_invoices()
+            if webhook is not None:
+                interval = INVOICE_RECONCILE_INTERVAL
+            elif requests:
+                interval = min(INVOICE_POLL_MIN * requests, INVOICE_POLL_MAX)
+        except CryptoPayUnavailable as e:
+            logging.warning(f"Skipping invoice check: {e}")
         except Exception as e:
             logging.error(f"Error checking invoices periodically: {e}", exc_info=True)
 
-        await asyncio.sleep(10) # Проверять каждые 10 секунд
+        try:
+            await asyncio.wait_for(invoice_poll_wakeup.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def flush_ref_digests():
+    """Одна сводка на реферера за окно вместо сообщения на каждую ставку реферала.
+    События удаляются только после отправки, так что недоставленные уйдут в следующей сводке"""
+    for digest in await db.get_ref_digests(time.time()):
+        net = digest['net']
+        text = (
+            f"📊 <b>Сводка по Реф.Балансу</b>\n\n"
+            f"<blockquote>• Изменение: <code>{'+' if net >= 0 else '-'}{fmt(abs(net))}$</code>\n"
+            f"• Пополнено за проигрыши рефералов: <code>{fmt(digest['credited'])}$</code>\n"
+            f"• Списано за выигрыши рефералов: <code>{fmt(digest['debited'])}$</code>\n"
+            f"• Ставок: <code>{digest['bets']}</code></blockquote>"
+        )
+        try:
+            with metrics.span('referral.digest'):
+                await bot.send_message(chat_id=digest['referrer_id'], text=text, parse_mode="HTML")
+        except aiogram.exceptions.TelegramForbiddenError:
+            pass # Реферер заблокировал бота - сводку не доставить
+        except Exception as e:
+            logging.error(f"Failed to send referral digest to {digest['referrer_id']}: {e}")
+            continue
+        await db.delete_ref_events(digest['referrer_id'], digest['last_id'])
+        await asyncio.sleep(0.05)
+
+async def send_ref_digests_periodically():
+    """Первая сводка - сразу при запуске: в ней события, не отправленные прошлым запуском"""
+    while True:
+        try:
+            await flush_ref_digests()
+        except Exception as e:
+            logging.error(f"Error sending referral digests: {e}", exc_info=True)
+        await asyncio.sleep(REF_DIGEST_INTERVAL)
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
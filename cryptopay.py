@@ -1,27 +1,218 @@
 import aiohttp
-from decimal import Decimal
+import asyncio
+import os
+import random
+import time
 from typing import Optional, Dict, List
 import logging
+from money import Money, to_str, to_units
+from metrics import Metrics
+
+# Метод API -> (таймаут, сек; число повторов). Повтор transfer безопасен: API не переводит дважды
+# по одному spend_id. createCheck и createInvoice повторяются, только если запрос точно не дошёл до API
+ENDPOINTS = {
+    "getBalance": (5.0, 2),
+    "getExchangeRates": (5.0, 2),
+    "getInvoices": (10.0, 2),
+    "getChecks": (10.0, 2),
+    "transfer": (15.0, 3),
+    "createCheck": (15.0, 2),
+    "createInvoice": (10.0, 2),
+}
+NOT_IDEMPOTENT = {"createCheck", "createInvoice"}
+
+
+class CryptoPayUnavailable(Exception):
+    """Запрос не выполнен: API не отвечает, повторы исчерпаны или предохранитель разомкнут"""
+
+
+class CryptoPayOutcomeUnknown(CryptoPayUnavailable):
+    """Запрос ушёл в API, но ответ потерян: createCheck/createInvoice мог выполниться"""
+
+
+class _ServerError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+class CircuitBreaker:
+    """Предохранитель: после threshold ошибок подряд запросы отклоняются сразу, без обращения к API.
+    Через reset_timeout секунд пропускается один пробный запрос; удачный замыкает предохранитель."""
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        """closed - запросы идут, open - отклоняются, half_open - ждём пробный запрос"""
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def retry_in(self) -> float:
+        """Через сколько секунд будет пробный запрос"""
+        if self._opened_at is None:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'half_open':
+            # Пробный запрос один на окно: следующий - не раньше чем через reset_timeout,
+            # даже если этот так и не завершится
+            self._opened_at = time.monotonic()
+        return state != 'open'
+
+    def success(self) -> None:
+        self.failures = 0
+        self._opened_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self._opened_at is None and self.failures >= self.threshold:
+            self.trips += 1
+            logging.error(f"Crypto Pay circuit breaker opened after {self.failures} failures")
+        if self._opened_at is not None or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+
 
 class CryptoPayAPI:
-    def __init__(self, api_token: str, testnet: bool = False):
+    """Клиент Crypto Pay API.
+
+    Все запросы идут через одну сессию с пулом keep-alive соединений, поэтому TLS-рукопожатие
+    делается один раз на соединение, а не на каждый запрос. Сессия создаётся при первом запросе
+    (или в start()) и закрывается в close(). base_url можно подменить, например, локальным сервером.
+
+    У каждого метода свой таймаут и число повторов (ENDPOINTS); повторы идут с экспоненциальной
+    паузой со случайным разбросом. Сетевые ошибки, таймауты и 5xx считает предохранитель (breaker);
+    когда он разомкнут, запросы сразу завершаются CryptoPayUnavailable.
+    """
+
+    def __init__(
+        self,
+        api_token: str,
+        testnet: bool = False,
+        base_url: Optional[str] = None,
+        connections: int = 10,
+        keepalive: float = 60.0,
+        dns_ttl: int = 300,
+        timeout: float = 30.0,
+        backoff: float = 0.5,
+        backoff_cap: float = 5.0,
+        breaker: Optional[CircuitBreaker] = None
+    ):
         self.api_token = api_token
-        self.base_url = "https://testnet-pay.crypt.bot/api" if testnet else "https://pay.crypt.bot/api"
+        self.base_url = base_url or ("https://testnet-pay.crypt.bot/api" if testnet else "https://pay.crypt.bot/api")
         self.headers = {"Crypto-Pay-API-Token": api_token}
+        self.connections = connections
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Новые соединения (рукопожатия) и запросы по уже открытым
+        self.handshakes = 0
+        self.reused = 0
+        # Задержка по методам API
+        self.metrics = Metrics()
 
-    async def _make_request(self, method: str, endpoint: str, **kwargs) -> Dict:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                method,
-                f"{self.base_url}/{endpoint}",
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_connection_created)
+            trace.on_connection_reuseconn.append(self._on_connection_reused)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connections,
+                    keepalive_timeout=self.keepalive,
+                    ttl_dns_cache=self.dns_ttl
+                ),
                 headers=self.headers,
-                **kwargs
-            ) as response:
-                return await response.json()
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace]
+            )
+        return self._session
+
+    async def _on_connection_created(self, session, context, params) -> None:
+        self.handshakes += 1
+
+    async def _on_connection_reused(self, session, context, params) -> None:
+        self.reused += 1
+
+    async def start(self) -> None:
+        """Открывает сессию заранее, чтобы первый запрос не ждал её создания"""
+        self._get_session()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> Dict:
+        """Число соединений и запросов, задержка по методам (см. Metrics.snapshot)"""
+        return {
+            'handshakes': self.handshakes,
+            'reused': self.reused,
+            'requests': self.handshakes + self.reused,
+            'retries': self.retries,
+            'breaker': {
+                'state': self.breaker.state,
+                'failures': self.breaker.failures,
+                'trips': self.breaker.trips,
+                'retry_in': self.breaker.retry_in(),
+            },
+            'endpoints': self.metrics.snapshot(),
+        }
+
+    async def _make_request(self, method: str, endpoint: str, **kwargs) -> Dict:
+        """Ответ API (в том числе с ok=false). Бросает CryptoPayUnavailable, если ответа получить не удалось,
+        и CryptoPayOutcomeUnknown, если неидемпотентный запрос мог выполниться"""
+        timeout, retries = ENDPOINTS.get(endpoint, (self.timeout, 0))
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CryptoPayUnavailable(f"{endpoint}: circuit breaker is open")
+            try:
+                with self.metrics.span(endpoint):
+                    async with self._get_session().request(
+                        method,
+                        f"{self.base_url}/{endpoint}",
+                        timeout=aiohttp.ClientTimeout(total=timeout),
+                        **kwargs
+                    ) as response:
+                        if response.status >= 500:
+                            raise _ServerError(response.status)
+                        data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, _ServerError) as e:
+                self.breaker.failure()
+                # Соединение не установлено - запрос до API не дошёл, повторять можно любой метод
+                not_sent = isinstance(e, aiohttp.ClientConnectorError)
+                if endpoint in NOT_IDEMPOTENT and not not_sent:
+                    raise CryptoPayOutcomeUnknown(f"{endpoint} outcome unknown after {attempt + 1} attempts: {e!r}") from e
+                if attempt >= retries:
+                    raise CryptoPayUnavailable(f"{endpoint} failed after {attempt + 1} attempts: {e!r}") from e
+                attempt += 1
+                self.retries += 1
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** attempt))
+                logging.warning(f"Crypto Pay {endpoint} failed ({e!r}), retry {attempt}/{retries} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.success()
+            return data
 
     async def create_invoice(
         self,
-        amount: str,
+        amount: Money,
         asset: str = "USDT",
         description: Optional[str] = None,
         hidden_message: Optional[str] = None,
@@ -34,7 +225,7 @@ class CryptoPayAPI:
     ) -> Dict:
         data = {
             "asset": asset,
-            "amount": amount,
+            "amount": to_str(amount),
             "description": description,
             "hidden_message": hidden_message,
             "paid_btn_name": paid_btn_name,
@@ -50,7 +241,7 @@ class CryptoPayAPI:
         self,
         user_id: int,
         asset: str,
-        amount: str,
+        amount: Money,
         spend_id: str,
         comment: Optional[str] = None,
         disable_send_notification: bool = False
@@ -58,7 +249,7 @@ class CryptoPayAPI:
         data = {
             "user_id": user_id,
             "asset": asset,
-            "amount": amount,
+            "amount": to_str(amount),
             "spend_id": spend_id,
             "comment": comment,
             "disable_send_notification": disable_send_notification
@@ -67,7 +258,7 @@ class CryptoPayAPI:
 
     async def create_check(
         self,
-        amount: str,
+        amount: Money,
         asset: str = "USDT",
         description: Optional[str] = None,
         hidden_message: Optional[str] = None,
@@ -76,7 +267,7 @@ class CryptoPayAPI:
     ) -> Dict:
         data = {
             "asset": asset,
-            "amount": amount,
+            "amount": to_str(amount),
             "description": description,
             "hidden_message": hidden_message,
             "payload": payload,
@@ -86,45 +277,51 @@ class CryptoPayAPI:
 
     async def get_balance(self) -> Dict:
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.base_url}/getBalance"
-                logging.info(f"Requesting balance from: {url}")
-                
-                async with session.get(
-                    url,
-                    headers=self.headers
-                ) as response:
-                    status = response.status
-                    logging.info(f"Balance API response status: {status}")
-                    
-                    if status == 200:
-                        data = await response.json()
-                        logging.info(f"Raw balance response: {data}")
-                        
-                        if isinstance(data, dict) and 'result' in data:
-                            for balance in data.get('result', []):
-                                logging.info(f"Found currency: {balance.get('currency')}, available: {balance.get('available')}")
-                            return data
-                    else:
-                        response_text = await response.text()
-                        logging.error(f"API error status {status}: {response_text}")
-                    
-                    return {'result': []}
+            logging.info(f"Requesting balance from: {self.base_url}/getBalance")
+            data = await self._make_request("GET", "getBalance")
+            logging.info(f"Raw balance response: {data}")
+
+            if isinstance(data, dict) and 'result' in data:
+                for balance in data.get('result', []):
+                    logging.info(f"Found currency: {balance.get('currency')}, available: {balance.get('available')}")
+                return data
+            logging.error(f"API error: {data}")
+            return {'result': []}
         except Exception as e:
             logging.error(f"CryptoPay API error: {e}")
             return {'result': []}
 
+    async def get_asset_balance(self, asset: str = "USDT") -> Money:
+        """Доступный баланс актива в целых единицах (см. money.py).
+        В отличие от get_balance, ошибку API не прячет: бросает CryptoPayUnavailable"""
+        balance_data = await self._make_request("GET", "getBalance")
+        if not balance_data.get('ok'):
+            raise CryptoPayUnavailable(f"getBalance: {balance_data.get('error')}")
+        for balance in balance_data.get('result', []):
+            currency = balance.get('currency_code', '')
+            if currency and currency.upper() == asset:
+                return to_units(balance.get('available', '0'))
+        return 0
+
     async def get_exchange_rates(self) -> List[Dict]:
         response = await self._make_request("GET", "getExchangeRates")
         return response.get("result", [])
 
-    async def get_invoices(self, status: str = None, offset: int = 0, count: int = 100) -> Dict:
+    async def get_invoices(
+        self,
+        status: str = None,
+        offset: int = 0,
+        count: int = 100,
+        invoice_ids: Optional[List[int]] = None
+    ) -> Dict:
         params = {
             "offset": offset,
             "count": count
         }
         if status:
             params["status"] = status
+        if invoice_ids:
+            params["invoice_ids"] = ",".join(str(invoice_id) for invoice_id in invoice_ids)
         return await self._make_request("GET", "getInvoices", params=params)
 
     async def get_checks(self, status: str = None, asset: str = None) -> Dict:
@@ -134,4 +331,48 @@ class CryptoPayAPI:
             params["status"] = status
         if asset:
             params["asset"] = asset
-        return await self._make_request("GET", "getChecks", params=params) 
\ No newline at end of file
+        return await self._make_request("GET", "getChecks", params=params)
+
+
+async def _benchmark(requests: int, base_url: Optional[str] = None) -> Dict:
+    """Задержка и число рукопожатий на серии запросов. Без base_url поднимает локальную заглушку API"""
+    from aiohttp import web
+    import socket
+
+    runner = None
+    if not base_url:
+        async def handler(request: web.Request) -> web.Response:
+            return web.json_response({'ok': True, 'result': []})
+
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(runner, sock).start()
+        base_url = f"http://127.0.0.1:{sock.getsockname()[1]}/api"
+
+    api = CryptoPayAPI(os.getenv('CRYPTO_PAY_TOKEN', 'test'), base_url=base_url)
+    try:
+        await api.start()
+        for _ in range(requests):
+            await api.get_balance()
+        return api.stats()
+    finally:
+        await api.close()
+        if runner:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    # python cryptopay.py [--requests N] [--base-url URL] — печатает задержку по методам и число рукопожатий
+    import argparse
+    import asyncio
+    import json
+
+    parser = argparse.ArgumentParser(description="Замер задержки запросов к Crypto Pay API и переиспользования соединений")
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--base-url', help="API или его заглушка; по умолчанию поднимается локальная заглушка")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(_benchmark(args.requests, args.base_url)), indent=2))
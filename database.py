@@ -1,138 +1,575 @@
 import aiosqlite
-import os
-from decimal import Decimal
-from typing import Optional, List, Dict
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional, List, Dict, AsyncIterator, Any, Awaitable, Callable, Tuple
+from collections import OrderedDict
 from datetime import datetime
 import time
+import json
 import logging
-from cryptopay import CryptoPayAPI
+from money import Money
+
+# Применяются к каждому соединению пула один раз при открытии
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Пересчёт проекции user_stats из журнала транзакций (миграция 4 и rebuild_user_stats)
+USER_STATS_BACKFILL = """
+    INSERT INTO user_stats (user_id, total_games, wins, losses, turnover, total_won, total_lost)
+    SELECT
+        user_id,
+        COUNT(*),
+        SUM(CASE WHEN amount > 0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN amount <= 0 THEN 1 ELSE 0 END),
+        COALESCE(SUM(ABS(amount)), 0),
+        SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+        SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END)
+    FROM transactions
+    WHERE type = 'game'
+    GROUP BY user_id
+"""
+
+# Итоговая строка daily_rollups за всё время; сортируется раньше любой даты
+ALL_TIME = "0000-00-00"
+# game_type строк daily_rollups с суммами обработанных выводов
+WITHDRAWALS_ROLLUP = "withdrawal"
+
+# Пересчёт daily_rollups из transactions и withdrawals (миграция 5 и rebuild_daily_rollups)
+DAILY_ROLLUPS_BACKFILL = [
+    """
+    INSERT INTO daily_rollups (day, game_type, games, wins, losses, draws, spent, earned, turnover)
+    SELECT
+        date(created_at),
+        game_type,
+        COUNT(*),
+        SUM(CASE WHEN amount > 0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN amount < 0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN amount = 0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+        SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END),
+        COALESCE(SUM(ABS(amount)), 0)
+    FROM transactions
+    WHERE type = 'game' AND game_type IS NOT NULL AND game_type NOT LIKE '%_cashback'
+    GROUP BY date(created_at), game_type
+    """,
+    f"""
+    INSERT INTO daily_rollups (day, game_type, withdrawals)
+    SELECT date(created_at), '{WITHDRAWALS_ROLLUP}', SUM(amount)
+    FROM withdrawals
+    WHERE status = 'processed'
+    GROUP BY date(created_at)
+    """,
+    f"""
+    INSERT INTO daily_rollups (day, game_type, games, wins, losses, draws, spent, earned, turnover, withdrawals)
+    SELECT '{ALL_TIME}', game_type, SUM(games), SUM(wins), SUM(losses), SUM(draws), SUM(spent), SUM(earned), SUM(turnover), SUM(withdrawals)
+    FROM daily_rollups
+    GROUP BY game_type
+    """,
+]
+
+# Миграции схемы: (версия, список SQL). Текущая версия хранится в PRAGMA user_version,
+# init() применяет недостающие по порядку, каждую в своей транзакции.
+MIGRATIONS = [
+    # 1: исходная схема
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            balance DECIMAL(10, 2) DEFAULT 0.0,
+            ref_balance DECIMAL(10, 2) DEFAULT 0.0,
+            ref_earnings DECIMAL(10, 2) DEFAULT 0.0,
+            ref_count INTEGER DEFAULT 0,
+            referrer_id INTEGER,
+            seen_instruction INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount DECIMAL(10, 2),
+            type TEXT,
+            game_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount DECIMAL(10, 2),
+            game TEXT,
+            bet_type TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount DECIMAL(10, 2),
+            network TEXT,
+            address TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount DECIMAL(10, 2),
+            game_type TEXT,
+            message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed INTEGER DEFAULT 0,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS win_check_tokens (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER,
+            amount DECIMAL(10, 2),
+            used INTEGER DEFAULT 0,
+            check_link TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS invoice_bets (
+            payload TEXT PRIMARY KEY,
+            user_id INTEGER,
+            game_key TEXT,
+            bet_type_key TEXT,
+            amount DECIMAL(10, 2),
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+    ]),
+    # 2: индексы под горячие запросы
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created ON transactions(user_id, type, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_queue_status_created ON queue(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_status_created ON withdrawals(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_user_created ON withdrawals(user_id, created_at)",
+    ]),
+    # 3: суммы из DECIMAL/REAL в целые микро-USDT (см. money.py). Тип столбцов не меняем:
+    # у DECIMAL числовое сродство, и целые значения SQLite хранит как INTEGER.
+    (3, [
+        f"UPDATE {table} SET {column} = CAST(ROUND({column} * 1000000) AS INTEGER) WHERE {column} IS NOT NULL"
+        for table, column in (
+            ("users", "balance"),
+            ("users", "ref_balance"),
+            ("users", "ref_earnings"),
+            ("transactions", "amount"),
+            ("queue", "amount"),
+            ("withdrawals", "amount"),
+            ("bets", "amount"),
+            ("win_check_tokens", "amount"),
+            ("invoice_bets", "amount"),
+        )
+    ]),
+    # 4: проекция статистики игрока, обновляется вместе с add_transaction
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            total_games INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0,
+            turnover INTEGER NOT NULL DEFAULT 0,
+            total_won INTEGER NOT NULL DEFAULT 0,
+            total_lost INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        USER_STATS_BACKFILL,
+    ]),
+    # 5: дневные агрегаты для админ-статистики и индекс по дате регистрации
+    (5, [
+        """
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day TEXT NOT NULL,
+            game_type TEXT NOT NULL,
+            games INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0,
+            draws INTEGER NOT NULL DEFAULT 0,
+            spent INTEGER NOT NULL DEFAULT 0,
+            earned INTEGER NOT NULL DEFAULT 0,
+            turnover INTEGER NOT NULL DEFAULT 0,
+            withdrawals INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, game_type)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)",
+        *DAILY_ROLLUPS_BACKFILL,
+    ]),
+    # 6: ref_count ведётся при регистрации/удалении реферала; пересчитываем накопленное
+    (6, [
+        """
+        UPDATE users SET ref_count = (
+            SELECT COUNT(*) FROM users AS r WHERE r.referrer_id = users.user_id
+        )
+        """,
+    ]),
+    # 7: поиск по username: триграммный FTS5-индекс, rowid = user_id
+    (7, [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username, tokenize='trigram')",
+        "DELETE FROM users_fts",
+        """
+        INSERT INTO users_fts (rowid, username)
+        SELECT user_id, username FROM users WHERE username IS NOT NULL
+        """,
+    ]),
+    # 8: очередь ставок разбирают воркеры: ставке нужны имя игрока, исходный комментарий и отметки времени.
+    # Старые 'pending' строки уже были разыграны обработчиком сообщения и в очередь не попадают
+    (8, [
+        "ALTER TABLE queue ADD COLUMN name TEXT",
+        "ALTER TABLE queue ADD COLUMN comment TEXT",
+        "ALTER TABLE queue ADD COLUMN enqueued_at REAL",
+        "ALTER TABLE queue ADD COLUMN started_at REAL",
+        "ALTER TABLE queue ADD COLUMN finished_at REAL",
+        "UPDATE queue SET status = 'done' WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_queue_user_status ON queue(user_id, status)",
+    ]),
+    # 9: захват ставки воркером с арендой: кто держит ставку и до какого времени.
+    # Ставки, оставшиеся в 'processing' после падения, сразу считаются просроченными
+    (9, [
+        "ALTER TABLE queue ADD COLUMN worker_id TEXT",
+        "ALTER TABLE queue ADD COLUMN lease_until REAL",
+        "ALTER TABLE queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "UPDATE queue SET lease_until = 0 WHERE status = 'processing'",
+    ]),
+    # 10: розыгрыш по этапам: текущий этап, его данные (JSON) и время, раньше которого этап не берётся
+    (10, [
+        "ALTER TABLE queue ADD COLUMN stage TEXT",
+        "ALTER TABLE queue ADD COLUMN state TEXT",
+        "ALTER TABLE queue ADD COLUMN due_at REAL",
+    ]),
+    # 11: ставка по инвойсу помнит свой payload: статус инвойса закрывается вместе с расчётом ставки
+    (11, [
+        "ALTER TABLE queue ADD COLUMN payload TEXT",
+    ]),
+    # 12: изменения реф.баланса копятся до сводки рефереру; попавшие в отправленную сводку удаляются
+    (12, [
+        """
+        CREATE TABLE IF NOT EXISTS ref_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ref_events_referrer ON ref_events(referrer_id, id)",
+    ]),
+    # 13: игры получают канонический исход (games.BET_SPEC): недоигранные ставки с алиасом из комментария переписываем
+    (13, [
+        """
+        WITH aliases(alias, bet_type) AS (VALUES
+            ('пл', 'плинко'), ('с1', 'сектор1'), ('с2', 'сектор2'), ('с3', 'сектор3'),
+            ('п1', 'победа1'), ('п2', 'победа2'),
+            ('к', 'камень'), ('н', 'ножницы'), ('б', 'бумага'),
+            ('казик', 'слоты'), ('777', 'слоты'), ('джекпот', 'слоты'),
+            ('боул', 'боулинг')
+        )
+        UPDATE queue
+        SET bet_type = (SELECT a.bet_type FROM aliases a WHERE a.alias = queue.bet_type)
+        WHERE status IN ('pending', 'processing')
+          AND bet_type IN (SELECT alias FROM aliases)
+        """,
+    ]),
+    # 14: статус инвойса опрашивается по его invoice_id; неоплаченный инвойс после expires_at истекает.
+    # У ожидающих инвойсов до миграции invoice_id нет, срок - час от создания, как у счёта в Crypto Pay
+    (14, [
+        "ALTER TABLE invoice_bets ADD COLUMN invoice_id INTEGER",
+        "ALTER TABLE invoice_bets ADD COLUMN expires_at REAL",
+        "UPDATE invoice_bets SET expires_at = CAST(strftime('%s', created_at) AS REAL) + 3600 WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_invoice_bets_status_expires ON invoice_bets(status, expires_at)",
+    ]),
+    # 15: имя игрока запоминается при создании инвойса - оплату ставят в очередь без запроса к Telegram.
+    # Индекс по created_at - для загрузки последних обработанных payload'ов при запуске
+    (15, [
+        "ALTER TABLE invoice_bets ADD COLUMN name TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_invoice_bets_created ON invoice_bets(created_at)",
+    ]),
+]
+
+# Ставка, аренда которой истекала столько раз, больше не перезапускается
+MAX_BET_ATTEMPTS = 3
+
+# Длина самого длинного user_id, до которой расширяется поиск по префиксу ID
+MAX_USER_ID_DIGITS = 16
+SEARCH_LIMIT = 50
+
+USER_LIST_SELECT = """
+    SELECT u.*, r.username AS referrer_username
+    FROM users u
+    LEFT JOIN users r ON r.user_id = u.referrer_id
+"""
+
+class UserCache:
+    """LRU-кэш строк users с TTL. Пишущие методы Database сбрасывают записи после коммита."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Растёт при каждой инвалидации: чтение, начатое до неё, не кладёт в кэш устаревшую строку
+        self.generation = 0
+        self._rows: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        entry = self._rows.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._rows[user_id]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        return dict(entry[1])
+
+    def put(self, user_id: int, row: Dict, generation: int) -> None:
+        if generation != self.generation:
+            return
+        self._rows[user_id] = (time.monotonic() + self.ttl, dict(row))
+        self._rows.move_to_end(user_id)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self.generation += 1
+        self._rows.pop(user_id, None)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._rows),
+            'hit_rate': (self.hits / total * 100) if total else 0,
+        }
+
+# Отложенная запись: выполняется внутри общей транзакции группового коммита
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
 
 class Database:
-    def __init__(self, db_path: str = "bunny.casino"):
+    def __init__(
+        self,
+        db_path: str = "bunny.casino",
+        readers: int = 4,
+        commit_window: float = 0.005,
+        max_batch: int = 256,
+        user_cache_size: int = 10000,
+        user_cache_ttl: float = 60.0
+    ):
         self.db_path = db_path
+        self.readers = readers
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._reader_pool: asyncio.Queue = asyncio.Queue()
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._write_queue: asyncio.Queue = asyncio.Queue()
+        self._flusher: Optional[asyncio.Task] = None
+        self._user_cache = UserCache(user_cache_size, user_cache_ttl)
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    @asynccontextmanager
+    async def _read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Берёт читающее соединение из пула на время запроса"""
+        conn = await self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Единственное пишущее соединение: одна транзакция, один commit"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
 
     async def init(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    balance DECIMAL(10, 2) DEFAULT 0.0,
-                    ref_balance DECIMAL(10, 2) DEFAULT 0.0,
-                    ref_earnings DECIMAL(10, 2) DEFAULT 0.0,
-                    ref_count INTEGER DEFAULT 0,
-                    referrer_id INTEGER,
-                    seen_instruction INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (referrer_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    amount DECIMAL(10, 2),
-                    type TEXT,
-                    game_type TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS queue (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    amount DECIMAL(10, 2),
-                    game TEXT,
-                    bet_type TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS withdrawals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    amount DECIMAL(10, 2),
-                    network TEXT,
-                    address TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS bets (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    amount DECIMAL(10, 2),
-                    game_type TEXT,
-                    message_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed INTEGER DEFAULT 0,
-                    processed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS win_check_tokens (
-                    token TEXT PRIMARY KEY,
-                    user_id INTEGER,
-                    amount DECIMAL(10, 2),
-                    used INTEGER DEFAULT 0,
-                    check_link TEXT
-                )
-            """)
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS invoice_bets (
-                    payload TEXT PRIMARY KEY,
-                    user_id INTEGER,
-                    game_key TEXT,
-                    bet_type_key TEXT,
-                    amount DECIMAL(10, 2),
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            await db.commit()
+        if self._writer is None:
+            self._writer = await self._connect()
+            for _ in range(self.readers):
+                conn = await self._connect(readonly=True)
+                self._reader_conns.append(conn)
+                self._reader_pool.put_nowait(conn)
+
+        await self.migrate()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _submit(self, op: WriteOp) -> Any:
+        """Ставит запись в очередь группового коммита и ждёт, пока она будет зафиксирована"""
+        if self._flusher is None or self._flusher.done():
+            async with self._write() as db:
+                return await op(db)
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((op, future))
+        return await future
+
+    async def flush(self) -> None:
+        """Дожидается фиксации всех поставленных на данный момент записей"""
+        async def noop(db: aiosqlite.Connection):
+            return None
+        await self._submit(noop)
+
+    async def _flush_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            item = await self._write_queue.get()
+            if item is None:
+                break
+            # Даём соседним записям несколько миллисекунд, чтобы попасть в тот же коммит
+            await asyncio.sleep(self.commit_window)
+            batch = [item]
+            while len(batch) < self.max_batch and not self._write_queue.empty():
+                item = self._write_queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch: List[Tuple[WriteOp, asyncio.Future]]) -> None:
+        results = []
+        try:
+            async with self._write() as db:
+                # IMMEDIATE: блокировка записи берётся сразу, и другой процесс ждёт busy_timeout,
+                # а не получает SQLITE_BUSY при повышении читающей транзакции
+                await db.execute("BEGIN IMMEDIATE")
+                for op, future in batch:
+                    # Ошибка одной записи откатывает только её savepoint, а не весь коммит
+                    await db.execute("SAVEPOINT write_op")
+                    try:
+                        result = await op(db)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO write_op")
+                        await db.execute("RELEASE write_op")
+                        results.append((future, None, e))
+                    else:
+                        await db.execute("RELEASE write_op")
+                        results.append((future, result, None))
+        except Exception as e:
+            logging.error(f"Group commit of {len(batch)} writes failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def migrate(self) -> int:
+        """Доводит схему до последней версии из MIGRATIONS, возвращает итоговую версию"""
+        async with self._write() as db:
+            async with db.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            logging.info(f"Applying schema migration {target}")
+            async with self._write() as db:
+                await db.execute("BEGIN")
+                for statement in statements:
+                    await db.execute(statement)
+                await db.execute(f"PRAGMA user_version = {target}")
+            version = target
+        return version
+
+    async def close(self) -> None:
+        """Сбрасывает очередь записи и закрывает пул соединений (вызывается при остановке бота)"""
+        if self._writer is None:
+            return
+        if self._flusher is not None:
+            self._write_queue.put_nowait(None)
+            await self._flusher
+            self._flusher = None
+        while not self._reader_pool.empty():
+            self._reader_pool.get_nowait()
+        for conn in self._reader_conns:
+            await conn.close()
+        self._reader_conns = []
+        async with self._write_lock:
+            await self._writer.close()
+            self._writer = None
+
+    def cache_stats(self) -> Dict:
+        """Счётчики попаданий/промахов кэша пользователей"""
+        return self._user_cache.stats()
 
     async def get_user(self, user_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            return user
+        generation = self._user_cache.generation
+        async with self._read() as db:
             async with db.execute(
                 "SELECT * FROM users WHERE user_id = ?", 
                 (user_id,)
             ) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-                return None
+        if row:
+            user = dict(row)
+            self._user_cache.put(user_id, user, generation)
+            return user
+        return None
     
     async def has_seen_instruction(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT seen_instruction FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                row = await cursor.fetchone()
-                return bool(row[0]) if row else False
+        user = await self.get_user(user_id)
+        return bool(user['seen_instruction']) if user else False
 
     async def mark_instruction_seen(self, user_id: int) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET seen_instruction = 1 WHERE user_id = ?", (user_id,))
-            await db.commit()
-
+        self._user_cache.invalidate(user_id)
 
     async def create_user(self, user_id: int, username: str, referrer_id: Optional[int] = None) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+        async with self._write() as db:
+            cursor = await db.execute(
                 """
                 INSERT OR IGNORE INTO users 
                 (user_id, username, referrer_id) 
@@ -140,89 +577,500 @@ class Database:
                 """,
                 (user_id, username, referrer_id)
             )
-            await db.commit()
+            created = cursor.rowcount == 1
+            if created:
+                await self._index_username(db, user_id, username)
+            if created and referrer_id:
+                await db.execute(
+                    "UPDATE users SET ref_count = ref_count + 1 WHERE user_id = ?",
+                    (referrer_id,)
+                )
+        self._user_cache.invalidate(user_id)
+        if created and referrer_id:
+            self._user_cache.invalidate(referrer_id)
 
-    async def update_balance(self, user_id: int, amount: Decimal) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def update_balance(self, user_id: int, amount: Money) -> bool:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE users SET balance = balance + ? WHERE user_id = ?",
-                (float(amount), user_id)
+                (amount, user_id)
             )
-            await db.commit()
-            return True
-
-    async def update_ref_balance(self, user_id: int, amount: Decimal) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT COUNT(*) FROM users WHERE referrer_id = ?",
-                (user_id,)
-            ) as cursor:
-                ref_count = (await cursor.fetchone())[0]
+        self._user_cache.invalidate(user_id)
+        return True
 
+    async def update_ref_balance(self, user_id: int, amount: Money) -> bool:
+        async with self._write() as db:
             await db.execute(
                 """
                 UPDATE users 
                 SET ref_balance = ref_balance + ?,
-                    ref_earnings = ref_earnings + ?,
-                    ref_count = ?
+                    ref_earnings = ref_earnings + ?
                 WHERE user_id = ?
                 """,
-                (float(amount), float(amount), ref_count, user_id)
+                (amount, amount, user_id)
             )
-            await db.commit()
-            return True
+        self._user_cache.invalidate(user_id)
+        return True
 
-    async def get_referrer(self, user_id: int) -> Optional[int]:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def apply_referral_change(self, referrer_id: int, user_id: int, amount: Money) -> None:
+        """Изменение реф.баланса из-за игры реферала user_id; реферер узнает о нём из сводки"""
+        async def op(db: aiosqlite.Connection):
+            await self._record_ref_change(db, referrer_id, user_id, amount)
+        await self._submit(op)
+        self._user_cache.invalidate(referrer_id)
+
+    async def _record_ref_change(
+        self,
+        db: aiosqlite.Connection,
+        referrer_id: int,
+        user_id: int,
+        amount: Money
+    ) -> None:
+        """Реф.баланс вместе с событием для сводки"""
+        await db.execute(
+            """
+            UPDATE users
+            SET ref_balance = ref_balance + ?,
+                ref_earnings = ref_earnings + ?
+            WHERE user_id = ?
+            """,
+            (amount, amount, referrer_id)
+        )
+        await db.execute(
+            "INSERT INTO ref_events (referrer_id, user_id, amount, created_at) VALUES (?, ?, ?, ?)",
+            (referrer_id, user_id, amount, time.time())
+        )
+
+    async def get_ref_digests(self, until: float) -> List[Dict]:
+        """Неотправленные события реф.баланса до until, сгруппированные по рефереру:
+        чистое изменение, начисления, списания, число ставок и id последнего события"""
+        async with self._read() as db:
             async with db.execute(
-                "SELECT referrer_id FROM users WHERE user_id = ?",
-                (user_id,)
+                """
+                SELECT referrer_id,
+                    SUM(amount) AS net,
+                    COALESCE(SUM(amount) FILTER (WHERE amount > 0), 0) AS credited,
+                    COALESCE(-SUM(amount) FILTER (WHERE amount < 0), 0) AS debited,
+                    COUNT(*) AS bets,
+                    MAX(id) AS last_id
+                FROM ref_events
+                WHERE created_at <= ?
+                GROUP BY referrer_id
+                """,
+                (until,)
             ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row and row[0] else None
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def delete_ref_events(self, referrer_id: int, last_id: int) -> int:
+        """Удаляет события, вошедшие в отправленную сводку"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                "DELETE FROM ref_events WHERE referrer_id = ? AND id <= ?",
+                (referrer_id, last_id)
+            )
+            return cursor.rowcount
+        return await self._submit(op)
+
+    async def get_referrer(self, user_id: int) -> Optional[int]:
+        user = await self.get_user(user_id)
+        return user['referrer_id'] if user and user['referrer_id'] else None
 
     async def add_to_queue(
         self,
         user_id: int,
-        amount: Decimal,
+        amount: Money,
         game: str,
-        bet_type: str
+        bet_type: str,
+        name: Optional[str] = None,
+        comment: Optional[str] = None
     ) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async def op(db: aiosqlite.Connection):
             cursor = await db.execute(
                 """
                 INSERT INTO queue 
-                (user_id, amount, game, bet_type) 
-                VALUES (?, ?, ?, ?)
+                (user_id, amount, game, bet_type, name, comment, enqueued_at) 
+                VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (user_id, float(amount), game, bet_type)
+                (user_id, amount, game, bet_type, name, comment, time.time())
             )
-            await db.commit()
             return cursor.lastrowid
+        return await self._submit(op)
 
-    async def get_next_bet(self) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+    async def get_queue_position(self, queue_id: int) -> Optional[Dict]:
+        """Ставка из очереди с её позицией среди неначатых ставок (position, с 1) и числом
+        незавершённых ставок того же игрока перед ней (user_ahead)"""
+        async with self._read() as db:
             async with db.execute(
                 """
-                SELECT * FROM queue 
-                WHERE status = 'pending' 
-                ORDER BY created_at ASC 
-                LIMIT 1
-                """
+                SELECT q.*,
+                    (SELECT COUNT(*) FROM queue p
+                     WHERE p.status = 'pending' AND p.stage IS NULL AND p.id <= q.id) AS position,
+                    (SELECT COUNT(*) FROM queue u
+                     WHERE u.user_id = q.user_id AND u.status IN ('pending', 'processing') AND u.id < q.id) AS user_ahead
+                FROM queue q
+                WHERE q.id = ?
+                """,
+                (queue_id,)
             ) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
+    async def claim_bet(
+        self,
+        worker_id: str,
+        lease: float = 30.0,
+        max_in_flight: Optional[int] = None
+    ) -> Optional[Dict]:
+        """Атомарно берёт ставку в аренду на lease секунд.
+
+        Берётся самая старая ставка, первая среди незавершённых ставок своего игрока: ожидающая
+        или с истёкшей арендой. Пока ставка игрока в работе у любого воркера любого процесса,
+        его следующие ставки не выдаются.
+
+        max_in_flight ограничивает число начатых и не доигранных ставок (в работе или в паузе между
+        этапами). Пока лимит выбран, новые ставки ждут в очереди, начатые продолжаются.
+        """
+        async def op(db: aiosqlite.Connection):
+            now = time.time()
+            await db.execute(
+                """
+                UPDATE queue SET status = 'failed', finished_at = ?
+                WHERE status = 'processing' AND lease_until < ? AND attempts >= ?
+                """,
+                (now, now, MAX_BET_ATTEMPTS)
+            )
+            async with db.execute(
+                """
+                UPDATE queue
+                SET status = 'processing',
+                    worker_id = :worker_id,
+                    lease_until = :now + :lease,
+                    started_at = COALESCE(started_at, :now),
+                    attempts = attempts + 1
+                WHERE id = (
+                    SELECT q.id FROM queue q
+                    WHERE ((q.status = 'pending' AND (q.due_at IS NULL OR q.due_at <= :now))
+                           OR (q.status = 'processing' AND q.lease_until < :now))
+                      AND (q.stage IS NOT NULL OR :max_in_flight IS NULL OR (
+                          SELECT COUNT(*) FROM queue s
+                          WHERE s.status = 'processing' OR (s.status = 'pending' AND s.stage IS NOT NULL)
+                      ) < :max_in_flight)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM queue p
+                          WHERE p.user_id = q.user_id
+                            AND p.status IN ('pending', 'processing')
+                            AND p.id < q.id
+                      )
+                    ORDER BY q.created_at ASC, q.id ASC
+                    LIMIT 1
+                )
+                RETURNING *
+                """,
+                {'worker_id': worker_id, 'now': now, 'lease': lease, 'max_in_flight': max_in_flight}
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            bet = dict(row)
+            bet['state'] = json.loads(bet['state']) if bet['state'] else {}
+            return bet
+        return await self._submit(op)
+
+    async def advance_bet(
+        self,
+        queue_id: int,
+        worker_id: str,
+        stage: str,
+        state: Dict,
+        delay: float = 0,
+        lease: float = 30.0
+    ) -> bool:
+        """Сохраняет следующий этап ставки.
+
+        Без задержки воркер продолжает держать ставку. С задержкой ставка возвращается в очередь
+        и станет доступна через delay секунд - воркер тем временем свободен для других ставок.
+        """
+        async def op(db: aiosqlite.Connection):
+            now = time.time()
+            if delay > 0:
+                cursor = await db.execute(
+                    """
+                    UPDATE queue
+                    SET stage = ?, state = ?, due_at = ?, status = 'pending',
+                        worker_id = NULL, lease_until = NULL, attempts = 0
+                    WHERE id = ? AND worker_id = ? AND status = 'processing'
+                    """,
+                    (stage, json.dumps(state), now + delay, queue_id, worker_id)
+                )
+            else:
+                cursor = await db.execute(
+                    """
+                    UPDATE queue
+                    SET stage = ?, state = ?, due_at = NULL, lease_until = ?, attempts = 0
+                    WHERE id = ? AND worker_id = ? AND status = 'processing'
+                    """,
+                    (stage, json.dumps(state), now + lease, queue_id, worker_id)
+                )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def save_bet_state(self, queue_id: int, worker_id: str, state: Dict) -> bool:
+        """Сохраняет данные текущего этапа, не трогая этап и счётчик попыток; False - ставку перехватили"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET state = ?
+                WHERE id = ? AND worker_id = ? AND status = 'processing'
+                """,
+                (json.dumps(state), queue_id, worker_id)
+            )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def extend_lease(self, queue_id: int, worker_id: str, lease: float = 30.0) -> bool:
+        """Продлевает аренду; False - ставку уже перехватил другой воркер"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET lease_until = ?
+                WHERE id = ? AND worker_id = ? AND status = 'processing'
+                """,
+                (time.time() + lease, queue_id, worker_id)
+            )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def finish_bet(self, queue_id: int, worker_id: str, status: str = 'done') -> bool:
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET status = ?, finished_at = ?, lease_until = NULL
+                WHERE id = ? AND worker_id = ? AND status = 'processing'
+                """,
+                (status, time.time(), queue_id, worker_id)
+            )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def settle_bet(
+        self,
+        bet: Dict,
+        worker_id: str,
+        outcome: str,
+        payout: Money,
+        ref_change: Money,
+        check_token: Optional[str] = None,
+        check_link: Optional[str] = None,
+        next_stage: str = 'notify',
+        lease: float = 30.0
+    ) -> Dict:
+        """Расчёт ставки одной транзакцией.
+
+        Журнал (ставка и выигрыш), реферальный баланс, токен чека, отметка инструкции, статус инвойса
+        и переход ставки на следующий этап фиксируются вместе. Если ставку уже рассчитали или её
+        перехватил другой воркер, ничего не пишется и бросается RuntimeError.
+        ref_change - изменение реферального баланса, если у игрока есть реферер.
+        Возвращает referrer_id, ref_change и show_instruction для сообщений об итоге.
+        """
+        user_id = bet['user_id']
+        state = bet['state']
+
+        async def op(db: aiosqlite.Connection):
+            await self._record_transaction(db, user_id, -bet['amount'], 'game', bet['game'])
+            if outcome == 'win':
+                await self._record_transaction(db, user_id, payout, 'game', bet['game'])
+
+            async with db.execute(
+                "SELECT referrer_id, seen_instruction FROM users WHERE user_id = ?",
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            referrer_id = row['referrer_id'] if row else None
+            if referrer_id:
+                await self._record_ref_change(db, referrer_id, user_id, ref_change)
+
+            if check_token:
+                await db.execute(
+                    "INSERT OR REPLACE INTO win_check_tokens (token, user_id, amount, used, check_link) VALUES (?, ?, ?, 0, ?)",
+                    (check_token, user_id, payout, check_link)
+                )
+
+            # Инструкцию показываем с первым итогом, у которого есть сообщение (ничья без чека его не получает)
+            show_instruction = False
+            if row and not row['seen_instruction'] and (outcome != 'draw' or check_token):
+                await db.execute("UPDATE users SET seen_instruction = 1 WHERE user_id = ?", (user_id,))
+                show_instruction = True
+
+            if bet.get('payload'):
+                await db.execute(
+                    "UPDATE invoice_bets SET status = 'paid' WHERE payload = ?",
+                    (bet['payload'],)
+                )
+            settlement = {
+                'referrer_id': referrer_id,
+                'ref_change': ref_change if referrer_id else 0,
+                'show_instruction': show_instruction,
+            }
+
+            # Переход на следующий этап последним: если ставка уже не наша, savepoint откатит весь расчёт
+            cursor = await db.execute(
+                """
+                UPDATE queue SET stage = ?, state = ?, lease_until = ?, attempts = 0
+                WHERE id = ? AND worker_id = ? AND status = 'processing' AND stage = 'settle'
+                """,
+                (next_stage, json.dumps({**state, **settlement}), time.time() + lease, bet['id'], worker_id)
+            )
+            if cursor.rowcount != 1:
+                raise RuntimeError(f"Bet {bet['id']} is not held by {worker_id} at settle stage")
+            return settlement
+
+        settlement = await self._submit(op)
+        self._user_cache.invalidate(user_id)
+        if settlement['referrer_id']:
+            self._user_cache.invalidate(settlement['referrer_id'])
+        return settlement
+
+    async def release_worker_bets(self, worker_name: str) -> int:
+        """Возвращает в очередь ставки, которые держал прошлый запуск этого же воркера (worker_id 'name:N').
+
+        Они продолжатся с сохранённого этапа сразу, не дожидаясь истечения аренды.
+        """
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET status = 'pending', worker_id = NULL, lease_until = NULL
+                WHERE status = 'processing' AND substr(worker_id, 1, ?) = ?
+                """,
+                (len(worker_name) + 1, worker_name + ':')
+            )
+            return cursor.rowcount
+        return await self._submit(op)
+
+    async def retry_bet(self, queue_id: int, worker_id: str, delay: float) -> bool:
+        """Возвращает упавшую ставку в очередь: сохранённый этап повторится через delay секунд.
+        Число попыток сохраняется, claim_bet продолжит его считать"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET status = 'pending', due_at = ?, worker_id = NULL, lease_until = NULL
+                WHERE id = ? AND worker_id = ? AND status = 'processing'
+                """,
+                (time.time() + delay, queue_id, worker_id)
+            )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def requeue_failed_settlements(self) -> int:
+        """Ставки, упавшие на этапе settle, не рассчитаны (расчёт атомарен) - их исход известен, разыгрываем заново.
+        Только пока попытки не исчерпаны: счётчик переживает перезапуски"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET status = 'pending', worker_id = NULL, lease_until = NULL
+                WHERE status = 'failed' AND stage = 'settle' AND attempts < ?
+                """,
+                (MAX_BET_ATTEMPTS,)
+            )
+            return cursor.rowcount
+        return await self._submit(op)
+
+    async def hold_failed_settlements(self) -> List[Dict]:
+        """Ставки, исчерпавшие попытки расчёта, переводятся в manual: их разбирают админы, очередь их больше не трогает"""
+        async def op(db: aiosqlite.Connection):
+            async with db.execute(
+                """
+                UPDATE queue SET status = 'manual', finished_at = ?
+                WHERE status = 'failed' AND stage = 'settle' AND attempts >= ?
+                RETURNING *
+                """,
+                (time.time(), MAX_BET_ATTEMPTS)
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+        return await self._submit(op)
+
+    async def get_bets_to_refund(self, enqueued_before: float = 0) -> List[Dict]:
+        """Нерассчитанные ставки, которые не доиграть: упавшие до settle и зависшие до settle дольше окна.
+        С enqueued_before = 0 - только упавшие"""
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT * FROM queue
+                WHERE COALESCE(stage, '') NOT IN ('settle', 'notify')
+                  AND (
+                      status = 'failed'
+                      OR (enqueued_at < :before AND (
+                          status = 'pending'
+                          OR (status = 'processing' AND lease_until < :now)
+                      ))
+                  )
+                ORDER BY id
+                """,
+                {'before': enqueued_before, 'now': time.time()}
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def start_refund(self, queue_id: int, status: str) -> bool:
+        """Забирает ставку под возврат, если её статус не изменился с момента выборки"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                """
+                UPDATE queue SET status = 'refunding', worker_id = NULL, lease_until = NULL
+                WHERE id = ? AND status = ? AND COALESCE(stage, '') NOT IN ('settle', 'notify')
+                """,
+                (queue_id, status)
+            )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def finish_refund(self, queue_id: int, payload: Optional[str] = None) -> None:
+        async def op(db: aiosqlite.Connection):
+            await db.execute(
+                "UPDATE queue SET status = 'refunded', finished_at = ? WHERE id = ?",
+                (time.time(), queue_id)
+            )
+            if payload:
+                await db.execute(
+                    "UPDATE invoice_bets SET status = 'refunded' WHERE payload = ?",
+                    (payload,)
+                )
+        await self._submit(op)
+
+    async def get_refunding_bets(self) -> List[Dict]:
+        """Возвраты, прерванные падением: чек мог быть уже создан, разбираются вручную"""
+        async with self._read() as db:
+            async with db.execute("SELECT * FROM queue WHERE status = 'refunding' ORDER BY id") as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_queue_stats(self) -> Dict:
+        """Глубина очереди (ещё не начатые ставки), ставки между этапами и возраст самой старой ожидающей"""
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT
+                    COUNT(*) FILTER (WHERE status = 'pending' AND stage IS NULL) AS pending,
+                    COUNT(*) FILTER (WHERE status = 'pending' AND stage IS NOT NULL) AS staged,
+                    COUNT(*) FILTER (WHERE status = 'processing') AS processing,
+                    COUNT(*) FILTER (WHERE status = 'processing' AND lease_until < :now) AS expired,
+                    COUNT(*) FILTER (WHERE status = 'processing' OR stage IS NOT NULL) AS in_game,
+                    MIN(enqueued_at) FILTER (WHERE status = 'pending' AND stage IS NULL) AS oldest_enqueued_at
+                FROM queue
+                WHERE status IN ('pending', 'processing')
+                """,
+                {'now': time.time()}
+            ) as cursor:
+                stats = dict(await cursor.fetchone())
+        oldest = stats.pop('oldest_enqueued_at')
+        stats['oldest_wait'] = time.time() - oldest if oldest else 0
+        return stats
+
     async def mark_bet_processed(self, bet_id: int) -> bool:
         """Отмечает ставку как обработанную"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._write() as db:
                 await db.execute("""
                     UPDATE bets SET processed = 1, processed_at = datetime('now')
                     WHERE id = ?
                 """, (bet_id,))
-                await db.commit()
                 return True
         except Exception as e:
             logging.error(f"Error marking bet as processed: {e}")
@@ -231,28 +1079,72 @@ class Database:
     async def add_transaction(
         self, 
         user_id: int, 
-        amount: Decimal, 
+        amount: Money, 
         type: str, 
         game_type: Optional[str] = None
     ) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
+        async def op(db: aiosqlite.Connection):
+            await self._record_transaction(db, user_id, amount, type, game_type)
+        await self._submit(op)
+
+    async def _record_transaction(
+        self,
+        db: aiosqlite.Connection,
+        user_id: int,
+        amount: Money,
+        type: str,
+        game_type: Optional[str] = None
+    ) -> None:
+        """Запись в журнал вместе с проекцией user_stats и дневными агрегатами"""
+        await db.execute(
+            """
+            INSERT INTO transactions 
+            (user_id, amount, type, game_type) 
+            VALUES (?, ?, ?, ?)
+            """,
+            (user_id, amount, type, game_type)
+        )
+        if type == 'game':
             await db.execute(
                 """
-                INSERT INTO transactions 
-                (user_id, amount, type, game_type) 
-                VALUES (?, ?, ?, ?)
+                INSERT INTO user_stats
+                (user_id, total_games, wins, losses, turnover, total_won, total_lost)
+                VALUES (?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total_games = total_games + 1,
+                    wins = wins + excluded.wins,
+                    losses = losses + excluded.losses,
+                    turnover = turnover + excluded.turnover,
+                    total_won = total_won + excluded.total_won,
+                    total_lost = total_lost + excluded.total_lost
                 """,
-                (user_id, float(amount), type, game_type)
+                (
+                    user_id,
+                    int(amount > 0),
+                    int(amount <= 0),
+                    abs(amount),
+                    max(amount, 0),
+                    max(-amount, 0),
+                )
+            )
+        if type == 'game' and game_type and not game_type.endswith('_cashback'):
+            await self._bump_rollups(
+                db, None, game_type,
+                games=1,
+                wins=int(amount > 0),
+                losses=int(amount < 0),
+                draws=int(amount == 0),
+                spent=max(amount, 0),
+                earned=max(-amount, 0),
+                turnover=abs(amount),
             )
-            await db.commit()
 
     async def get_user_transactions(
         self, 
         user_id: int, 
         limit: int = 10
     ) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """
                 SELECT * FROM transactions 
@@ -266,27 +1158,19 @@ class Database:
                 return [dict(row) for row in rows]
 
     async def get_user_stats(self, user_id: int) -> dict:
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем все транзакции пользователя типа 'game'
-            cursor = await db.execute("""
-                SELECT 
-                    COUNT(*) as total_games,
-                    SUM(CASE WHEN amount > 0 THEN 1 ELSE 0 END) as wins,
-                    SUM(CASE WHEN amount <= 0 THEN 1 ELSE 0 END) as losses,
-                    SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END) as total_won,
-                    SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END) as total_lost,
-                    SUM(ABS(amount)) as turnover
-                FROM transactions 
-                WHERE user_id = ? AND type = 'game'
-            """, (user_id,))
-            row = await cursor.fetchone()
-            
-            total_games = row[0] or 0
-            wins = row[1] or 0
-            losses = row[2] or 0
-            total_won = float(row[3] or 0)
-            total_lost = float(row[4] or 0)
-            turnover = float(row[5] or 0)
+        async with self._read() as db:
+            # Проекция user_stats ведётся в add_transaction
+            async with db.execute(
+                """
+                SELECT total_games, wins, losses, total_won, total_lost, turnover
+                FROM user_stats
+                WHERE user_id = ?
+                """,
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+
+            total_games, wins, losses, total_won, total_lost, turnover = row if row else (0, 0, 0, 0, 0, 0)
             
             win_rate = (wins / total_games * 100) if total_games > 0 else 0
             
@@ -300,14 +1184,41 @@ class Database:
                 'total_lost': total_lost
             }
 
+    async def _bump_rollups(self, db: aiosqlite.Connection, day: Optional[str], game_type: str, **deltas: int) -> None:
+        """Прибавляет дельты к строке дня (None — сегодня) и к итоговой строке ALL_TIME"""
+        columns = list(deltas)
+        for row_day in (day, ALL_TIME):
+            await db.execute(
+                f"""
+                INSERT INTO daily_rollups (day, game_type, {', '.join(columns)})
+                VALUES (COALESCE(?, date('now')), ?, {', '.join('?' for _ in columns)})
+                ON CONFLICT(day, game_type) DO UPDATE SET
+                    {', '.join(f'{column} = {column} + excluded.{column}' for column in columns)}
+                """,
+                (row_day, game_type, *deltas.values())
+            )
+
+    async def rebuild_daily_rollups(self) -> None:
+        """Полностью пересчитывает daily_rollups по transactions и withdrawals"""
+        async with self._write() as db:
+            await db.execute("DELETE FROM daily_rollups")
+            for statement in DAILY_ROLLUPS_BACKFILL:
+                await db.execute(statement)
+
+    async def rebuild_user_stats(self) -> None:
+        """Полностью пересчитывает user_stats по таблице transactions"""
+        async with self._write() as db:
+            await db.execute("DELETE FROM user_stats")
+            await db.execute(USER_STATS_BACKFILL)
+
     async def create_withdrawal(
         self,
         user_id: int,
-        amount: float,
+        amount: Money,
         network: str,
         address: str
     ) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             cursor = await db.execute(
                 """
                 INSERT INTO withdrawals 
@@ -316,12 +1227,10 @@ class Database:
                 """,
                 (user_id, amount, network, address)
             )
-            await db.commit()
             return cursor.lastrowid
 
     async def get_pending_withdrawals(self) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """
                 SELECT w.*, u.username 
@@ -335,20 +1244,25 @@ class Database:
                 return [dict(row) for row in rows]
 
     async def mark_withdrawal_processed(self, withdrawal_id: int) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+        async with self._write() as db:
+            async with db.execute(
                 """
                 UPDATE withdrawals 
                 SET status = 'processed',
                     processed_at = CURRENT_TIMESTAMP
-                WHERE id = ?
+                WHERE id = ? AND status != 'processed'
+                RETURNING amount, date(created_at)
                 """,
                 (withdrawal_id,)
-            )
-            await db.commit()
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                amount, day = row
+                await self._bump_rollups(db, day, WITHDRAWALS_ROLLUP, withdrawals=amount)
 
     async def cancel_withdrawal(self, withdrawal_id: int) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
+        user_id = None
+        async with self._write() as db:
             # First get the withdrawal details
             async with db.execute(
                 "SELECT user_id, amount FROM withdrawals WHERE id = ?",
@@ -372,11 +1286,11 @@ class Database:
                         """,
                         (withdrawal_id,)
                     )
-                    await db.commit()
+        if user_id is not None:
+            self._user_cache.invalidate(user_id)
 
     async def get_user_withdrawals(self, user_id: int, limit: int = 10) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """
                 SELECT * FROM withdrawals 
@@ -390,130 +1304,115 @@ class Database:
                 return [dict(row) for row in rows]
 
     async def get_admin_stats(self) -> Dict:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             stats = {}
             
-            # Get total users and registrations
+            # Регистрации: диапазоны по created_at обслуживает индекс idx_users_created
             async with db.execute(
                 """
                 SELECT 
-                    COUNT(*) as total_users,
-                    SUM(CASE WHEN date(created_at) = date('now') THEN 1 ELSE 0 END) as today_users,
-                    SUM(CASE WHEN date(created_at) >= date('now', '-7 days') THEN 1 ELSE 0 END) as week_users
-                FROM users
+                    (SELECT COUNT(*) FROM users) as total_users,
+                    (SELECT COUNT(*) FROM users WHERE created_at >= date('now')) as today_users,
+                    (SELECT COUNT(*) FROM users WHERE created_at >= date('now', '-7 days')) as week_users
                 """
             ) as cursor:
-                user_stats = dict(await cursor.fetchone())
-                stats.update(user_stats)
+                stats.update(dict(await cursor.fetchone()))
 
-            # Get game statistics for today
+            # Игры и выводы: суммы по нескольким строкам daily_rollups вместо проходов по журналу
             async with db.execute(
                 """
                 SELECT 
-                    COUNT(DISTINCT id) as today_games,
-                    SUM(CASE WHEN amount > 0 THEN 1 ELSE 0 END) as today_wins,
-                    SUM(CASE WHEN amount < 0 THEN 1 ELSE 0 END) as today_losses,
-                    SUM(CASE WHEN amount = 0 THEN 1 ELSE 0 END) as today_draws,
-                    COALESCE(SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END), 0) as today_spent,
-                    COALESCE(SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END), 0) as today_earned,
-                    COALESCE(SUM(ABS(amount)), 0) as today_turnover
-                FROM transactions 
-                WHERE type = 'game' 
-                AND date(created_at) = date('now')
-                AND game_type NOT LIKE '%_cashback'
-                """
-            ) as cursor:
-                today_stats = dict(await cursor.fetchone())
-                stats.update(today_stats)
-
-            # Get game statistics for week
-            async with db.execute(
-                """
-                SELECT 
-                    COUNT(DISTINCT id) as week_games,
-                    SUM(CASE WHEN amount > 0 THEN 1 ELSE 0 END) as week_wins,
-                    SUM(CASE WHEN amount < 0 THEN 1 ELSE 0 END) as week_losses,
-                    SUM(CASE WHEN amount = 0 THEN 1 ELSE 0 END) as week_draws,
-                    COALESCE(SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END), 0) as week_spent,
-                    COALESCE(SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END), 0) as week_earned,
-                    COALESCE(SUM(ABS(amount)), 0) as week_turnover
-                FROM transactions 
-                WHERE type = 'game' 
-                AND date(created_at) >= date('now', '-7 days')
-                AND game_type NOT LIKE '%_cashback'
-                """
-            ) as cursor:
-                week_stats = dict(await cursor.fetchone())
-                stats.update(week_stats)
-
-            # Get total statistics
-            async with db.execute(
-                """
-                SELECT 
-                    COUNT(DISTINCT id) as total_bets,
-                    COALESCE(SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END), 0) as total_spent,
-                    COALESCE(SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END), 0) as total_earned,
-                    COALESCE(SUM(ABS(amount)), 0) as total_turnover
-                FROM transactions 
-                WHERE type = 'game'
-                AND game_type NOT LIKE '%_cashback'
-                """
-            ) as cursor:
-                total_stats = dict(await cursor.fetchone())
-                stats.update(total_stats)
-
-            # Get withdrawal statistics
-            async with db.execute(
-                """
-                SELECT 
-                    COALESCE(SUM(amount), 0) as total_withdrawals,
-                    COALESCE(SUM(CASE WHEN date(created_at) = date('now') THEN amount ELSE 0 END), 0) as today_withdrawals,
-                    COALESCE(SUM(CASE WHEN date(created_at) >= date('now', '-7 days') THEN amount ELSE 0 END), 0) as week_withdrawals
-                FROM withdrawals 
-                WHERE status = 'processed'
-                """
-            ) as cursor:
-                withdrawal_stats = dict(await cursor.fetchone())
-                stats.update(withdrawal_stats)
-
-            # Debug: Get raw transactions data
-            async with db.execute(
-                """
-                SELECT * FROM transactions 
-                WHERE type = 'game' 
-                ORDER BY created_at DESC 
-                LIMIT 5
-                """
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN games END), 0) as today_games,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN wins END), 0) as today_wins,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN losses END), 0) as today_losses,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN draws END), 0) as today_draws,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN spent END), 0) as today_spent,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN earned END), 0) as today_earned,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN turnover END), 0) as today_turnover,
+                    COALESCE(SUM(CASE WHEN day = date('now') THEN withdrawals END), 0) as today_withdrawals,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN games END), 0) as week_games,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN wins END), 0) as week_wins,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN losses END), 0) as week_losses,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN draws END), 0) as week_draws,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN spent END), 0) as week_spent,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN earned END), 0) as week_earned,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN turnover END), 0) as week_turnover,
+                    COALESCE(SUM(CASE WHEN day != :all_time THEN withdrawals END), 0) as week_withdrawals,
+                    COALESCE(SUM(CASE WHEN day = :all_time THEN games END), 0) as total_bets,
+                    COALESCE(SUM(CASE WHEN day = :all_time THEN spent END), 0) as total_spent,
+                    COALESCE(SUM(CASE WHEN day = :all_time THEN earned END), 0) as total_earned,
+                    COALESCE(SUM(CASE WHEN day = :all_time THEN turnover END), 0) as total_turnover,
+                    COALESCE(SUM(CASE WHEN day = :all_time THEN withdrawals END), 0) as total_withdrawals
+                FROM daily_rollups
+                WHERE day = :all_time OR day >= date('now', '-7 days')
+                """,
+                {"all_time": ALL_TIME}
             ) as cursor:
-                recent_transactions = await cursor.fetchall()
-                if recent_transactions:
-                    logging.info("Recent transactions found:")
-                    for tx in recent_transactions:
-                        logging.info(f"Transaction: {dict(tx)}")
-                else:
-                    logging.info("No recent transactions found")
+                stats.update(dict(await cursor.fetchone()))
 
             return stats 
 
-    async def get_all_users(self, limit: int = 100, offset: int = 0) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+    async def get_users_page(
+        self,
+        limit: int = 10,
+        after: Optional[Tuple[str, int]] = None,
+        newest_first: bool = True
+    ) -> List[Dict]:
+        """Страница пользователей по ключу (created_at, user_id): after - ключ последней строки предыдущей страницы"""
+        order = "DESC" if newest_first else "ASC"
+        cmp = "<" if newest_first else ">"
+        if after:
+            # Две ветки вместо (created_at, user_id) > (?, ?): индекс по created_at ищет только по первому
+            # столбцу, и курсор внутри большой пачки с одинаковым created_at сканировал бы её целиком
+            source = f"""(
+                SELECT * FROM (
+                    SELECT * FROM users WHERE created_at = :created_at AND user_id {cmp} :user_id
+                    ORDER BY user_id {order} LIMIT :limit
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM users WHERE created_at {cmp} :created_at
+                    ORDER BY created_at {order}, user_id {order} LIMIT :limit
+                )
+            )"""
+            params = {'created_at': after[0], 'user_id': after[1], 'limit': limit}
+        else:
+            source = "users"
+            params = {'limit': limit}
+        async with self._read() as db:
             async with db.execute(
-                """
-                SELECT u.*, 
-                       (SELECT username FROM users WHERE user_id = u.referrer_id) as referrer_username
-                FROM users u
-                ORDER BY u.created_at DESC
-                LIMIT ? OFFSET ?
+                f"""
+                SELECT u.*, r.username AS referrer_username
+                FROM {source} u
+                LEFT JOIN users r ON r.user_id = u.referrer_id
+                ORDER BY u.created_at {order}, u.user_id {order}
+                LIMIT :limit
                 """,
-                (limit, offset)
+                params
             ) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def iter_users(self, batch_size: int = 500) -> AsyncIterator[List[Dict]]:
+        """Все пользователи от старых к новым пачками по batch_size, без OFFSET и без загрузки всей таблицы"""
+        after = None
+        while True:
+            batch = await self.get_users_page(batch_size, after, newest_first=False)
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            after = (batch[-1]['created_at'], batch[-1]['user_id'])
+
+    async def count_users(self) -> int:
+        async with self._read() as db:
+            async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+                return (await cursor.fetchone())[0]
+
     async def update_user(self, user_id: int, updates: Dict) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+        old_referrer = None
+        async with self._write() as db:
             # Build the update query dynamically based on provided fields
             fields = []
             values = []
@@ -524,68 +1423,225 @@ class Database:
             
             if not fields:
                 return False
+
+            new_referrer = updates.get('referrer_id')
+            if 'referrer_id' in updates:
+                async with db.execute(
+                    "SELECT referrer_id FROM users WHERE user_id = ?",
+                    (user_id,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                    old_referrer = row[0] if row else None
                 
             query = f"UPDATE users SET {', '.join(fields)} WHERE user_id = ?"
             values.append(user_id)
             
             await db.execute(query, values)
-            await db.commit()
-            return True
+
+            if 'username' in updates:
+                await db.execute("DELETE FROM users_fts WHERE rowid = ?", (user_id,))
+                await self._index_username(db, user_id, updates['username'])
+
+            # Смена реферера переносит реферала между счётчиками
+            if 'referrer_id' in updates and old_referrer != new_referrer:
+                if old_referrer:
+                    await db.execute(
+                        "UPDATE users SET ref_count = ref_count - 1 WHERE user_id = ? AND ref_count > 0",
+                        (old_referrer,)
+                    )
+                if new_referrer:
+                    await db.execute(
+                        "UPDATE users SET ref_count = ref_count + 1 WHERE user_id = ?",
+                        (new_referrer,)
+                    )
+            else:
+                old_referrer = new_referrer = None
+        self._user_cache.invalidate(user_id)
+        for referrer_id in (old_referrer, new_referrer):
+            if referrer_id:
+                self._user_cache.invalidate(referrer_id)
+        return True
 
     async def delete_user(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+        referrer_id = None
+        async with self._write() as db:
+            async with db.execute(
+                "SELECT referrer_id FROM users WHERE user_id = ?",
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                referrer_id = row[0] if row else None
+
             # First delete related records
             await db.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM withdrawals WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM queue WHERE user_id = ?", (user_id,))
+            await db.execute("DELETE FROM user_stats WHERE user_id = ?", (user_id,))
+            # Неотправленные сводки: и самого пользователя как реферера, и его ставок у реферера
+            await db.execute(
+                "DELETE FROM ref_events WHERE referrer_id = ? OR user_id = ?",
+                (user_id, user_id)
+            )
             
             # Then delete the user
             await db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-            await db.commit()
-            return True
+            await db.execute("DELETE FROM users_fts WHERE rowid = ?", (user_id,))
+            if referrer_id:
+                await db.execute(
+                    "UPDATE users SET ref_count = ref_count - 1 WHERE user_id = ? AND ref_count > 0",
+                    (referrer_id,)
+                )
+        self._user_cache.invalidate(user_id)
+        if referrer_id:
+            self._user_cache.invalidate(referrer_id)
+        return True
+
+    @staticmethod
+    async def _index_username(db: aiosqlite.Connection, user_id: int, username: Optional[str]) -> None:
+        if username:
+            await db.execute(
+                "INSERT INTO users_fts (rowid, username) VALUES (?, ?)",
+                (user_id, username)
+            )
 
     async def search_users(self, query: str) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                """
-                SELECT u.*, 
-                       (SELECT username FROM users WHERE user_id = u.referrer_id) as referrer_username
-                FROM users u
-                WHERE u.username LIKE ? OR u.user_id LIKE ?
-                ORDER BY u.created_at DESC
-                LIMIT 50
-                """,
-                (f"%{query}%", f"%{query}%")
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        query = query.strip().lstrip('@')
+        if not query:
+            return []
 
-    async def add_bet(self, user_id: int, amount: float, game_type: str, message_id: int) -> int:
+        users: Dict[int, Dict] = {}
+        async with self._read() as db:
+            if query.isdigit():
+                # Префикс ID: по диапазону первичного ключа на каждую возможную длину, точное совпадение первым
+                prefix = int(query)
+                for length in range(len(query), MAX_USER_ID_DIGITS + 1):
+                    if len(users) >= SEARCH_LIMIT:
+                        break
+                    step = 10 ** (length - len(query))
+                    async with db.execute(
+                        USER_LIST_SELECT + "WHERE u.user_id >= ? AND u.user_id < ? ORDER BY u.user_id LIMIT ?",
+                        (prefix * step, (prefix + 1) * step, SEARCH_LIMIT - len(users))
+                    ) as cursor:
+                        for row in await cursor.fetchall():
+                            users[row['user_id']] = dict(row)
+
+            if len(users) < SEARCH_LIMIT:
+                if len(query) >= 3:
+                    # Триграммы ищут подстроку без учёта регистра
+                    phrase = '"' + query.replace('"', '""') + '"'
+                    sql = USER_LIST_SELECT + """
+                        WHERE u.user_id IN (
+                            SELECT rowid FROM users_fts WHERE users_fts MATCH ? LIMIT ?
+                        )
+                        ORDER BY u.created_at DESC
+                    """
+                    params = (phrase, SEARCH_LIMIT)
+                else:
+                    # Для одного-двух символов триграмм нет: подстроку ищем перебором таблицы
+                    sql = USER_LIST_SELECT + "WHERE u.username LIKE ? ESCAPE '\\' ORDER BY u.created_at DESC LIMIT ?"
+                    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                    params = ('%' + escaped + '%', SEARCH_LIMIT)
+                async with db.execute(sql, params) as cursor:
+                    for row in await cursor.fetchall():
+                        if len(users) >= SEARCH_LIMIT:
+                            break
+                        users.setdefault(row['user_id'], dict(row))
+
+        return list(users.values())
+
+    async def add_bet(self, user_id: int, amount: Money, game_type: str, message_id: int) -> int:
         """Добавляет ставку в очередь и возвращает её ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async def op(db: aiosqlite.Connection):
             cursor = await db.execute("""
                 INSERT INTO bets (user_id, amount, game_type, message_id, created_at, processed)
                 VALUES (?, ?, ?, ?, datetime('now'), 0)
             """, (user_id, amount, game_type, message_id))
-            await db.commit()
-            return cursor.lastrowid 
+            return cursor.lastrowid
+        return await self._submit(op)
 
-    async def add_invoice_bet(self, payload: str, user_id: int, game_key: str, bet_type_key: str, amount: Decimal) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def add_invoice_bet(
+        self,
+        payload: str,
+        user_id: int,
+        game_key: str,
+        bet_type_key: str,
+        amount: Money,
+        expires_at: Optional[float] = None,
+        name: Optional[str] = None
+    ) -> None:
+        async with self._write() as db:
             await db.execute(
                 """
                 INSERT INTO invoice_bets 
-                (payload, user_id, game_key, bet_type_key, amount) 
-                VALUES (?, ?, ?, ?, ?)
+                (payload, user_id, game_key, bet_type_key, amount, expires_at, name) 
+                VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (payload, user_id, game_key, bet_type_key, float(amount))
+                (payload, user_id, game_key, bet_type_key, amount, expires_at, name)
+            )
+
+    async def set_invoice_id(self, payload: str, invoice_id: int) -> None:
+        """Привязывает ставку к созданному инвойсу Crypto Pay"""
+        async def op(db: aiosqlite.Connection):
+            await db.execute("UPDATE invoice_bets SET invoice_id = ? WHERE payload = ?", (invoice_id, payload))
+        await self._submit(op)
+
+    async def get_pending_invoice_bets(self) -> List[Dict]:
+        """Неоплаченные инвойсы (payload, invoice_id), старые первыми"""
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT payload, invoice_id FROM invoice_bets
+                WHERE status = 'pending'
+                ORDER BY expires_at
+                """
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def expire_invoice_bets(self, expired_before: float) -> int:
+        """Закрывает неоплаченные инвойсы, срок которых вышел до expired_before"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                "UPDATE invoice_bets SET status = 'expired' WHERE status = 'pending' AND expires_at < ?",
+                (expired_before,)
             )
-            await db.commit()
+            return cursor.rowcount
+        return await self._submit(op)
+
+    async def expire_invoice_bet(self, payload: str) -> bool:
+        """Закрывает неоплаченный инвойс: истёк в Crypto Pay или не был создан"""
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                "UPDATE invoice_bets SET status = 'expired' WHERE payload = ? AND status = 'pending'",
+                (payload,)
+            )
+            return cursor.rowcount == 1
+        return await self._submit(op)
+
+    async def claim_expired_invoice_bet(self, payload: str) -> Optional[Dict]:
+        """Забирает под возврат инвойс, оплаченный после истечения. Только один вызов на payload получает строку"""
+        async def op(db: aiosqlite.Connection):
+            async with db.execute(
+                """
+                UPDATE invoice_bets SET status = 'refunding'
+                WHERE payload = ? AND status = 'expired'
+                RETURNING *
+                """,
+                (payload,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            return dict(row) if row else None
+        return await self._submit(op)
+
+    async def finish_expired_invoice_refund(self, payload: str) -> None:
+        async def op(db: aiosqlite.Connection):
+            await db.execute(
+                "UPDATE invoice_bets SET status = 'refunded' WHERE payload = ? AND status = 'refunding'",
+                (payload,)
+            )
+        await self._submit(op)
 
     async def get_invoice_bet(self, payload: str) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT * FROM invoice_bets WHERE payload = ?", 
                 (payload,)
@@ -593,48 +1649,66 @@ class Database:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
-    async def mark_invoice_bet_paid(self, payload: str) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE invoice_bets SET status = 'paid' WHERE payload = ?",
+    async def claim_invoice_bet(self, payload: str, name: Optional[str] = None) -> Optional[Dict]:
+        """Атомарно забирает оплаченный инвойс и ставит его ставку в очередь.
+
+        Только один вызов на payload получает строку invoice_bets (со столбцом queue_id); остальные,
+        как и неизвестный payload, получают None. Инвойс остаётся в 'processing' до settle_bet.
+        name - имя игрока, если оно не сохранено с инвойсом.
+        """
+        async def op(db: aiosqlite.Connection):
+            async with db.execute(
+                """
+                UPDATE invoice_bets SET status = 'processing'
+                WHERE payload = ? AND status = 'pending'
+                RETURNING *
+                """,
                 (payload,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            invoice_bet = dict(row)
+            cursor = await db.execute(
+                """
+                INSERT INTO queue
+                (user_id, amount, game, bet_type, name, comment, payload, enqueued_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    invoice_bet['user_id'], invoice_bet['amount'], invoice_bet['game_key'],
+                    invoice_bet['bet_type_key'], invoice_bet['name'] or name or f"User {invoice_bet['user_id']}",
+                    invoice_bet['bet_type_key'], payload, time.time()
+                )
             )
-            await db.commit()
+            invoice_bet['queue_id'] = cursor.lastrowid
+            return invoice_bet
+        return await self._submit(op)
 
-    async def get_current_balance(self) -> float:
-        """Возвращает текущий баланс казны (из CryptoPay API)"""
-        try:
-            crypto_pay = CryptoPayAPI(os.getenv('CRYPTO_PAY_TOKEN'))
-            balance_data = await crypto_pay.get_balance()
-            
-            balances = balance_data.get('result', [])
-            usdt_balance = 0
-            
-            # Находим USDT баланс
-            for balance in balances:
-                currency = balance.get('currency_code', '')
-                available = balance.get('available', '0')
-                
-                if currency and currency.upper() == 'USDT':
-                    usdt_balance = float(available)
-                    break
-            
-            return usdt_balance
-        except Exception as e:
-            logging.error(f"Error getting current balance: {e}")
-            return 0.0 
+    async def get_claimed_payloads(self, limit: int) -> List[str]:
+        """Последние payload'ы, которые уже взяты в работу"""
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT payload FROM invoice_bets
+                WHERE status != 'pending'
+                ORDER BY created_at DESC
+                LIMIT ?
+                """,
+                (limit,)
+            ) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
 
-    async def save_win_check_token(self, token: str, user_id: int, amount: float, check_link: str):
-        async with aiosqlite.connect(self.db_path) as db:
+    async def save_win_check_token(self, token: str, user_id: int, amount: Money, check_link: str):
+        async def op(db: aiosqlite.Connection):
             await db.execute(
                 "INSERT OR REPLACE INTO win_check_tokens (token, user_id, amount, used, check_link) VALUES (?, ?, ?, 0, ?)",
                 (token, user_id, amount, check_link)
             )
-            await db.commit()
+        await self._submit(op)
 
     async def get_win_check_token(self, token: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT * FROM win_check_tokens WHERE token = ? AND used = 0",
                 (token,)
@@ -643,9 +1717,33 @@ class Database:
                 return dict(row) if row else None
 
     async def mark_win_check_token_used(self, token: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE win_check_tokens SET used = 1 WHERE token = ?",
                 (token,)
             )
-            await db.commit() 
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    # python database.py [путь] [--rebuild-stats] [--rebuild-rollups] — обновляет существующий файл базы на месте
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Миграции и обслуживание базы")
+    parser.add_argument("path", nargs="?", default="bunny.casino")
+    parser.add_argument("--rebuild-stats", action="store_true", help="пересчитать user_stats из transactions")
+    parser.add_argument("--rebuild-rollups", action="store_true", help="пересчитать daily_rollups из transactions и withdrawals")
+    args = parser.parse_args()
+
+    async def _run() -> None:
+        db = Database(args.path, readers=0)
+        await db.init()
+        if args.rebuild_stats:
+            await db.rebuild_user_stats()
+            logging.info("user_stats rebuilt")
+        if args.rebuild_rollups:
+            await db.rebuild_daily_rollups()
+            logging.info("daily_rollups rebuilt")
+        await db.close()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run())
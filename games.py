@@ -1,13 +1,112 @@
 import random
-from decimal import Decimal
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Dict
 from dataclasses import dataclass
+from money import Money, scale, to_str
+
+# Игры и исходы. Исход задаётся каноническим ключом: подпись для меню и алиасы, которыми его можно
+# указать в комментарии к переводу. Всё остальное (GAMES_DATA, BET_ALIASES) строится отсюда
+BET_SPEC = {
+    "cube": {
+        "name": "🎲 Кубик",
+        "bets": {
+            "чет": ("Чет (x1.85)", []),
+            "нечет": ("Нечет (x1.85)", []),
+            "больше": ("Больше 3 (x1.85)", []),
+            "меньше": ("Меньше 4 (x1.85)", []),
+            "плинко": ("Плинко (x0.3-1.95)", ["пл"]),
+            "1": ("Число 1 (x4)", []),
+            "2": ("Число 2 (x4)", []),
+            "3": ("Число 3 (x4)", []),
+            "4": ("Число 4 (x4)", []),
+            "5": ("Число 5 (x4)", []),
+            "6": ("Число 6 (x4)", []),
+            "сектор1": ("Сектор 1 (x2.5)", ["с1"]),
+            "сектор2": ("Сектор 2 (x2.5)", ["с2"]),
+            "сектор3": ("Сектор 3 (x2.5)", ["с3"]),
+        }
+    },
+    "two_dice": {
+        "name": "🎲🎲 Два кубика",
+        "bets": {
+            "победа1": ("Победа 1 (x1.85)", ["п1"]),
+            "победа2": ("Победа 2 (x1.85)", ["п2"]),
+            "ничья": ("Ничья (x3)", []),
+        }
+    },
+    "rock_paper_scissors": {
+        "name": "👊 КНБ",
+        "bets": {
+            "камень": ("👊 (x2.5)", ["к"]),
+            "ножницы": ("✌️ (x2.5)", ["н"]),
+            "бумага": ("✋ (x2.5)", ["б"]),
+        }
+    },
+    "basketball": {
+        "name": "🏀 Баскетбол",
+        "bets": {
+            "гол": ("Гол (x1.85)", []),
+            "мимо": ("Мимо (x1.4)", []),
+        }
+    },
+    "darts": {
+        "name": "🎯 Дартс",
+        "bets": {
+            "белое": ("Белое (x1.85)", []),
+            "красное": ("Красное (x1.85)", []),
+            "яблочко": ("Яблочко (x2.5)", []),
+            "промах": ("Мимо (x2.5)", []),
+        }
+    },
+    "slots": {
+        "name": "🎰 Слоты",
+        "bets": {
+            "слоты": ("Играть (x5-10)", ["казик", "777", "джекпот"]),
+        }
+    },
+    "bowling": {
+        "name": "🎳 Боулинг",
+        "bets": {
+            "страйк": ("Страйк (x4)", []),
+            "боулпромах": ("Промах (x4)", []),
+            "боулинг": ("Плинко (x0-4)", ["боул"]),
+            "боулпобеда": ("Победа в дуэли (x1.85)", []),
+            "боулпоражение": ("Поражение в дуэли (x1.85)", []),
+        }
+    },
+}
+
+def normalize_bet(text: str) -> str:
+    return text.lower().replace(" ", "").replace("ё", "е")
+
+# Игра -> название и подписи исходов для меню
+GAMES_DATA = {
+    game: {"name": spec["name"], "types": {bet: label for bet, (label, _) in spec["bets"].items()}}
+    for game, spec in BET_SPEC.items()
+}
+
+def _build_aliases() -> Dict[str, Tuple[str, str]]:
+    aliases = {}
+    for game, spec in BET_SPEC.items():
+        for bet, (_, names) in spec["bets"].items():
+            for name in (bet, *names):
+                key = normalize_bet(name)
+                if key in aliases:
+                    raise ValueError(f"Duplicate bet alias {name!r}: {aliases[key]} and {(game, bet)}")
+                aliases[key] = (game, bet)
+    return aliases
+
+# Нормализованный алиас или ключ исхода -> (игра, канонический исход)
+BET_ALIASES = _build_aliases()
+
+def resolve_bet(comment: str) -> Optional[Tuple[str, str]]:
+    """(игра, канонический исход) по комментарию к ставке или None"""
+    return BET_ALIASES.get(normalize_bet(comment))
 
 @dataclass
 class GameResult:
     won: bool
     draw: bool
-    amount: Decimal
+    amount: Money
     message: str
     emoji: str
     value: Optional[int] = None
@@ -15,10 +114,11 @@ class GameResult:
 class Game:
     EMOJI = "🎲"
     
-    def __init__(self, bet_amount: Decimal):
+    def __init__(self, bet_amount: Money):
         self.bet_amount = bet_amount
 
     async def process(self, bet_type: str, dice_value: int) -> GameResult:
+        """bet_type - канонический исход из BET_SPEC"""
         raise NotImplementedError
 
     def get_emoji(self, bet_type: str) -> str:
@@ -26,80 +126,68 @@ class Game:
 
 class CubeGame(Game):
     EMOJI = "🎲"
+    SECTORS = {"сектор1": [1, 2], "сектор2": [3, 4], "сектор3": [5, 6]}
+    PLINKO = {1: 0, 2: 30, 3: 90, 4: 110, 5: 140, 6: 195}
     
     async def process(self, bet_type: str, dice_value: int) -> GameResult:
-        bet_type = bet_type.lower().replace(" ", "")
-        
         if bet_type in ["чет", "нечет"]:
             is_even = dice_value % 2 == 0
             if (bet_type == "чет" and is_even) or (bet_type == "нечет" and not is_even):
-                win_amount = self.bet_amount * Decimal('1.85')
+                win_amount = scale(self.bet_amount, 185)
                 return GameResult(
                     won=True,
                     draw=False,
                     amount=win_amount,
-                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {win_amount}$!",
+                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {to_str(win_amount)}$!",
                     emoji=self.EMOJI,
                     value=dice_value
                 )
         
         elif bet_type in ["больше", "меньше"]:
             if (bet_type == "больше" and dice_value > 3) or (bet_type == "меньше" and dice_value <= 3):
-                win_amount = self.bet_amount * Decimal('1.85')
+                win_amount = scale(self.bet_amount, 185)
                 return GameResult(
                     won=True,
                     draw=False,
                     amount=win_amount,
-                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {win_amount}$!",
+                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {to_str(win_amount)}$!",
                     emoji=self.EMOJI,
                     value=dice_value
                 )
         
-        elif bet_type in ["сектор1", "сектор2", "сектор3", "с1", "с2", "с3"]:
-            sector_map = {
-                "сектор1": "1", "с1": "1",
-                "сектор2": "2", "с2": "2",
-                "сектор3": "3", "с3": "3"
-            }
-            sector = sector_map[bet_type]
-            sector_numbers = {
-                "1": [1, 2],
-                "2": [3, 4],
-                "3": [5, 6]
-            }
-            if dice_value in sector_numbers[sector]:
-                win_amount = self.bet_amount * Decimal('2.5')
+        elif bet_type in self.SECTORS:
+            sector = bet_type[-1]
+            if dice_value in self.SECTORS[bet_type]:
+                win_amount = scale(self.bet_amount, 250)
                 return GameResult(
                     won=True,
                     draw=False,
                     amount=win_amount,
-                    message=f"🎲 Выпало число {dice_value}!\nСектор {sector} выиграл!\nВы выиграли {win_amount}$!",
+                    message=f"🎲 Выпало число {dice_value}!\nСектор {sector} выиграл!\nВы выиграли {to_str(win_amount)}$!",
                     emoji=self.EMOJI,
                     value=dice_value
                 )
         
         elif bet_type in ["1", "2", "3", "4", "5", "6"]:
             if str(dice_value) == bet_type:
-                win_amount = self.bet_amount * Decimal('4')
+                win_amount = scale(self.bet_amount, 400)
                 return GameResult(
                     won=True,
                     draw=False,
                     amount=win_amount,
-                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {win_amount}$!",
+                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {to_str(win_amount)}$!",
                     emoji=self.EMOJI,
                     value=dice_value
                 )
         
-        elif bet_type in ["плинко", "пл", "plinko"]:
-            multipliers = {1: 0, 2: Decimal('0.3'), 3: Decimal('0.9'), 
-                         4: Decimal('1.1'), 5: Decimal('1.4'), 6: Decimal('1.95')}
-            if dice_value in multipliers and multipliers[dice_value] > 0:
-                win_amount = self.bet_amount * multipliers[dice_value]
+        elif bet_type == "плинко":
+            if self.PLINKO.get(dice_value, 0) > 0:
+                win_amount = scale(self.bet_amount, self.PLINKO[dice_value])
                 return GameResult(
                     won=True,
                     draw=False,
                     amount=win_amount,
-                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {win_amount}$!",
+                    message=f"🎲 Выпало число {dice_value}!\nВы выиграли {to_str(win_amount)}$!",
                     emoji=self.EMOJI,
                     value=dice_value
                 )
@@ -107,7 +195,7 @@ class CubeGame(Game):
         return GameResult(
             won=False,
             draw=False,
-            amount=Decimal('0'),
+            amount=0,
             message=f"🎲 Выпало число {dice_value}!\nВы проиграли!",
             emoji=self.EMOJI,
             value=dice_value
@@ -117,29 +205,28 @@ class TwoDiceGame(Game):
     EMOJI = "🎲"
     
     async def process(self, bet_type: str, dice_value: int, second_dice_value: int = None) -> GameResult:
-        bet_type = bet_type.lower().replace(" ", "")
         dice1 = dice_value
         dice2 = second_dice_value if second_dice_value is not None else await self.roll_second_dice()
         if bet_type == "ничья":
             if dice1 == dice2:
-                return GameResult(True, False, self.bet_amount * Decimal('3'), f"🎲 Выпало {dice1} и {dice2}! Ничья — выигрыш {self.bet_amount * Decimal('3')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 300), f"🎲 Выпало {dice1} и {dice2}! Ничья — выигрыш {to_str(scale(self.bet_amount, 300))}$!", self.EMOJI, dice_value)
             else: 
-                return GameResult(False, False, Decimal('0'), f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
+                return GameResult(False, False, 0, f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
         elif bet_type == "победа1":
             if dice1 > dice2:
-                return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🎲 Выпало {dice1} и {dice2}!\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 185), f"🎲 Выпало {dice1} и {dice2}!\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
             elif dice1 == dice2:
-                return GameResult(False, True, self.bet_amount * Decimal('1'), f"🎲 Выпало {dice1} и {dice2}! Ничья — {self.bet_amount}$", self.EMOJI, dice_value)
+                return GameResult(False, True, self.bet_amount, f"🎲 Выпало {dice1} и {dice2}! Ничья — {to_str(self.bet_amount)}$", self.EMOJI, dice_value)
             else:
-                return GameResult(False, False, Decimal('0'), f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
+                return GameResult(False, False, 0, f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
         elif bet_type == "победа2":
             if dice2 > dice1:
-                return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🎲 Выпало {dice1} и {dice2}!\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 185), f"🎲 Выпало {dice1} и {dice2}!\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
             elif dice1 == dice2:
-                return GameResult(True, True, self.bet_amount * Decimal('1'), f"🎲 Выпало {dice1} и {dice2}! Ничья — возврат {self.bet_amount}$", self.EMOJI, dice_value)
+                return GameResult(True, True, self.bet_amount, f"🎲 Выпало {dice1} и {dice2}! Ничья — возврат {to_str(self.bet_amount)}$", self.EMOJI, dice_value)
             else:
-                return GameResult(False, False, Decimal('0'), f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
-        return GameResult(False, Decimal('0'), f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
+                return GameResult(False, False, 0, f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
+        return GameResult(False, False, 0, f"🎲 Выпало {dice1} и {dice2}!\nВы проиграли!", self.EMOJI, dice_value)
     
     async def roll_second_dice(self) -> int:
         return random.randint(1, 6)
@@ -156,15 +243,6 @@ class RockPaperScissorsGame(Game):
         "камень": ROCK_EMOJI,
         "бумага": PAPER_EMOJI,
         "ножницы": SCISSORS_EMOJI,
-        "rock": ROCK_EMOJI,
-        "paper": PAPER_EMOJI,
-        "scissors": SCISSORS_EMOJI,
-        "к": ROCK_EMOJI,
-        "б": PAPER_EMOJI,
-        "н": SCISSORS_EMOJI,
-        "r": ROCK_EMOJI,
-        "p": PAPER_EMOJI,
-        "s": SCISSORS_EMOJI,
     }
     
     RULES = {
@@ -174,25 +252,16 @@ class RockPaperScissorsGame(Game):
     }
     
     def get_emoji(self, bet_type: str) -> str:
-        bet_type = bet_type.lower().replace(" ", "")
         return self.BET_EMOJIS.get(bet_type, self.EMOJI)
     
     async def process(self, bet_type: str, bot_choice_value: int) -> GameResult:
-        bet_type = bet_type.lower().replace(" ", "")
-        
-        bet_mapping = {
-            "к": "камень", "б": "бумага", "н": "ножницы",
-            "r": "камень", "p": "бумага", "s": "ножницы",
-            "rock": "камень", "paper": "бумага", "scissors": "ножницы"
-        }
-        
-        player_choice = bet_mapping.get(bet_type, bet_type)
+        player_choice = bet_type
         
-        if player_choice not in ["камень", "бумага", "ножницы"]:
+        if player_choice not in self.BET_EMOJIS:
             return GameResult(
                 won=False,
                 draw=False,
-                amount=Decimal('0'),
+                amount=0,
                 message=f"❌",
                 emoji=self.EMOJI,
                 value=bot_choice_value
@@ -205,7 +274,7 @@ class RockPaperScissorsGame(Game):
         bot_emoji = self.BET_EMOJIS[bot_choice]
         
         if player_choice == bot_choice:
-            win_amount = self.bet_amount * Decimal('1')
+            win_amount = self.bet_amount
             return GameResult(
                 won=True,
                 draw=True,
@@ -216,7 +285,7 @@ class RockPaperScissorsGame(Game):
             )
         
         elif bot_choice in self.RULES.get(player_choice, []):
-            win_amount = self.bet_amount * Decimal('2.5')
+            win_amount = scale(self.bet_amount, 250)
             return GameResult(
                 won=True,
                 draw=False,
@@ -230,7 +299,7 @@ class RockPaperScissorsGame(Game):
             return GameResult(
                 won=False,
                 draw=False,
-                amount=Decimal('0'),
+                amount=0,
                 message=f"{player_emoji}",
                 emoji=self.EMOJI,
                 value=bot_choice_value
@@ -240,46 +309,38 @@ class BasketballGame(Game):
     EMOJI = "🏀"
     
     async def process(self, bet_type: str, dice_value: int) -> GameResult:
-        bet_type = bet_type.lower().replace(" ", "")
-        goal_words = ["гол", "попадание", "goal", "hit", "score"]
-        miss_words = ["промах", "мимо", "miss"]
         is_goal = dice_value in [4, 5]
-        if any(word in bet_type for word in goal_words) and is_goal:
-            return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🏀 Попадание! Выпало {dice_value}\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
-        if any(word in bet_type for word in miss_words) and not is_goal:
-            return GameResult(True, self.bet_amount * Decimal('1.4'), f"🏀 Промах! Выпало {dice_value}\nВы выиграли {self.bet_amount * Decimal('1.4')}$!", self.EMOJI, dice_value)
-        return GameResult(False, False, Decimal('0'), f"🏀 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+        if bet_type == "гол" and is_goal:
+            return GameResult(True, False, scale(self.bet_amount, 185), f"🏀 Попадание! Выпало {dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
+        if bet_type == "мимо" and not is_goal:
+            return GameResult(True, False, scale(self.bet_amount, 140), f"🏀 Промах! Выпало {dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 140))}$!", self.EMOJI, dice_value)
+        return GameResult(False, False, 0, f"🏀 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
 
 class DartsGame(Game):
     EMOJI = "🎯"
     
     async def process(self, bet_type: str, dice_value: int) -> GameResult:
-        bet_type = bet_type.lower().replace(" ", "")
-        miss_words = ["промах", "мимо"]
-        white_words = ["белое"]
-        red_words = ["красное"]
-        bullseye_words = ["яблочко"]
-        if bet_type in miss_words:
+        if bet_type == "промах":
             if dice_value == 1:
-                return GameResult(True, False, self.bet_amount * Decimal('2.5'), f"🎯 Промах! Выпало {dice_value}\nВы выиграли {self.bet_amount * Decimal('2.5')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 250), f"🎯 Промах! Выпало {dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 250))}$!", self.EMOJI, dice_value)
             else:
-                return GameResult(False, False, Decimal('0'), f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
-        if bet_type in white_words:
+                return GameResult(False, False, 0, f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+        if bet_type == "белое":
             if dice_value in [3, 5]:
-                return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🎯 Белое! Выпало {dice_value}\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 185), f"🎯 Белое! Выпало {dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
             else:
-                return GameResult(False, False, Decimal('0'), f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
-        if bet_type in red_words:
+                return GameResult(False, False, 0, f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+        if bet_type == "красное":
             if dice_value in [2, 4]:
-                return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🎯 Красное! Выпало {dice_value}\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 185), f"🎯 Красное! Выпало {dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
             else:
-                return GameResult(False, False, Decimal('0'), f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
-        if bet_type in bullseye_words:
+                return GameResult(False, False, 0, f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+        if bet_type == "яблочко":
             if dice_value == 6:
-                return GameResult(True, False, self.bet_amount * Decimal('2.5'), f"🎯 Яблочко! Выпало {dice_value}\nВы выиграли {self.bet_amount * Decimal('2.5')}$!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 250), f"🎯 Яблочко! Выпало {dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 250))}$!", self.EMOJI, dice_value)
             else:
-                return GameResult(False, Decimal('0'), f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
-        return GameResult(False, Decimal('0'), f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+                return GameResult(False, False, 0, f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+        return GameResult(False, False, 0, f"🎯 Выпало {dice_value}\nВы проиграли!", self.EMOJI, dice_value)
 
 class SlotsGame(Game):
     EMOJI = "🎰"
@@ -289,49 +350,47 @@ class SlotsGame(Game):
         # 1 — три BAR (x5)
         # 43, 22, 52, 27, 38 — три одинаковых (x5)
         if dice_value == 64:
-            return GameResult(True, False, self.bet_amount * Decimal('10'), f"🎰 Джекпот! 777!\nВы выиграли {self.bet_amount * Decimal('10')}$!", self.EMOJI, dice_value)
+            return GameResult(True, False, scale(self.bet_amount, 1000), f"🎰 Джекпот! 777!\nВы выиграли {to_str(scale(self.bet_amount, 1000))}$!", self.EMOJI, dice_value)
         if dice_value == 1:
-            return GameResult(True, False, self.bet_amount * Decimal('5'), f"🎰 Джекпот! BAR!\nВы выиграли {self.bet_amount * Decimal('5')}$!", self.EMOJI, dice_value)
+            return GameResult(True, False, scale(self.bet_amount, 500), f"🎰 Джекпот! BAR!\nВы выиграли {to_str(scale(self.bet_amount, 500))}$!", self.EMOJI, dice_value)
         if dice_value in [43, 22, 52, 27, 38]:
-            return GameResult(True, False, self.bet_amount * Decimal('5'), f"🎰 Три одинаковых!\nВы выиграли {self.bet_amount * Decimal('5')}$!", self.EMOJI, dice_value)
-        return GameResult(False, Decimal('0'), f"🎰 Неудачная комбинация.\nВы проиграли!", self.EMOJI, dice_value)
+            return GameResult(True, False, scale(self.bet_amount, 500), f"🎰 Три одинаковых!\nВы выиграли {to_str(scale(self.bet_amount, 500))}$!", self.EMOJI, dice_value)
+        return GameResult(False, False, 0, f"🎰 Неудачная комбинация.\nВы проиграли!", self.EMOJI, dice_value)
     
 class BowlingGame(Game):
     EMOJI = "🎳"
+    # Исходы дуэли: бросок игрока против второго броска
+    DUELS = ("боулпобеда", "боулпоражение")
     
     async def process(self, bet_type: str, dice_value: int, second_dice_value: int = None) -> GameResult:
-        bet_type = bet_type.lower().replace(" ", "")
-        duel_words = ["боулпобеда", "боулпоражение"]
-        strike_words = ["страйк"]
-        miss_words = ["боулпромах"]
         # Дуэль
-        if bet_type in duel_words and second_dice_value is not None:
+        if bet_type in self.DUELS and second_dice_value is not None:
             if bet_type == "боулпобеда":
                 if dice_value > (second_dice_value or 0):
-                    return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
+                    return GameResult(True, False, scale(self.bet_amount, 185), f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
                 elif dice_value == (second_dice_value or 0):
-                    return GameResult(True, True, self.bet_amount * Decimal('1'), f"🎳 Дуэль: {dice_value} vs {second_dice_value}! Ничья — ставка возвращается с комиссией 30%: {self.bet_amount * Decimal('0.7')}$!", self.EMOJI, dice_value)
+                    return GameResult(True, True, self.bet_amount, f"🎳 Дуэль: {dice_value} vs {second_dice_value}! Ничья — ставка возвращается с комиссией 30%: {to_str(scale(self.bet_amount, 70))}$!", self.EMOJI, dice_value)
                 else:
-                    return GameResult(False, False, Decimal('0'), f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+                    return GameResult(False, False, 0, f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы проиграли!", self.EMOJI, dice_value)
             if bet_type == "боулпоражение":
                 if dice_value < (second_dice_value or 0):
-                    return GameResult(True, False, self.bet_amount * Decimal('1.85'), f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы выиграли {self.bet_amount * Decimal('1.85')}$!", self.EMOJI, dice_value)
+                    return GameResult(True, False, scale(self.bet_amount, 185), f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы выиграли {to_str(scale(self.bet_amount, 185))}$!", self.EMOJI, dice_value)
                 elif dice_value == (second_dice_value or 0):
-                    return GameResult(True, True, self.bet_amount * Decimal('1'), f"🎳 Дуэль: {dice_value} vs {second_dice_value}! Ничья — ставка возвращается с комиссией 30%: {self.bet_amount * Decimal('0.7')}$!", self.EMOJI, dice_value)
+                    return GameResult(True, True, self.bet_amount, f"🎳 Дуэль: {dice_value} vs {second_dice_value}! Ничья — ставка возвращается с комиссией 30%: {to_str(scale(self.bet_amount, 70))}$!", self.EMOJI, dice_value)
                 else:
-                    return GameResult(False, False, Decimal('0'), f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы проиграли!", self.EMOJI, dice_value)
+                    return GameResult(False, False, 0, f"🎳 Дуэль: {dice_value} vs {second_dice_value}\nВы проиграли!", self.EMOJI, dice_value)
         # Одиночный режим (Plinko-стиль)
-        if bet_type in ["боул", "боулинг"]:
+        if bet_type == "боулинг":
             if dice_value == 0:
-                return GameResult(True, False, self.bet_amount * Decimal('4'), f"🎳 Промах! Выпало {dice_value}. Выигрыш x4!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 400), f"🎳 Промах! Выпало {dice_value}. Выигрыш x4!", self.EMOJI, dice_value)
             elif dice_value == 1:
-                return GameResult(False, False, Decimal('0'), f"🎳 Выпало {dice_value}. Поражение!", self.EMOJI, dice_value)
+                return GameResult(False, False, 0, f"🎳 Выпало {dice_value}. Поражение!", self.EMOJI, dice_value)
             elif dice_value == 6:
-                return GameResult(True, False, self.bet_amount * Decimal('4'), f"🎳 Страйк! Выпало {dice_value}. Выигрыш x4!", self.EMOJI, dice_value)
+                return GameResult(True, False, scale(self.bet_amount, 400), f"🎳 Страйк! Выпало {dice_value}. Выигрыш x4!", self.EMOJI, dice_value)
             else:
-                return GameResult(True, False, self.bet_amount * Decimal('1.4'), f"🎳 Обычный бросок! Выпало {dice_value}. Выигрыш x1.4!", self.EMOJI, dice_value)
-        if bet_type in strike_words and dice_value == 6:
-            return GameResult(True, False, self.bet_amount * Decimal('4'), f"🎳 Страйк! Выпало {dice_value}. Вы выиграли {self.bet_amount * Decimal('4')}$!", self.EMOJI, dice_value)
-        if bet_type in miss_words and dice_value == 0:
-            return GameResult(True, False, self.bet_amount * Decimal('4'), f"🎳 Промах! Выпало {dice_value}. Вы выиграли {self.bet_amount * Decimal('4')}$!", self.EMOJI, dice_value)
-        return GameResult(False, False, Decimal('0'), f"🎳 Выпало {dice_value}. Вы проиграли!", self.EMOJI, dice_value) 
\ No newline at end of file
+                return GameResult(True, False, scale(self.bet_amount, 140), f"🎳 Обычный бросок! Выпало {dice_value}. Выигрыш x1.4!", self.EMOJI, dice_value)
+        if bet_type == "страйк" and dice_value == 6:
+            return GameResult(True, False, scale(self.bet_amount, 400), f"🎳 Страйк! Выпало {dice_value}. Вы выиграли {to_str(scale(self.bet_amount, 400))}$!", self.EMOJI, dice_value)
+        if bet_type == "боулпромах" and dice_value == 0:
+            return GameResult(True, False, scale(self.bet_amount, 400), f"🎳 Промах! Выпало {dice_value}. Вы выиграли {to_str(scale(self.bet_amount, 400))}$!", self.EMOJI, dice_value)
+        return GameResult(False, False, 0, f"🎳 Выпало {dice_value}. Вы проиграли!", self.EMOJI, dice_value) 
\ No newline at end of file
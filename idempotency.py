@@ -0,0 +1,39 @@
+from collections import OrderedDict
+
+from database import Database
+
+
+class PayloadRegistry:
+    """Payload'ы инвойсов, которые уже взяты в работу или заведомо не наши.
+
+    Ограниченное по размеру множество: самые давние payload'ы вытесняются первыми. Это только быстрый
+    фильтр перед походом в базу - право разыграть ставку даёт Database.claim_invoice_bet, так что
+    вытесненный payload максимум стоит лишнего запроса.
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self._payloads: "OrderedDict[str, None]" = OrderedDict()
+
+    def __contains__(self, payload: str) -> bool:
+        if payload in self._payloads:
+            self._payloads.move_to_end(payload)
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def add(self, payload: str) -> None:
+        self._payloads[payload] = None
+        self._payloads.move_to_end(payload)
+        while len(self._payloads) > self.maxsize:
+            self._payloads.popitem(last=False)
+
+    async def warm(self, db: Database) -> int:
+        """Загружает последние обработанные payload'ы из invoice_bets"""
+        for payload in await db.get_claimed_payloads(self.maxsize):
+            self.add(payload)
+        return len(self._payloads)
@@ -0,0 +1,83 @@
+import functools
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Iterator
+
+
+class Metrics:
+    """Гистограммы длительностей именованных участков (spans) внутри процесса.
+
+    По каждому участку хранятся последние samples замеров, перцентили считаются по ним при запросе.
+    Участки с точкой в имени ('payout.check') - части более крупного участка.
+    """
+
+    def __init__(self, samples: int = 1000):
+        self.samples = samples
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self._errors: Dict[str, int] = {}
+        self._started_at = time.time()
+
+    def record(self, name: str, seconds: float) -> None:
+        if name not in self._samples:
+            self._samples[name] = deque(maxlen=self.samples)
+            self._counts[name] = 0
+        self._samples[name].append(seconds)
+        self._counts[name] += 1
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Замер блока кода; участок, завершившийся исключением, считается и как ошибка"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._errors[name] = self._errors.get(name, 0) + 1
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def timed(self, name: str):
+        """Декоратор корутины: каждый вызов - замер участка name"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Участок -> число замеров, ошибок и перцентили по последним замерам, сек"""
+        result = {}
+        for name in sorted(self._samples):
+            values = sorted(self._samples[name])
+            result[name] = {
+                'count': self._counts[name],
+                'errors': self._errors.get(name, 0),
+                'avg': sum(values) / len(values),
+                'p50': _percentile(values, 0.50),
+                'p95': _percentile(values, 0.95),
+                'p99': _percentile(values, 0.99),
+                'max': values[-1],
+            }
+        return result
+
+    def dump(self) -> str:
+        """Снимок в JSON для внешних систем"""
+        return json.dumps(
+            {
+                'started_at': self._started_at,
+                'uptime': time.time() - self._started_at,
+                'samples': self.samples,
+                'spans': self.snapshot(),
+            },
+            ensure_ascii=False,
+            indent=2
+        )
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return values[min(int(len(values) * q), len(values) - 1)]
@@ -0,0 +1,35 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Union
+
+# Все суммы в боте хранятся и считаются в целых микро-USDT: 1 USDT = 1_000_000 единиц.
+# Decimal/float/строки появляются только на границах: ввод пользователя, Crypto Pay API и вывод в сообщения.
+Money = int
+
+UNITS = 1_000_000
+
+
+def to_units(value: Union[int, float, str, Decimal]) -> Money:
+    """Переводит сумму в USDT (число или строку) в целые микро-USDT"""
+    try:
+        units = (Decimal(str(value)) * UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}")
+    return int(units)
+
+
+def to_decimal(units: Money) -> Decimal:
+    return Decimal(units) / UNITS
+
+
+def to_str(units: Money) -> str:
+    """Строка для Crypto Pay API и сообщений: без лишних нулей, например '0.185'"""
+    return format(to_decimal(units).normalize(), 'f')
+
+
+def fmt(units: Money, places: int = 2) -> str:
+    return f"{to_decimal(units):.{places}f}"
+
+
+def scale(units: Money, percent: int) -> Money:
+    """Умножает сумму на коэффициент, заданный в процентах (x1.85 -> 185)"""
+    return units * percent // 100
@@ -0,0 +1,41 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database, MIGRATIONS
+
+
+@pytest.fixture
+def with_db(tmp_path):
+    """Запускает сценарий scenario(db) на свежей базе во временном каталоге"""
+    def run(scenario, path=None):
+        async def main():
+            db = Database(str(path or tmp_path / "test.casino"), readers=2)
+            await db.init()
+            try:
+                return await scenario(db)
+            finally:
+                await db.close()
+        return asyncio.run(main())
+    return run
+
+
+@pytest.fixture
+def v0_database(tmp_path):
+    """База в исходной схеме (user_version 0): суммы в долларах, без проекций и индексов"""
+    path = tmp_path / "v0.casino"
+    conn = sqlite3.connect(path)
+    for statement in MIGRATIONS[0][1]:
+        conn.execute(statement)
+    conn.execute("INSERT INTO users (user_id, username, balance) VALUES (1, 'referrer', 1.5)")
+    conn.execute("INSERT INTO users (user_id, username, referrer_id) VALUES (2, 'player', 1)")
+    conn.execute("INSERT INTO transactions (user_id, amount, type, game_type) VALUES (2, -0.25, 'game', 'cube')")
+    conn.execute("INSERT INTO transactions (user_id, amount, type, game_type) VALUES (2, 0.1, 'game', 'cube')")
+    conn.commit()
+    conn.close()
+    return path
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import cryptopay
+from cryptopay import CircuitBreaker, CryptoPayAPI, CryptoPayOutcomeUnknown, CryptoPayUnavailable
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cryptopay.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert breaker.trips == 1
+    assert not breaker.allow()
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(threshold=3)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock[0] += 29
+    assert breaker.retry_in() == pytest.approx(1)
+    assert not breaker.allow()
+
+    clock[0] += 1
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    # Пока пробный запрос не завершился, остальные отклоняются
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_probe_result_closes_or_reopens(clock):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert breaker.trips == 1
+
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def run_api(endpoint, scenario):
+    """Запускает scenario(api, calls) против сервера, отвечающего 500 на endpoint"""
+    calls = []
+
+    async def handle(request):
+        calls.append(request.path)
+        return web.Response(status=500)
+
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', f"/api/{endpoint}", handle)
+        server = TestServer(app)
+        await server.start_server()
+        api = CryptoPayAPI('1234:AAA', base_url=str(server.make_url('/api')), backoff=0, breaker=CircuitBreaker(threshold=100))
+        try:
+            await scenario(api)
+        finally:
+            await api.close()
+            await server.close()
+
+    asyncio.run(main())
+    return calls
+
+
+def test_create_check_is_not_retried_after_reaching_api():
+    async def scenario(api):
+        with pytest.raises(CryptoPayOutcomeUnknown):
+            await api.create_check(1_000_000)
+
+    assert len(run_api('createCheck', scenario)) == 1
+
+
+def test_idempotent_request_is_retried_and_fails_plainly():
+    async def scenario(api):
+        with pytest.raises(CryptoPayUnavailable) as e:
+            await api._make_request("GET", "getChecks")
+        assert not isinstance(e.value, CryptoPayOutcomeUnknown)
+
+    assert len(run_api('getChecks', scenario)) == 3
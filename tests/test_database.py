@@ -0,0 +1,340 @@
+import asyncio
+
+import pytest
+
+from database import MAX_BET_ATTEMPTS
+
+
+async def queue_bet(db, user_id, amount=1_000_000, game='cube', bet_type='чет'):
+    return await db.add_to_queue(user_id=user_id, amount=amount, game=game, bet_type=bet_type, name='n', comment='c')
+
+
+async def queue_row(db, queue_id):
+    async with db._read() as conn:
+        async with conn.execute("SELECT * FROM queue WHERE id = ?", (queue_id,)) as cursor:
+            return dict(await cursor.fetchone())
+
+
+def test_group_commit_rolls_back_only_failed_write(with_db):
+    async def scenario(db):
+        async def failing(conn):
+            await conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'lost')")
+            raise ValueError("boom")
+
+        async def ok(conn):
+            await conn.execute("INSERT INTO users (user_id, username) VALUES (2, 'kept')")
+
+        results = await asyncio.gather(db._submit(failing), db._submit(ok), return_exceptions=True)
+        assert isinstance(results[0], ValueError)
+        assert results[1] is None
+        assert await db.get_user(1) is None
+        assert (await db.get_user(2))['username'] == 'kept'
+
+    with_db(scenario)
+
+
+def test_ref_count_follows_referrals(with_db):
+    async def scenario(db):
+        await db.create_user(1, 'referrer')
+        await db.create_user(2, 'first', referrer_id=1)
+        await db.create_user(3, 'second', referrer_id=1)
+        # Повторная регистрация не считается
+        await db.create_user(3, 'second', referrer_id=1)
+        assert (await db.get_user(1))['ref_count'] == 2
+        await db.delete_user(2)
+        assert (await db.get_user(1))['ref_count'] == 1
+
+    with_db(scenario)
+
+
+def test_delete_user_drops_pending_ref_events(with_db):
+    async def scenario(db):
+        await db.create_user(1, 'referrer')
+        await db.create_user(2, 'middle', referrer_id=1)
+        await db.create_user(3, 'referral', referrer_id=2)
+        await db.create_user(4, 'other', referrer_id=1)
+        await db.apply_referral_change(1, 2, 100)
+        await db.apply_referral_change(2, 3, 200)
+        await db.apply_referral_change(1, 4, 300)
+        await db.delete_user(2)
+        digests = await db.get_ref_digests(float('inf'))
+        assert [(d['referrer_id'], d['net']) for d in digests] == [(1, 300)]
+
+    with_db(scenario)
+
+
+def test_search_users(with_db):
+    async def scenario(db):
+        await db.create_user(123456, 'xabcx')
+        await db.create_user(124000, 'Other')
+        await db.create_user(999, 'abc')
+
+        async def found(query):
+            return sorted(user['user_id'] for user in await db.search_users(query))
+
+        assert await found('ABC') == [999, 123456]
+        # Короче триграммы - всё равно подстрока, а не префикс
+        assert await found('ab') == [999, 123456]
+        assert await found('@other') == [124000]
+        assert await found('12') == [123456, 124000]
+        assert await found('1234') == [123456]
+        assert await found('%') == []
+
+    with_db(scenario)
+
+
+def test_users_page_walks_all_users_once(with_db):
+    async def scenario(db):
+        for user_id in range(1, 8):
+            await db.create_user(user_id, f'user{user_id}')
+        for newest_first in (True, False):
+            seen = []
+            after = None
+            while True:
+                page = await db.get_users_page(limit=3, after=after, newest_first=newest_first)
+                if not page:
+                    break
+                seen += [user['user_id'] for user in page]
+                after = (page[-1]['created_at'], page[-1]['user_id'])
+            assert seen == sorted(seen, reverse=newest_first)
+            assert sorted(seen) == list(range(1, 8))
+
+    with_db(scenario)
+
+
+def test_claim_bet_is_fifo_per_user(with_db):
+    async def scenario(db):
+        first = await queue_bet(db, 1)
+        second = await queue_bet(db, 1)
+        other = await queue_bet(db, 2)
+
+        assert (await db.claim_bet('w:0'))['id'] == first
+        # Вторая ставка игрока ждёт, пока первая в работе
+        assert (await db.claim_bet('w:1'))['id'] == other
+        assert await db.claim_bet('w:2') is None
+
+        assert await db.finish_bet(first, 'w:0')
+        assert (await db.claim_bet('w:2'))['id'] == second
+
+    with_db(scenario)
+
+
+def test_expired_lease_is_reclaimed_until_attempts_run_out(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        for attempt in range(1, MAX_BET_ATTEMPTS + 1):
+            bet = await db.claim_bet(f'w:{attempt}', lease=-1)
+            assert bet['id'] == queue_id
+            assert bet['attempts'] == attempt
+        assert await db.claim_bet('w:last') is None
+        assert (await queue_row(db, queue_id))['status'] == 'failed'
+
+    with_db(scenario)
+
+
+def test_lease_holder_only(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0')
+        assert not await db.extend_lease(queue_id, 'w:1')
+        assert not await db.finish_bet(queue_id, 'w:1')
+        assert await db.extend_lease(queue_id, 'w:0')
+
+    with_db(scenario)
+
+
+def test_advance_bet_with_delay_returns_bet_to_queue(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0')
+        assert not await db.advance_bet(queue_id, 'w:1', 'roll', {})
+        assert await db.advance_bet(queue_id, 'w:0', 'reveal', {'dice': 4}, delay=60)
+
+        row = await queue_row(db, queue_id)
+        assert (row['status'], row['stage'], row['worker_id']) == ('pending', 'reveal', None)
+        # Пауза не истекла - ставку не выдают
+        assert await db.claim_bet('w:1') is None
+
+    with_db(scenario)
+
+
+def test_advance_bet_resumes_saved_stage(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0')
+        assert await db.advance_bet(queue_id, 'w:0', 'reveal', {'dice': 4}, delay=0.01)
+        await asyncio.sleep(0.05)
+        bet = await db.claim_bet('w:1')
+        assert (bet['id'], bet['stage'], bet['state']) == (queue_id, 'reveal', {'dice': 4})
+
+    with_db(scenario)
+
+
+def test_settle_bet_settles_once(with_db):
+    async def scenario(db):
+        await db.create_user(1, 'player')
+        queue_id = await queue_bet(db, 1)
+        bet = await db.claim_bet('w:0')
+        await db.advance_bet(queue_id, 'w:0', 'settle', {})
+        bet['stage'] = 'settle'
+
+        settlement = await db.settle_bet(bet, 'w:0', 'win', 1_850_000, 0)
+        assert settlement['referrer_id'] is None
+        with pytest.raises(RuntimeError):
+            await db.settle_bet(bet, 'w:0', 'win', 1_850_000, 0)
+
+        async with db._read() as conn:
+            async with conn.execute("SELECT amount FROM transactions WHERE user_id = 1 ORDER BY id") as cursor:
+                amounts = [row[0] for row in await cursor.fetchall()]
+        assert amounts == [-1_000_000, 1_850_000]
+        assert (await queue_row(db, queue_id))['stage'] == 'notify'
+
+    with_db(scenario)
+
+
+def test_settle_bet_rejects_foreign_worker(with_db):
+    async def scenario(db):
+        await db.create_user(1, 'player')
+        queue_id = await queue_bet(db, 1)
+        bet = await db.claim_bet('w:0')
+        await db.advance_bet(queue_id, 'w:0', 'settle', {})
+        with pytest.raises(RuntimeError):
+            await db.settle_bet(bet, 'w:1', 'lose', 0, 0)
+        async with db._read() as conn:
+            async with conn.execute("SELECT COUNT(*) FROM transactions") as cursor:
+                assert (await cursor.fetchone())[0] == 0
+
+    with_db(scenario)
+
+
+def test_claim_invoice_bet_is_idempotent(with_db):
+    async def scenario(db):
+        await db.add_invoice_bet('bet_1', 1, 'cube', 'чет', 1_000_000, name='Player')
+        claims = await asyncio.gather(*(db.claim_invoice_bet('bet_1') for _ in range(5)))
+        won = [claim for claim in claims if claim]
+        assert len(won) == 1
+        assert await db.claim_invoice_bet('bet_1') is None
+        assert await db.claim_invoice_bet('bet_unknown') is None
+
+        row = await queue_row(db, won[0]['queue_id'])
+        assert (row['payload'], row['name'], row['amount']) == ('bet_1', 'Player', 1_000_000)
+        assert (await db.get_invoice_bet('bet_1'))['status'] == 'processing'
+        assert await db.get_claimed_payloads(10) == ['bet_1']
+
+    with_db(scenario)
+
+
+def test_retry_bet_keeps_attempts(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0')
+        assert not await db.retry_bet(queue_id, 'w:1', 0)
+        assert await db.retry_bet(queue_id, 'w:0', 0)
+        bet = await db.claim_bet('w:1')
+        assert bet['attempts'] == 2
+
+    with_db(scenario)
+
+
+def test_failed_settlements_stop_after_max_attempts(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0')
+        await db.advance_bet(queue_id, 'w:0', 'settle', {})
+        await db.finish_bet(queue_id, 'w:0', 'failed')
+
+        assert await db.requeue_failed_settlements() == 1
+        assert await db.hold_failed_settlements() == []
+
+        # Попытки считаются с перехода на этап settle
+        for attempt in range(1, MAX_BET_ATTEMPTS + 1):
+            bet = await db.claim_bet('w:0')
+            assert bet['attempts'] == attempt
+            await db.finish_bet(queue_id, 'w:0', 'failed')
+            if attempt < MAX_BET_ATTEMPTS:
+                assert await db.requeue_failed_settlements() == 1
+
+        assert await db.requeue_failed_settlements() == 0
+        assert [bet['id'] for bet in await db.hold_failed_settlements()] == [queue_id]
+        assert (await queue_row(db, queue_id))['status'] == 'manual'
+
+    with_db(scenario)
+
+
+def test_failed_bets_before_settle_are_refunded(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0')
+        await db.advance_bet(queue_id, 'w:0', 'roll', {})
+        await db.finish_bet(queue_id, 'w:0', 'failed')
+        # Ожидающая ставка в пределах окна не возвращается
+        await queue_bet(db, 2)
+
+        refunds = await db.get_bets_to_refund()
+        assert [bet['id'] for bet in refunds] == [queue_id]
+        assert await db.start_refund(queue_id, 'failed')
+        assert not await db.start_refund(queue_id, 'failed')
+        await db.finish_refund(queue_id)
+        assert (await queue_row(db, queue_id))['status'] == 'refunded'
+
+    with_db(scenario)
+
+
+def test_claim_bet_respects_max_in_flight(with_db):
+    async def scenario(db):
+        first = await queue_bet(db, 1)
+        staged = await queue_bet(db, 2)
+        await queue_bet(db, 3)
+        assert (await db.claim_bet('w:0', max_in_flight=2))['id'] == first
+        assert (await db.claim_bet('w:1', max_in_flight=2))['id'] == staged
+        assert await db.advance_bet(staged, 'w:1', 'reveal', {}, delay=0.01)
+        # Ставка в паузе между этапами занимает место, новые ждут
+        assert await db.claim_bet('w:2', max_in_flight=2) is None
+        await asyncio.sleep(0.05)
+        assert (await db.claim_bet('w:2', max_in_flight=2))['id'] == staged
+
+    with_db(scenario)
+
+
+def test_queue_position(with_db):
+    async def scenario(db):
+        first = await queue_bet(db, 1)
+        second = await queue_bet(db, 1)
+        other = await queue_bet(db, 2)
+        assert (await db.get_queue_position(first))['position'] == 1
+        position = await db.get_queue_position(second)
+        assert (position['position'], position['user_ahead']) == (2, 1)
+        assert (await db.get_queue_position(other))['user_ahead'] == 0
+
+    with_db(scenario)
+
+
+def test_save_bet_state_keeps_stage_and_attempts(with_db):
+    async def scenario(db):
+        queue_id = await queue_bet(db, 1)
+        await db.claim_bet('w:0', lease=-1)
+        bet = await db.claim_bet('w:1')
+        assert bet['attempts'] == 2
+        # Прежний держатель ставки сохранить ничего не может
+        assert not await db.save_bet_state(queue_id, 'w:0', {'check_link': 'stale'})
+        assert await db.save_bet_state(queue_id, 'w:1', {'check_link': 'link'})
+
+        row = await queue_row(db, queue_id)
+        assert (row['attempts'], row['stage'], row['state']) == (2, None, '{"check_link": "link"}')
+
+    with_db(scenario)
+
+
+def test_late_paid_expired_invoice_is_claimed_for_refund_once(with_db):
+    async def scenario(db):
+        await db.add_invoice_bet('bet_late', 1, 'cube', 'чет', 1_000_000)
+        assert await db.expire_invoice_bet('bet_late')
+        assert await db.claim_invoice_bet('bet_late') is None
+
+        claims = await asyncio.gather(*(db.claim_expired_invoice_bet('bet_late') for _ in range(3)))
+        assert [claim['amount'] for claim in claims if claim] == [1_000_000]
+        await db.finish_expired_invoice_refund('bet_late')
+        assert (await db.get_invoice_bet('bet_late'))['status'] == 'refunded'
+        assert await db.claim_expired_invoice_bet('bet_late') is None
+
+    with_db(scenario)
@@ -0,0 +1,58 @@
+from database import MIGRATIONS
+
+
+async def user_version(db):
+    async with db._read() as conn:
+        async with conn.execute("PRAGMA user_version") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+def test_migrates_v0_database_to_latest(v0_database, with_db):
+    async def scenario(db):
+        assert await user_version(db) == MIGRATIONS[-1][0]
+        assert (await db.get_user(2))['username'] == 'player'
+
+    with_db(scenario, v0_database)
+
+
+def test_migrate_is_idempotent(with_db):
+    async def scenario(db):
+        assert await db.migrate() == MIGRATIONS[-1][0]
+        assert await user_version(db) == MIGRATIONS[-1][0]
+
+    with_db(scenario)
+
+
+def test_amounts_are_rescaled_to_micro_usdt(v0_database, with_db):
+    async def scenario(db):
+        assert (await db.get_user(1))['balance'] == 1_500_000
+        async with db._read() as conn:
+            async with conn.execute("SELECT amount FROM transactions ORDER BY id") as cursor:
+                assert [row[0] for row in await cursor.fetchall()] == [-250_000, 100_000]
+
+    with_db(scenario, v0_database)
+
+
+def test_user_stats_are_backfilled(v0_database, with_db):
+    async def scenario(db):
+        async with db._read() as conn:
+            async with conn.execute("SELECT * FROM user_stats WHERE user_id = 2") as cursor:
+                stats = dict(await cursor.fetchone())
+        assert (stats['total_games'], stats['wins'], stats['losses']) == (2, 1, 1)
+        assert (stats['total_won'], stats['total_lost'], stats['turnover']) == (100_000, 250_000, 350_000)
+
+    with_db(scenario, v0_database)
+
+
+def test_ref_count_is_recounted(v0_database, with_db):
+    async def scenario(db):
+        assert (await db.get_user(1))['ref_count'] == 1
+
+    with_db(scenario, v0_database)
+
+
+def test_usernames_are_indexed_for_search(v0_database, with_db):
+    async def scenario(db):
+        assert [user['user_id'] for user in await db.search_users('laye')] == [2]
+
+    with_db(scenario, v0_database)
@@ -0,0 +1,64 @@
+import asyncio
+
+from treasury import Treasury
+
+
+class FakeAPI:
+    def __init__(self, balance):
+        self.balance = balance
+        self.calls = 0
+
+    async def get_asset_balance(self, asset):
+        self.calls += 1
+        return self.balance
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+def test_reservations_share_cached_balance():
+    async def scenario():
+        api = FakeAPI(3_000_000)
+        treasury = Treasury(api)
+        reservations = [await treasury.reserve(1_000_000) for _ in range(5)]
+        assert sum(r is not None for r in reservations) == 3
+        assert treasury.available() == 0
+        assert api.calls == 1
+
+        treasury.release(1_000_000, spent=False, reserved_at=reservations[0])
+        assert treasury.available() == 1_000_000
+        treasury.release(1_000_000, spent=True, reserved_at=reservations[1])
+        assert treasury.stats()['balance'] == 2_000_000
+        assert treasury.reserved == 1_000_000
+    run(scenario)
+
+
+def test_spend_is_not_subtracted_twice_after_refresh():
+    async def scenario():
+        api = FakeAPI(3_000_000)
+        treasury = Treasury(api)
+        reserved_at = await treasury.reserve(1_000_000)
+
+        # Баланс обновился, пока создавался чек, и уже учёл его
+        api.balance = 2_000_000
+        treasury.invalidate()
+        await treasury.refresh()
+        treasury.release(1_000_000, spent=True, reserved_at=reserved_at)
+        assert treasury.reserved == 0
+
+        assert await treasury.reserve(2_000_000) is not None
+        assert treasury.stats()['balance'] == 2_000_000
+    run(scenario)
+
+
+def test_unknown_balance_refuses_payout():
+    async def scenario():
+        class DownAPI:
+            async def get_asset_balance(self, asset):
+                raise ConnectionError("down")
+
+        treasury = Treasury(DownAPI())
+        assert await treasury.reserve(1) is None
+        assert treasury.stats()['refresh_errors'] == 1
+    run(scenario)
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import hmac
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import SIGNATURE_HEADER, WebhookServer, sign, signed_update, verify
+
+TOKEN = '1234:AAA'
+
+
+def test_sign_matches_crypto_pay_scheme():
+    body = b'{"update_id":1}'
+    secret = hashlib.sha256(TOKEN.encode()).digest()
+    assert sign(TOKEN, body) == hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def test_verify():
+    body, headers = signed_update(TOKEN, 'bet_1')
+    assert verify(TOKEN, body, headers[SIGNATURE_HEADER])
+    assert not verify('other', body, headers[SIGNATURE_HEADER])
+    assert not verify(TOKEN, body + b' ', headers[SIGNATURE_HEADER])
+    assert not verify(TOKEN, body, None)
+    assert not verify(TOKEN, body, '')
+
+
+def post_updates(requests):
+    """Шлёт запросы (тело, заголовки) на приёмник; возвращает статусы ответов и полученные payload'ы"""
+    async def main():
+        paid = []
+
+        async def on_invoice_paid(payload):
+            await asyncio.sleep(0.01)
+            paid.append(payload)
+
+        server = WebhookServer(TOKEN)
+        server._on_invoice_paid = on_invoice_paid
+        statuses = []
+        async with TestClient(TestServer(server.app())) as client:
+            for body, headers in requests:
+                response = await client.post(server.path, data=body, headers=headers)
+                statuses.append(response.status)
+        await server.stop()
+        return statuses, paid, server.stats()
+    return asyncio.run(main())
+
+
+def test_invoice_paid_is_handed_over():
+    statuses, paid, stats = post_updates([signed_update(TOKEN, 'bet_1')])
+    assert statuses == [200]
+    assert paid == ['bet_1']
+    assert stats['invoices_paid'] == 1
+
+
+def test_rejects_bad_signature():
+    body, headers = signed_update('other', 'bet_1')
+    statuses, paid, stats = post_updates([(body, headers), (body, {})])
+    assert statuses == [401, 401]
+    assert paid == []
+    assert stats['rejected'] == 2
+
+
+def test_rejects_non_object_body():
+    requests = [(body, {SIGNATURE_HEADER: sign(TOKEN, body)}) for body in (b'[]', b'not json', b'"x"')]
+    statuses, paid, _ = post_updates(requests)
+    assert statuses == [400, 400, 400]
+    assert paid == []
+
+
+def test_ignores_other_updates():
+    body = json.dumps({'update_type': 'invoice_paid', 'payload': []}).encode()
+    other = json.dumps({'update_type': 'check_activated', 'payload': {'payload': 'x'}}).encode()
+    requests = [(b, {SIGNATURE_HEADER: sign(TOKEN, b)}) for b in (body, other)]
+    statuses, paid, _ = post_updates(requests)
+    assert statuses == [200, 200]
+    assert paid == []
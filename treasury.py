@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+from typing import Optional, Dict
+
+from cryptopay import CryptoPayAPI
+from money import Money
+
+
+class Treasury:
+    """Баланс казны в Crypto Pay с кешем и локальными резервами под создаваемые чеки.
+
+    Баланс обновляется фоновой задачей раз в refresh_interval секунд, поэтому проверка "хватит ли
+    на выплату" обычно не ходит в сеть. Сумма чека резервируется до его создания, так что
+    параллельные выплаты не рассчитывают на одни и те же деньги. Созданный чек списывается
+    с кеша сразу, не дожидаясь следующего обновления, - если баланс не обновился, пока чек создавался:
+    тогда неизвестно, учтён ли чек в новом балансе, и кеш считается устаревшим. В сеть reserve идёт, только если кеш
+    старше ttl (фоновое обновление не справляется) или ещё не загружен.
+    """
+
+    def __init__(
+        self,
+        crypto_pay: CryptoPayAPI,
+        asset: str = "USDT",
+        ttl: float = 60.0,
+        refresh_interval: float = 15.0
+    ):
+        self.crypto_pay = crypto_pay
+        self.asset = asset
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._balance: Optional[Money] = None
+        self._reserved: Money = 0
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    @property
+    def reserved(self) -> Money:
+        return self._reserved
+
+    def available(self) -> Money:
+        """Баланс из кеша за вычетом резервов; 0, пока баланс не загружен"""
+        return max((self._balance or 0) - self._reserved, 0)
+
+    def can_pay(self, amount: Money) -> bool:
+        """Хватит ли на выплату по кешу, без запроса к API"""
+        return self._balance is not None and self.available() >= amount
+
+    async def refresh(self) -> Optional[Money]:
+        """Загружает баланс из API. Одновременные вызовы делают один запрос"""
+        requested_at = time.monotonic()
+        async with self._lock:
+            # Пока ждали блокировку, баланс уже обновил другой вызов
+            if self._fetched_at >= requested_at:
+                return self._balance
+            try:
+                self._balance = await self.crypto_pay.get_asset_balance(self.asset)
+                self._fetched_at = time.monotonic()
+                self.refreshes += 1
+            except Exception as e:
+                self.refresh_errors += 1
+                logging.error(f"Failed to refresh treasury balance: {e}")
+            return self._balance
+
+    async def reserve(self, amount: Money) -> Optional[float]:
+        """Резервирует сумму под чек. Возвращает отметку баланса для release; None - денег не хватает
+        или баланс неизвестен"""
+        if self._balance is None or time.monotonic() - self._fetched_at > self.ttl:
+            await self.refresh()
+        if not self.can_pay(amount):
+            return None
+        self._reserved += amount
+        return self._fetched_at
+
+    def release(self, amount: Money, spent: bool, reserved_at: float) -> None:
+        """Снимает резерв, взятый при балансе reserved_at. Потраченная сумма сразу списывается с кеша"""
+        self._reserved -= amount
+        if not spent or self._balance is None:
+            return
+        if self._fetched_at == reserved_at:
+            self._balance -= amount
+        else:
+            # Баланс обновился, пока создавался чек: списан ли чек в нём, неизвестно
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        """Баланс мог измениться неизвестно как (чек создан или нет): следующий reserve обновит его"""
+        self._fetched_at = 0.0
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    def stats(self) -> Dict:
+        return {
+            'balance': self._balance,
+            'reserved': self._reserved,
+            'available': self.available(),
+            'age': time.monotonic() - self._fetched_at if self._fetched_at else None,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+        }
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from typing import Optional, Dict, Set, Tuple, Awaitable, Callable
+
+from aiohttp import web
+
+SIGNATURE_HEADER = "crypto-pay-api-signature"
+
+# Обработчик оплаченного инвойса: получает payload, с которым инвойс создавался
+InvoicePaidHandler = Callable[[str], Awaitable[None]]
+
+
+def sign(api_token: str, body: bytes) -> str:
+    """Подпись тела запроса, как её считает Crypto Pay: HMAC-SHA256 с ключом SHA256(токен)"""
+    secret = hashlib.sha256(api_token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify(api_token: str, body: bytes, signature: Optional[str]) -> bool:
+    return bool(signature) and hmac.compare_digest(sign(api_token, body), signature)
+
+
+def signed_update(api_token: str, payload: str, invoice_id: int = 1, update_id: int = 1) -> Tuple[bytes, Dict[str, str]]:
+    """Тело и заголовки подписанного обновления invoice_paid - для проверки приёмника без Crypto Pay"""
+    update = {
+        'update_id': update_id,
+        'update_type': 'invoice_paid',
+        'request_date': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+        'payload': {'invoice_id': invoice_id, 'status': 'paid', 'payload': payload},
+    }
+    body = json.dumps(update).encode()
+    return body, {'Content-Type': 'application/json', SIGNATURE_HEADER: sign(api_token, body)}
+
+
+class WebhookServer:
+    """Приёмник обновлений Crypto Pay.
+
+    Подпись проверяется по сырому телу запроса; неподписанные и подделанные запросы отклоняются с 401.
+    Обновление invoice_paid передаётся в обработчик из start() отдельной задачей, а Crypto Pay сразу
+    получает ответ - медленный Telegram не приводит к таймаутам и повторной доставке.
+    Обработчик должен быть идемпотентным: Crypto Pay повторяет недоставленные обновления, а тот же
+    платёж может найти и опрос инвойсов.
+    """
+
+    def __init__(
+        self,
+        api_token: str,
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        path: str = "/cryptopay"
+    ):
+        self.api_token = api_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self._on_invoice_paid: Optional[InvoicePaidHandler] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.received = 0
+        self.rejected = 0
+        self.invoices_paid = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        return app
+
+    async def start(self, on_invoice_paid: InvoicePaidHandler) -> None:
+        self._on_invoice_paid = on_invoice_paid
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Crypto Pay webhook listening on {self.host}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        """Останавливает приём и дожидается уже принятых оплат"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.received += 1
+        body = await request.read()
+        if not verify(self.api_token, body, request.headers.get(SIGNATURE_HEADER)):
+            self.rejected += 1
+            logging.warning(f"Rejected Crypto Pay webhook with bad signature from {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = json.loads(body)
+        except ValueError:
+            update = None
+        if not isinstance(update, dict):
+            self.rejected += 1
+            return web.Response(status=400)
+
+        if update.get('update_type') == 'invoice_paid':
+            invoice = update.get('payload')
+            payload = invoice.get('payload') if isinstance(invoice, dict) else None
+            if payload:
+                self.invoices_paid += 1
+                task = asyncio.create_task(self._on_invoice_paid(payload))
+                self._tasks.add(task)
+                task.add_done_callback(self._task_done)
+        return web.Response(text="ok")
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Error handling Crypto Pay invoice_paid update: {task.exception()}")
+
+    def stats(self) -> Dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'invoices_paid': self.invoices_paid,
+        }
+
+
+if __name__ == '__main__':
+    # python webhook.py --url http://127.0.0.1:8080/cryptopay --payload bet_... — шлёт подписанное invoice_paid
+    import argparse
+    import os
+
+    import aiohttp
+
+    async def _send(url: str, payload: str, invoice_id: int, api_token: str) -> None:
+        body, headers = signed_update(api_token, payload, invoice_id)
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, data=body, headers=headers) as response:
+                print(response.status, await response.text())
+
+    parser = argparse.ArgumentParser(description="Отправка подписанного обновления invoice_paid на приёмник бота")
+    parser.add_argument('--url', default="http://127.0.0.1:8080/cryptopay")
+    parser.add_argument('--payload', required=True, help="payload инвойса ставки")
+    parser.add_argument('--invoice-id', type=int, default=1)
+    parser.add_argument('--token', default=os.getenv('CRYPTO_PAY_TOKEN'), help="по умолчанию CRYPTO_PAY_TOKEN")
+    args = parser.parse_args()
+    asyncio.run(_send(args.url, args.payload, args.invoice_id, args.token))
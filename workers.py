@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import socket
+import time
+from collections import deque
+from typing import Optional, List, Dict, Awaitable, Callable, Tuple
+
+from database import Database, MAX_BET_ATTEMPTS
+
+# Этап розыгрыша: получает ставку (bet['state'] - данные, накопленные прошлыми этапами) и возвращает
+# (следующий этап, задержка в секундах) или None, если ставка разыграна. Этап, который сам записал
+# переход в своей транзакции, выставляет bet['stage'] в следующий этап - пул тогда его не пересохраняет
+StageHandler = Callable[[Dict], Awaitable[Optional[Tuple[str, float]]]]
+
+
+class BetWorkerPool:
+    """Пул воркеров, разбирающих таблицу queue.
+
+    Ставки захватываются атомарно с арендой (Database.claim_bet), поэтому очередь можно разбирать
+    из нескольких задач и процессов сразу. Ставки разных игроков разыгрываются параллельно, ставки
+    одного игрока - строго по очереди. Пока ставка в игре, воркер продлевает аренду; аренду упавшего
+    воркера после истечения перехватывает другой.
+
+    Приём ограничен: начатых и не доигранных ставок не больше max_in_flight, остальные ждут в queue.
+    Ожидание в очереди дольше queue_slo секунд считается нарушением SLO.
+
+    Ставка проходит этапы (stages). Этап сохраняется в базе после каждого шага; если этапу нужна пауза
+    (анимация броска), ставка возвращается в очередь с таймером, а воркер берёт другие ставки.
+    Упавший этап повторяется через retry_delay * попытка секунд; после MAX_BET_ATTEMPTS попыток ставка
+    помечается failed и дальше ею занимается разбор упавших ставок в боте.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        workers: int = 4,
+        poll_interval: float = 1.0,
+        lease: float = 30.0,
+        samples: int = 1000,
+        name: Optional[str] = None,
+        max_in_flight: Optional[int] = None,
+        queue_slo: Optional[float] = None,
+        retry_delay: float = 5.0
+    ):
+        self.db = db
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_in_flight = max_in_flight
+        self.queue_slo = queue_slo
+        self.retry_delay = retry_delay
+        # Постоянное имя процесса: после перезапуска он узнаёт свои ставки по worker_id 'name:N'.
+        # Несколько процессов на одном хосте должны получить разные имена
+        self.name = name or socket.gethostname()
+        self._stages: Dict[str, StageHandler] = {}
+        self._first_stage: Optional[str] = None
+        self._tasks: List[asyncio.Task] = []
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._running = False
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.slo_breaches = 0
+        self._last_wait = 0.0
+        # Последние значения ожидания в очереди до первого этапа, сек
+        self._waits = deque(maxlen=samples)
+        # Этап -> число выполнений, ошибок и суммарное время
+        self._stage_stats: Dict[str, Dict] = {}
+        self._started_at = time.time()
+
+    def start(self, stages: Dict[str, StageHandler]) -> None:
+        """stages - этапы в порядке прохождения; новые ставки начинают с первого"""
+        self._stages = stages
+        self._first_stage = next(iter(stages))
+        self._stage_stats = {name: {'count': 0, 'failed': 0, 'time': 0.0} for name in stages}
+        self._started_at = time.time()
+        self._running = True
+        self._tasks = [asyncio.create_task(self._worker(f"{self.name}:{i}")) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Дожидается ставок в игре; новые ставки остаются в очереди до следующего запуска"""
+        self._running = False
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        """Будит воркеры после добавления ставки в очередь"""
+        self._wakeup.set()
+
+    def overloaded(self) -> bool:
+        """Последняя начатая ставка прождала в очереди дольше SLO"""
+        return bool(self.queue_slo) and self._last_wait > self.queue_slo
+
+    async def _keep_lease(self, bet: Dict, worker_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                extended = await self.db.extend_lease(bet['id'], worker_id, self.lease)
+            except Exception as e:
+                # База занята - аренда ещё действует, пробуем на следующем такте
+                logging.error(f"Failed to extend lease of bet {bet['id']} by {worker_id}: {e}")
+                continue
+            if not extended:
+                logging.warning(f"Bet {bet['id']} lease lost by {worker_id}")
+                return
+
+    async def _worker(self, worker_id: str) -> None:
+        while self._running:
+            # Сбрасываем до поиска: ставка, добавленная во время поиска, снова взведёт событие
+            self._wakeup.clear()
+            try:
+                bet = await self.db.claim_bet(worker_id, self.lease, self.max_in_flight)
+            except Exception as e:
+                logging.error(f"Bet worker {worker_id} failed to claim a bet: {e}")
+                bet = None
+            if bet is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if bet['stage'] is None and bet['attempts'] == 1 and bet['enqueued_at']:
+                self._last_wait = time.time() - bet['enqueued_at']
+                self._waits.append(self._last_wait)
+                if self.queue_slo and self._last_wait > self.queue_slo:
+                    self.slo_breaches += 1
+            self._in_flight += 1
+            heartbeat = asyncio.create_task(self._keep_lease(bet, worker_id))
+            try:
+                status = await self._run_stages(bet, worker_id)
+            finally:
+                heartbeat.cancel()
+                self._in_flight -= 1
+            if status is not None:
+                try:
+                    if not await self.db.finish_bet(bet['id'], worker_id, status):
+                        logging.warning(f"Bet {bet['id']} was reclaimed before {worker_id} finished it")
+                except Exception as e:
+                    logging.error(f"Failed to finish bet {bet['id']}: {e}")
+                # Следующая ставка этого игрока освободилась
+                self._wakeup.set()
+
+    async def _run_stages(self, bet: Dict, worker_id: str) -> Optional[str]:
+        """Проводит ставку по этапам до конца или до паузы. Возвращает итоговый статус или None, если ставка отложена"""
+        stage = bet['stage'] or self._first_stage
+        while True:
+            bet['stage'] = stage
+            stats = self._stage_stats[stage]
+            started = time.time()
+            try:
+                step = await self._stages[stage](bet)
+            except Exception as e:
+                stats['failed'] += 1
+                self.failed += 1
+                logging.error(f"Error processing bet {bet['id']} at stage {stage}: {e}", exc_info=True)
+                return await self._retry_or_fail(bet, worker_id)
+            finally:
+                stats['time'] += time.time() - started
+            stats['count'] += 1
+
+            if step is None:
+                self.processed += 1
+                return 'done'
+
+            stage, delay = step
+            if bet['stage'] == stage and delay == 0:
+                continue
+            try:
+                saved = await self.db.advance_bet(bet['id'], worker_id, stage, bet['state'], delay, self.lease)
+            except Exception as e:
+                logging.error(f"Failed to save stage {stage} of bet {bet['id']}: {e}")
+                return await self._retry_or_fail(bet, worker_id)
+            if not saved:
+                logging.warning(f"Bet {bet['id']} was reclaimed before {worker_id} saved stage {stage}")
+                return None
+            if delay > 0:
+                asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+                return None
+
+    async def _retry_or_fail(self, bet: Dict, worker_id: str) -> Optional[str]:
+        """Возвращает ставку в очередь на повтор сохранённого этапа или, если попытки кончились, - 'failed'"""
+        if bet['attempts'] >= MAX_BET_ATTEMPTS:
+            return 'failed'
+        delay = self.retry_delay * bet['attempts']
+        try:
+            if not await self.db.retry_bet(bet['id'], worker_id, delay):
+                logging.warning(f"Bet {bet['id']} was reclaimed before {worker_id} scheduled a retry")
+                return None
+        except Exception as e:
+            # Не удалось даже вернуть в очередь: аренда истечёт, и ставку перехватит другой воркер
+            logging.error(f"Failed to schedule retry of bet {bet['id']}: {e}")
+            return None
+        self.retried += 1
+        asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+        return None
+
+    async def stats(self) -> Dict:
+        stats = await self.db.get_queue_stats()
+        waits = sorted(self._waits)
+        minutes = max(time.time() - self._started_at, 1) / 60
+        stats.update({
+            'workers': self.workers,
+            'max_in_flight': self.max_in_flight,
+            'queue_slo': self.queue_slo,
+            'slo_breaches': self.slo_breaches,
+            'in_flight': self._in_flight,
+            'processed': self.processed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'avg_wait': sum(waits) / len(waits) if waits else 0,
+            'p95_wait': waits[min(int(len(waits) * 0.95), len(waits) - 1)] if waits else 0,
+            'max_wait': waits[-1] if waits else 0,
+            'stages': {
+                name: {
+                    'count': s['count'],
+                    'failed': s['failed'],
+                    'per_minute': s['count'] / minutes,
+                    'avg_time': s['time'] / (s['count'] + s['failed']) if s['count'] + s['failed'] else 0,
+                }
+                for name, s in self._stage_stats.items()
+            },
+        })
+        return stats